@@ -0,0 +1,202 @@
+import copy
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ExactIndex:
+    """Brute-force scan over the whole gallery; the reference results"""
+
+    kind = "exact"
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+
+    def build(self):
+        return self
+
+    def add(self, name=None):
+        pass
+
+    def extended(self, gallery, names):
+        """Index of the next gallery version (see Gallery.extended)"""
+        return ExactIndex(gallery)
+
+    def search(self, embedding, k=1, nprobe=None):
+        return self.gallery.search(embedding, k)
+
+    def search_batch(self, embeddings, k=1, nprobe=None):
+        return self.gallery.search_batch(embeddings, k)
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate index over a Gallery.
+
+    A k-means coarse quantizer splits the gallery rows into nlist cells, and
+    each cell keeps an inverted list of the row positions assigned to it. A
+    query only scans the rows of its nprobe nearest cells, then the gallery
+    re-scores that shortlist exactly, so returned distances are still the
+    compare_embeddings distances. Raising nprobe trades latency for recall;
+    nprobe == nlist is an exhaustive search.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, gallery, nlist=None, nprobe=8, train_size=65536,
+                 iterations=10, min_train_size=4096, seed=0):
+        self.gallery = gallery
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.iterations = iterations
+        self.min_train_size = min_train_size
+        self.seed = seed
+
+        self.centroids = None
+        self._centroid_sq_norms = None
+        self._lists = []
+        self._assignments = np.empty(0, dtype=np.int32)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _assign(self, rows, chunk_size=16384):
+        """Nearest centroid for each row, in chunks to bound memory"""
+        assignments = np.empty(rows.shape[0], dtype=np.int32)
+        for start in range(0, rows.shape[0], chunk_size):
+            chunk = np.asarray(rows[start:start + chunk_size], dtype=np.float32)
+            # argmin ||c||^2 - 2 c.x  (||x||^2 is constant per row)
+            scores = self._centroid_sq_norms[None, :] - 2.0 * (chunk @ self.centroids.T)
+            assignments[start:start + chunk.shape[0]] = np.argmin(scores, axis=1)
+        return assignments
+
+    def _train(self, rows, nlist):
+        rng = np.random.default_rng(self.seed)
+        if rows.shape[0] > self.train_size:
+            sample = rows[np.sort(rng.choice(rows.shape[0], self.train_size, replace=False))]
+        else:
+            sample = rows
+        sample = np.asarray(sample, dtype=np.float32)
+
+        self._set_centroids(sample[rng.choice(sample.shape[0], nlist, replace=False)])
+        for _ in range(self.iterations):
+            assignments = self._assign(sample)
+            order = np.argsort(assignments, kind='stable')
+            counts = np.bincount(assignments, minlength=nlist)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+            centroids = np.empty_like(self.centroids)
+            filled = counts > 0
+            centroids[filled] = np.add.reduceat(sample[order], starts[filled], axis=0) / counts[filled, None]
+            # Re-seed empty cells with random training rows
+            if not filled.all():
+                centroids[~filled] = sample[rng.choice(sample.shape[0], int((~filled).sum()))]
+            self._set_centroids(centroids)
+
+    def _set_centroids(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self._centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+    def build(self):
+        """(Re)train the coarse quantizer and fill the inverted lists"""
+        rows = self.gallery.rows
+        count = rows.shape[0]
+        if count < self.min_train_size:
+            # Too small to train usefully; search falls back to an exact scan
+            self.centroids = None
+            self._lists = []
+            self._assignments = np.empty(0, dtype=np.int32)
+            return self
+
+        nlist = self.nlist or max(1, int(np.sqrt(count)))
+        nlist = min(nlist, count)
+        logger.info(f"Training IVF index with {nlist} lists on {count} embeddings...")
+        self._train(rows, nlist)
+
+        self._assignments = self._assign(rows)
+        order = np.argsort(self._assignments, kind='stable')
+        bounds = np.searchsorted(self._assignments[order], np.arange(nlist + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]].astype(np.int64) for i in range(nlist)]
+        logger.info("IVF index built.")
+        return self
+
+    def add(self, name=None):
+        """
+        Insert every row appended to the gallery since the index last saw it
+        (after Gallery.add or Gallery.extended), whichever identities they
+        belong to, in one pass
+        """
+        if not self.is_trained:
+            if self.gallery.rows.shape[0] >= self.min_train_size:
+                self.build()
+            return
+
+        start, count = self._assignments.shape[0], self.gallery.rows.shape[0]
+        if count <= start:
+            # Nothing new (the gallery ignored a duplicate template)
+            return
+        cells = self._assign(self.gallery.rows[start:count])
+
+        assignments = np.empty(count, dtype=np.int32)
+        assignments[:start] = self._assignments
+        assignments[start:] = cells
+        self._assignments = assignments
+
+        order = np.argsort(cells, kind='stable')
+        positions = np.arange(start, count, dtype=np.int64)[order]
+        touched, bounds = np.unique(cells[order], return_index=True)
+        for cell, part in zip(touched, np.split(positions, bounds[1:])):
+            self._lists[cell] = np.concatenate((self._lists[cell], part))
+
+    def extended(self, gallery, names):
+        """
+        Index of the next gallery version (see Gallery.extended), with its
+        new rows inserted. The inverted lists and assignments are replaced,
+        never modified in place, so only the list of lists is copied; this
+        index keeps serving its gallery.
+        """
+        index = copy.copy(self)
+        index.gallery = gallery
+        index._lists = list(self._lists)
+        index.add()
+        return index
+
+    def candidates(self, embedding, nprobe=None):
+        """Row positions stored in the nprobe cells nearest to the embedding"""
+        nprobe = min(nprobe or self.nprobe, len(self._lists))
+        probe = np.asarray(embedding, dtype=np.float32)
+        probe = probe / np.linalg.norm(probe)
+
+        scores = self._centroid_sq_norms - 2.0 * (self.centroids @ probe)
+        if nprobe < len(self._lists):
+            cells = np.argpartition(scores, nprobe - 1)[:nprobe]
+        else:
+            cells = np.arange(len(self._lists))
+        return np.concatenate([self._lists[cell] for cell in cells])
+
+    def search(self, embedding, k=1, nprobe=None):
+        if not self.is_trained:
+            return self.gallery.search(embedding, k)
+        return self.gallery.search(embedding, k, candidates=self.candidates(embedding, nprobe))
+
+    def search_batch(self, embeddings, k=1, nprobe=None):
+        if not self.is_trained:
+            return self.gallery.search_batch(embeddings, k)
+        # Each probe visits its own cells, so the shortlists are scanned separately
+        return [self.search(embedding, k, nprobe) for embedding in embeddings]
+
+
+INDEX_TYPES = {
+    ExactIndex.kind: ExactIndex,
+    IVFIndex.kind: IVFIndex,
+}
+
+
+def create_index(kind, gallery, **options):
+    """Build a gallery index by name ('exact' or 'ivf')"""
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown gallery index type: {kind}")
+    return INDEX_TYPES[kind](gallery, **options).build()
@@ -1,10 +1,17 @@
 import os
+import io
+import json
 import uuid
 import logging
-from flask import Flask, request, jsonify
+import time
+import threading
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from face_recognition import FaceRecognitionSystem
+from tracking import FaceTracker, TrackerSessions
+from inference_pool import InferencePool
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,6 +23,27 @@ CORS(app)
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
+MAX_BATCH_ITEMS = 64
+
+# Candidates a search may return (k)
+MAX_SEARCH_K = 100
+
+# /database pages: names per page by default and at most
+DATABASE_PAGE_SIZE = 100
+DATABASE_MAX_PAGE_SIZE = 1000
+
+# MTCNN/FaceNet worker processes; 0 runs inference in the request threads
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', '0'))
+
+# Load and warm the models at import time (before gunicorn --preload forks its workers)
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', '0') == '1'
+# Set by gunicorn.conf.py when preloading: the master only loads the models and
+# each forked worker warms them up (TensorFlow's thread pools do not survive a fork)
+WARM_UP_AFTER_FORK = os.environ.get('WARM_UP_AFTER_FORK', '0') == '1'
+
+# Poll the embedding store and hot-reload the gallery when a new generation is published
+WATCH_DATABASE = os.environ.get('WATCH_DATABASE', '0') == '1'
+DATABASE_WATCH_INTERVAL = float(os.environ.get('DATABASE_WATCH_INTERVAL', '5'))
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
@@ -26,31 +54,191 @@ os.makedirs('database/ids', exist_ok=True)
 
 # LAZY LOADING: Defer initialization of the face recognition system
 _face_recognition_system = None
+_inference_pool = None
+_init_lock = threading.Lock()
+
+# Face trackers of /recognize_stream sessions
+stream_sessions = TrackerSessions()
 
 def get_face_recognition_system():
     """Initializes and returns a singleton instance of the FaceRecognitionSystem."""
     global _face_recognition_system
-    if _face_recognition_system is None:
-        logger.info("Initializing Face Recognition System for the first time...")
-        _face_recognition_system = FaceRecognitionSystem()
-        logger.info("Face Recognition System initialized.")
+    with _init_lock:
+        if _face_recognition_system is None:
+            logger.info("Initializing Face Recognition System for the first time...")
+            _face_recognition_system = create_face_recognition_system()
+            logger.info("Face Recognition System initialized.")
     return _face_recognition_system
 
+def create_face_recognition_system(warm_up=True):
+    """Load the models and the gallery, then warm the models up (unless warm_up is False)"""
+    system = FaceRecognitionSystem(inference_pool=get_inference_pool())
+    if warm_up:
+        system.warm_up()
+    if WATCH_DATABASE:
+        system.watch_database(interval=DATABASE_WATCH_INTERVAL)
+    return system
+
+def preload_face_recognition_system(warm_up=True):
+    """Create the system at import time; with warm_up False, warm_up_models() finishes in each worker"""
+    global _face_recognition_system
+    with _init_lock:
+        if _face_recognition_system is None:
+            _face_recognition_system = create_face_recognition_system(warm_up=warm_up)
+    return _face_recognition_system
+
+def warm_up_models():
+    """Warm up the models of this process (gunicorn post_fork hook); /ready answers 200 once done"""
+    system = get_face_recognition_system()
+    with _init_lock:
+        if not system.warm:
+            system.warm_up()
+    return system
+
+def get_inference_pool():
+    """The shared inference worker pool, or None when INFERENCE_WORKERS is 0"""
+    global _inference_pool
+    if _inference_pool is None and INFERENCE_WORKERS > 0:
+        _inference_pool = InferencePool(INFERENCE_WORKERS)
+    return _inference_pool
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+@app.after_request
+def finish_request_metrics(response):
+    if 'metrics_start' not in g:
+        return response
+    endpoint, start = g.metrics_endpoint, g.metrics_start
+    labels = (endpoint, request.method, response.status_code)
+
+    # Called once the response (streamed or not) has been sent
+    def record():
+        metrics.REQUESTS_IN_FLIGHT.labels(endpoint).dec()
+        metrics.REQUEST_SECONDS.labels(*labels).observe(time.perf_counter() - start)
+
+    response.call_on_close(record)
+    return response
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def int_param(name, default=None, maximum=None):
+    """A positive integer request parameter; ValueError (a 400) if it is anything else"""
+    value = request.values.get(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a positive integer')
+    if value < 1:
+        raise ValueError(f'{name} must be a positive integer')
+    if maximum is not None and value > maximum:
+        raise ValueError(f'{name} must be at most {maximum}')
+    return value
+
+def fraction_param(name, default=None):
+    """A request parameter between 0 and 1; ValueError (a 400) if it is anything else"""
+    value = request.values.get(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a number between 0 and 1')
+    if not 0.0 <= value <= 1.0:
+        raise ValueError(f'{name} must be a number between 0 and 1')
+    return value
+
+def search_params():
+    """Read the optional k and nprobe search parameters of a request"""
+    k = int_param('k', 1, maximum=MAX_SEARCH_K)
+    # Optional recall/latency knob for approximate gallery indexes
+    nprobe = int_param('nprobe')
+    return k, nprobe
+
+def match_result(candidates):
+    """Best match under the threshold plus the top-k candidates, as returned by /recognize"""
+    best_match_name = "Unknown"
+    min_distance = None
+    # A search can find nothing, e.g. when the IVF cells it probes hold only evicted templates
+    if not candidates:
+        return {'name': best_match_name, 'distance': min_distance, 'candidates': []}
+
+    name, distance, is_match = candidates[0]
+    if is_match:
+        best_match_name = name
+        min_distance = float(distance)
+
+    return {
+        'name': best_match_name,
+        'distance': min_distance,
+        'candidates': [
+            {'name': name, 'distance': float(distance), 'match': bool(is_match)}
+            for name, distance, is_match in candidates
+        ]
+    }
+
+def uploaded_files(field):
+    """Files of a multi-file field, plus a per-item error for each unusable one"""
+    files = request.files.getlist(field)
+    errors = []
+    for file in files:
+        if file.filename == '':
+            errors.append('No file selected')
+        elif not allowed_file(file.filename):
+            errors.append('Invalid file type. Please upload PNG, JPG, or JPEG')
+        else:
+            errors.append(None)
+    return files, errors
+
+def gallery_etag(snapshot):
+    """ETag of a gallery snapshot; versions only identify a gallery within one process"""
+    return f"{os.getpid()}-{snapshot.version}"
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
-    system = get_face_recognition_system()
+    """Liveness probe: constant time whatever the gallery size; never triggers model loading"""
+    system = _face_recognition_system
+    if system is None:
+        return jsonify({'status': 'healthy', 'models_loaded': False})
+
+    snapshot = system.versions.current
     return jsonify({
         'status': 'healthy',
-        'database_size': len(system.id_embeddings),
+        'models_loaded': True,
+        'database_size': len(snapshot.gallery),
+        'gallery_version': snapshot.version,
         'threshold': system.threshold,
-        'registered_faces': list(system.id_embeddings.keys())
+        'embedding_cache': system.embedding_cache.stats(),
+        'in_flight': system.in_flight.stats(),
+        'inference_pool': system.inference_pool.stats() if system.inference_pool else None
     })
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once the models are loaded and warmed up, 503 before. Loads nothing."""
+    system = _face_recognition_system
+    ready = system is not None and system.warm
+    return jsonify({
+        'ready': ready,
+        'models_loaded': system is not None,
+        'warm': bool(system is not None and system.warm)
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics of this server process; never triggers model loading"""
+    system = _face_recognition_system
+    if system is not None:
+        metrics.update_system_metrics(system)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/register', methods=['POST'])
 def register_face():
     """Endpoint to register a new face."""
@@ -69,20 +257,19 @@ def register_face():
 
         # Extract face and create embedding
         system = get_face_recognition_system()
-        face = system.extract_face(file)
-        if face is None:
-            return jsonify({'error': 'No face could be detected in the image.'}), 400
-            
-        embedding = system.get_embedding(face)
+        embedding, _, detection = system.embed_image(file, detector=system.detector_modes['register'])
+        if embedding is None:
+            return jsonify({'error': 'No face could be detected in the image.', 'detector': detection}), 400
 
-        # Add to in-memory database
-        system.id_embeddings[name] = embedding
-        logger.info(f"Registered new face: {name}")
+        # Append to the registration journal and the in-memory database
+        system.register_identity(name, embedding)
+        templates = len(system.gallery.templates(name))
+        logger.info(f"Registered new face: {name} ({templates} templates)")
 
-        # Save the updated database to file
-        system.save_database()
-
-        return jsonify({'success': True, 'name': name, 'message': 'Face registered successfully.'})
+        return jsonify({
+            'success': True, 'name': name, 'templates': templates, 'detector': detection,
+            'message': 'Face registered successfully.'
+        })
 
     except ValueError as ve:
         logger.error(f"Registration error: {str(ve)}")
@@ -108,13 +295,15 @@ def verify_face():
             return jsonify({'error': 'Invalid file type. Please upload PNG, JPG, or JPEG'}), 400
 
         system = get_face_recognition_system()
+        detector = system.detector_modes['verify']
         # Process first image
-        face1 = system.extract_face(file1)
-        emb1 = system.get_embedding(face1)
+        emb1, _, detection1 = system.embed_image(file1, detector=detector)
 
         # Process second image
-        face2 = system.extract_face(file2)
-        emb2 = system.get_embedding(face2)
+        emb2, _, detection2 = system.embed_image(file2, detector=detector)
+
+        if emb1 is None or emb2 is None:
+            raise ValueError('No face could be detected in the image.')
 
         # Compare embeddings
         is_match, distance = system.compare_embeddings(emb1, emb2)
@@ -132,7 +321,8 @@ def verify_face():
         return jsonify({
             'verified': bool(is_match),
             'distance': float(distance),
-            'similarity': float(similarity_score)
+            'similarity': float(similarity_score),
+            'detectors': [detection1, detection2]
         })
 
     except ValueError as ve:
@@ -156,31 +346,26 @@ def recognize_face():
         
         if not allowed_file(file.filename):
             return jsonify({'error': 'Invalid file type. Please upload PNG, JPG, or JPEG'}), 400
+
+        k, nprobe = search_params()
         
         system = get_face_recognition_system()
-        face = system.extract_face(file)
-        if face is None:
-            return jsonify({'error': 'No face could be detected in the image.'}), 400
+        if request.values.get('mode', 'single') == 'crowd':
+            return recognize_crowd(system, file, k, nprobe)
 
-        embedding = system.get_embedding(face)
+        embedding, _, detection = system.embed_image(file, detector=system.detector_modes['recognize'])
+        if embedding is None:
+            return jsonify({'error': 'No face could be detected in the image.', 'detector': detection}), 400
 
         if not system.id_embeddings:
-            return jsonify({'name': 'Unknown', 'distance': None, 'error': 'No IDs have been registered in the database.'})
+            return jsonify({
+                'name': 'Unknown', 'distance': None, 'detector': detection,
+                'error': 'No IDs have been registered in the database.'
+            })
 
-        # Find the best match in the database
-        best_match_name = "Unknown"
-        min_distance = float('inf')
-
-        for name, id_emb in system.id_embeddings.items():
-            is_match, distance = system.compare_embeddings(embedding, id_emb)
-            if is_match and distance < min_distance:
-                min_distance = distance
-                best_match_name = name
-
-        return jsonify({
-            'name': best_match_name,
-            'distance': float(min_distance) if min_distance != float('inf') else None
-        })
+        # Find the top-k matches through the gallery index
+        candidates = system.search_gallery(embedding, k=k, nprobe=nprobe)
+        return jsonify({**match_result(candidates), 'detector': detection})
 
     except ValueError as ve:
         logger.error(f"Recognition error: {str(ve)}")
@@ -189,29 +374,269 @@ def recognize_face():
         logger.error(f"Recognition endpoint error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def recognize_crowd(system, file, k, nprobe):
+    """/recognize with mode=crowd: match every face in the image above a confidence floor"""
+    min_confidence = fraction_param('min_confidence', 0.9)
+    faces = system.embed_faces(file, min_confidence=min_confidence)
+    if not faces:
+        return jsonify({'error': 'No face could be detected in the image.'}), 400
+
+    if not system.id_embeddings:
+        return jsonify({'faces': [], 'error': 'No IDs have been registered in the database.'})
+
+    # One batched FaceNet call already ran; match all faces in one matrix operation
+    matches = system.search_gallery_batch([embedding for embedding, _, _ in faces], k=k, nprobe=nprobe)
+    results = []
+    for (_, box, confidence), candidates in zip(faces, matches):
+        results.append({'box': box, 'confidence': confidence, **match_result(candidates)})
+
+    return jsonify({'count': len(results), 'faces': results})
+
+@app.route('/recognize_batch', methods=['POST'])
+def recognize_batch():
+    """Recognize many images (multipart field 'images') in one request"""
+    try:
+        files, errors = uploaded_files('images')
+        if not files:
+            return jsonify({'error': 'No image files provided'}), 400
+        if len(files) > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'At most {MAX_BATCH_ITEMS} images per batch'}), 400
+
+        k, nprobe = search_params()
+
+        system = get_face_recognition_system()
+        valid = [i for i, error in enumerate(errors) if error is None]
+        embeddings, extract_errors, detections = system.embed_images(
+            [files[i] for i in valid], detector=system.detector_modes['recognize']
+        )
+        for i, error in zip(valid, extract_errors):
+            errors[i] = error
+
+        # Match every detected face against the gallery in one matrix operation
+        results = [{'index': i, 'filename': file.filename} for i, file in enumerate(files)]
+        for i, detection in zip(valid, detections):
+            if detection is not None:
+                results[i]['detector'] = detection
+        embedded = [(i, embedding) for i, embedding in zip(valid, embeddings) if embedding is not None]
+        if embedded and not system.id_embeddings:
+            for i, _ in embedded:
+                errors[i] = 'No IDs have been registered in the database.'
+        elif embedded:
+            matches = system.search_gallery_batch([embedding for _, embedding in embedded], k=k, nprobe=nprobe)
+            for (i, _), candidates in zip(embedded, matches):
+                results[i].update(match_result(candidates))
+
+        for result, error in zip(results, errors):
+            if error is not None:
+                result['error'] = error
+
+        return jsonify({'results': results})
+
+    except ValueError as ve:
+        logger.error(f"Batch recognition error: {str(ve)}")
+        return jsonify({'error': str(ve)}), 400
+    except Exception as e:
+        logger.error(f"Batch recognition endpoint error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/verify_batch', methods=['POST'])
+def verify_batch():
+    """
+    Verify many image pairs in one request. 'file1' and 'file2' are paired in
+    order; a single 'file1' is compared against every 'file2'.
+    """
+    try:
+        files1, errors1 = uploaded_files('file1')
+        files2, errors2 = uploaded_files('file2')
+        if not files1 or not files2:
+            return jsonify({'error': 'Both file1 and file2 images are required'}), 400
+        if len(files1) == 1 and len(files2) > 1:
+            files1, errors1 = files1 * len(files2), errors1 * len(files2)
+        if len(files1) != len(files2):
+            return jsonify({'error': 'file1 and file2 must contain the same number of images'}), 400
+        if len(files2) > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'At most {MAX_BATCH_ITEMS} pairs per batch'}), 400
+
+        # Every distinct upload is detected and embedded once, in one FaceNet call
+        unique_files = []
+        slots = {}
+        for file, error in zip(files1 + files2, errors1 + errors2):
+            if error is None and id(file) not in slots:
+                slots[id(file)] = len(unique_files)
+                unique_files.append(file)
+
+        system = get_face_recognition_system()
+        embeddings, extract_errors, detections = system.embed_images(
+            unique_files, detector=system.detector_modes['verify']
+        )
+
+        def lookup(file, error):
+            if error is not None:
+                return None, error, None
+            slot = slots[id(file)]
+            return embeddings[slot], extract_errors[slot], detections[slot]
+
+        results = []
+        pairs = []
+        for i, (file1, error1, file2, error2) in enumerate(zip(files1, errors1, files2, errors2)):
+            result = {'index': i, 'file1': file1.filename, 'file2': file2.filename}
+            emb1, error1, detection1 = lookup(file1, error1)
+            emb2, error2, detection2 = lookup(file2, error2)
+            result['detectors'] = [detection1, detection2]
+            if error1 or error2:
+                result['error'] = f"file1: {error1}" if error1 else f"file2: {error2}"
+            else:
+                pairs.append((i, emb1, emb2))
+            results.append(result)
+
+        if pairs:
+            is_match, distances = system.compare_embeddings_batch(
+                [emb1 for _, emb1, _ in pairs], [emb2 for _, _, emb2 in pairs]
+            )
+            for (i, _, _), matched, distance in zip(pairs, is_match, distances):
+                similarity_score = max(0, (system.threshold - distance) / system.threshold) * 100
+                results[i].update({
+                    'verified': bool(matched),
+                    'distance': float(distance),
+                    'similarity': float(similarity_score)
+                })
+
+        return jsonify({'results': results})
+
+    except ValueError as ve:
+        logger.error(f"Batch verification error: {str(ve)}")
+        return jsonify({'error': str(ve)}), 400
+    except Exception as e:
+        logger.error(f"Batch verification endpoint error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/recognize_stream', methods=['POST'])
+def recognize_stream():
+    """
+    Recognize a sequence of video frames (multipart field 'frames', in order)
+    with face tracking. Detection re-runs every 'detect_every' frames or when a
+    track is lost, and each track is embedded only when it first appears or
+    is seen at clearly better quality. Send the same 'session' id with later
+    chunks to keep following the same tracks. Results are streamed back as
+    one JSON line per frame.
+    """
+    try:
+        frames, errors = uploaded_files('frames')
+        if not frames:
+            return jsonify({'error': 'No frames provided'}), 400
+        if len(frames) > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'At most {MAX_BATCH_ITEMS} frames per request'}), 400
+
+        detect_every = int_param('detect_every', 10)
+        min_confidence = fraction_param('min_confidence', 0.9)
+
+        system = get_face_recognition_system()
+
+        def new_tracker():
+            return FaceTracker(system, detect_every=detect_every, min_confidence=min_confidence)
+
+        session_id = request.values.get('session')
+        tracker = stream_sessions.get(session_id, new_tracker) if session_id else new_tracker()
+
+        # Uploaded files are closed once the streamed response starts
+        frames = [io.BytesIO(frame.read()) if error is None else None for frame, error in zip(frames, errors)]
+
+    except ValueError as ve:
+        logger.error(f"Stream recognition error: {str(ve)}")
+        return jsonify({'error': str(ve)}), 400
+    except Exception as e:
+        logger.error(f"Stream recognition endpoint error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    def generate():
+        with tracker.lock:
+            for i, (frame, error) in enumerate(zip(frames, errors)):
+                if error is None:
+                    try:
+                        result = tracker.process(frame)
+                    except Exception as e:
+                        logger.error(f"Stream frame error: {str(e)}")
+                        result = {'error': f'Could not process frame: {e}'}
+                else:
+                    result = {'error': error}
+                result['index'] = i
+                yield json.dumps(result) + '\n'
+
+            yield json.dumps({'summary': tracker.stats(), 'session': session_id}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/database', methods=['GET'])
 def get_database_info():
-    """Get information about the ID database"""
+    """
+    One page of registered IDs in name order. Query parameters: prefix,
+    cursor (next_cursor of the previous page) and limit. The ETag follows
+    the gallery version, so an unchanged gallery answers If-None-Match
+    with 304.
+    """
+    try:
+        limit = int_param('limit', DATABASE_PAGE_SIZE, maximum=DATABASE_MAX_PAGE_SIZE)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+
     system = get_face_recognition_system()
-    return jsonify({
-        'total_ids': len(system.id_embeddings),
-        'id_names': list(system.id_embeddings.keys()),
-        'threshold': system.threshold
-    })
+    snapshot = system.versions.current
+    etag = gallery_etag(snapshot)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        names, more = snapshot.gallery.list_identities(
+            prefix=request.args.get('prefix', ''),
+            after=request.args.get('cursor') or None,
+            limit=limit
+        )
+        response = jsonify({
+            'total_ids': len(snapshot.gallery),
+            'id_names': names,
+            'next_cursor': names[-1] if more else None,
+            'gallery_version': snapshot.version,
+            'threshold': system.threshold
+        })
+
+    response.set_etag(etag)
+    response.headers['X-Gallery-Version'] = str(snapshot.version)
+    return response
 
 @app.route('/reload_database', methods=['POST'])
 def reload_database():
-    """Reload the ID database"""
+    """
+    Reload the ID database. The new gallery is built while requests keep being
+    served from the current one, then swapped in; the models are not reloaded.
+    """
     try:
-        global _face_recognition_system
-        _face_recognition_system = FaceRecognitionSystem()
+        system = get_face_recognition_system()
+        count = system.load_database()
+        return jsonify({
+            'success': True,
+            'message': f'Database reloaded with {count} IDs',
+            'version': system.database_version
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/compact_database', methods=['POST'])
+def compact_database():
+    """Fold the registration journal into the binary embedding store"""
+    try:
+        system = get_face_recognition_system()
+        compacted = system.compact_database()
         return jsonify({
             'success': True,
-            'message': f'Database reloaded with {len(_face_recognition_system.id_embeddings)} IDs'
+            'message': f'Compacted {compacted} journaled registrations'
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Spawned inference workers re-import the main module as __mp_main__
+if PRELOAD_MODELS and __name__ != '__mp_main__':
+    logger.info("Preloading models before serving requests...")
+    preload_face_recognition_system(warm_up=not WARM_UP_AFTER_FORK)
+
 if __name__ == '__main__':
     logger.info("Starting Face Recognition API Server in debug mode...")
     # In debug mode, we don't lazy load so that we can see initialization errors immediately.
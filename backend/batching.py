@@ -0,0 +1,123 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching for model inference.
+
+    Callers on any thread submit single items and block until their result is
+    ready. One scheduler thread gathers queued items into a batch, bounded by
+    max_batch_size and by max_wait_ms after the first item arrived, runs
+    process_batch once on the whole list and hands each caller its own
+    result. Items that arrive while a batch is running are picked up by the
+    next one, so batches grow with load without delaying a lone request by
+    more than max_wait_ms.
+    """
+
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=2, name="micro-batcher"):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"{self.name} is closed")
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit_async(self, item):
+        """Queue one item and return a Future for its result"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit(self, item):
+        """Queue one item and block until its result is ready"""
+        return self.submit_async(item).result()
+
+    def submit_many(self, items):
+        """Queue several items (they may share a batch with other callers) and wait for all"""
+        futures = [self.submit_async(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = self._collect(first)
+            stop = False
+            if any(entry is None for entry in batch):
+                stop = True
+                batch = [entry for entry in batch if entry is not None]
+
+            if batch:
+                self._dispatch(batch)
+            if stop:
+                return
+
+    def _dispatch(self, batch):
+        # Items whose caller cancelled the future while it was queued are skipped
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            results = list(self.process_batch(items))
+            if len(results) != len(items):
+                # A caller without a result would wait forever
+                raise RuntimeError(f"{self.name}: got {len(results)} results for a batch of {len(items)}")
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        except Exception as e:
+            logger.error(f"{self.name}: batch of {len(items)} failed: {e}")
+            for future in futures:
+                # Callers whose result was already set keep it
+                if not future.done():
+                    future.set_exception(e)
+
+        self.batches += 1
+        self.items += len(items)
+
+    def close(self):
+        """Finish queued work and stop the scheduler thread"""
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
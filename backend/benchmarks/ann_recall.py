@@ -0,0 +1,118 @@
+"""
+Recall and latency of the IVF gallery index against exact search.
+
+Run from the backend directory:
+
+    python -m benchmarks.ann_recall --size 1000000 --nprobe 1,4,16,64
+    python -m benchmarks.ann_recall --store      # use database/ instead of synthetic data
+"""
+import json
+import time
+import argparse
+import numpy as np
+from numpy.linalg import norm
+from gallery import Gallery, ensure_normalized
+from ann_index import ExactIndex, IVFIndex
+from embedding_store import EmbeddingStore
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes
+
+
+def compare_embeddings_loop(gallery, embedding, threshold):
+    """The original /recognize loop over compare_embeddings, used as ground truth"""
+    best_match_name, min_distance = "Unknown", float('inf')
+    for name in gallery.names:
+        distance = norm(ensure_normalized(embedding) - ensure_normalized(gallery[name]))
+        if distance < threshold and distance < min_distance:
+            min_distance, best_match_name = distance, name
+    return best_match_name, min_distance
+
+
+def timed_search(index, probes, k, nprobe=None):
+    results, latencies = [], []
+    for probe in probes:
+        start = time.perf_counter()
+        results.append(index.search(probe, k, nprobe=nprobe))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def latency_summary(latencies):
+    return {
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100000, help='synthetic gallery size')
+    parser.add_argument('--dimension', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', default='1,2,4,8,16,32,64')
+    parser.add_argument('--threshold', type=float, default=0.97)
+    parser.add_argument('--loop-checks', type=int, default=5,
+                        help='queries also checked against the compare_embeddings loop')
+    parser.add_argument('--store', action='store_true', help='benchmark the gallery in database/')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    if args.store:
+        names, matrix, _ = EmbeddingStore("database").load()
+    else:
+        names, matrix = synthetic_gallery(args.size, args.dimension)
+    gallery = Gallery.from_matrix(names, matrix)
+    probes = synthetic_probes(gallery.matrix, args.queries)
+
+    exact = ExactIndex(gallery)
+    truth, exact_latencies = timed_search(exact, probes, args.k)
+
+    # The exact index must reproduce the original per-ID loop
+    for probe, expected in list(zip(probes, truth))[:args.loop_checks]:
+        name, distance = compare_embeddings_loop(gallery, probe, args.threshold)
+        if name != "Unknown" and (expected[0][0], expected[0][1]) != (name, distance):
+            raise AssertionError(f"Exact index disagrees with compare_embeddings: {expected[0]} != {(name, distance)}")
+
+    start = time.perf_counter()
+    ivf = IVFIndex(gallery, nlist=args.nlist, min_train_size=1).build()
+    build_seconds = time.perf_counter() - start
+
+    report = {
+        'gallery_size': len(gallery),
+        'dimension': int(gallery.matrix.shape[1]),
+        'queries': len(probes),
+        'k': args.k,
+        'nlist': len(ivf._lists),
+        'build_seconds': build_seconds,
+        'exact': latency_summary(exact_latencies),
+        'ivf': []
+    }
+
+    for nprobe in [int(value) for value in args.nprobe.split(',')]:
+        results, latencies = timed_search(ivf, probes, args.k, nprobe=nprobe)
+        top1 = np.mean([bool(r) and r[0][0] == t[0][0] for r, t in zip(results, truth)])
+        recall = np.mean([
+            len({name for name, _ in r} & {name for name, _ in t}) / len(t)
+            for r, t in zip(results, truth)
+        ])
+        distances_match = all(
+            r[0][1] == t[0][1] for r, t in zip(results, truth) if r and r[0][0] == t[0][0]
+        )
+        report['ivf'].append({
+            'nprobe': nprobe,
+            'recall_at_1': float(top1),
+            f'recall_at_{args.k}': float(recall),
+            'distances_match_exact': distances_match,
+            **latency_summary(latencies)
+        })
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Parity and throughput of the FaceNet embedder backends (see embedders.py).
+
+Every backend embeds the same face crops. The first backend (normally
+keras) is the reference: for each other backend the report gives the
+distance between its embeddings and the reference ones, how much the
+pairwise face distances that matching relies on move, and how often a
+match decision at the threshold flips. Throughput is measured at each
+batch size.
+
+Run from the backend directory, after `python embedders.py export`:
+
+    python -m benchmarks.embedder_report --backends keras,onnx,onnx:models/facenet.int8.onnx
+    python -m benchmarks.embedder_report --backends keras,tflite:models/facenet.int8.tflite --batch-sizes 1,8,64
+"""
+import os
+import json
+import platform
+import argparse
+import numpy as np
+from numpy.linalg import norm
+from embedders import create_embedder, load_faces
+from benchmarks.stages import measure
+
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+
+
+def parse_backend(spec):
+    """'kind' or 'kind:model_path'"""
+    kind, _, model_path = spec.partition(":")
+    return kind, model_path or None
+
+
+def normalized(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    return embeddings / norm(embeddings, axis=1, keepdims=True)
+
+
+def pairwise_distances(embeddings):
+    return norm(embeddings[:, None, :] - embeddings[None, :, :], axis=2)
+
+
+def parity_report(embeddings, reference, threshold):
+    """How far a backend's embeddings and match decisions are from the reference backend's"""
+    deltas = norm(embeddings - reference, axis=1)
+    distances, reference_distances = pairwise_distances(embeddings), pairwise_distances(reference)
+    upper = np.triu_indices(len(reference), k=1)
+    pair_deltas = np.abs(distances[upper] - reference_distances[upper])
+    agreement = (distances[upper] < threshold) == (reference_distances[upper] < threshold)
+
+    np.fill_diagonal(distances, np.inf)
+    np.fill_diagonal(reference_distances, np.inf)
+    return {
+        'mean_embedding_distance': float(deltas.mean()),
+        'max_embedding_distance': float(deltas.max()),
+        'mean_pair_distance_delta': float(pair_deltas.mean()) if pair_deltas.size else 0.0,
+        'max_pair_distance_delta': float(pair_deltas.max()) if pair_deltas.size else 0.0,
+        'match_decision_agreement': float(agreement.mean()) if agreement.size else 1.0,
+        'nearest_face_agreement': float(np.mean(distances.argmin(axis=1) == reference_distances.argmin(axis=1)))
+    }
+
+
+def throughput_report(embedder, faces, batch_sizes, iterations):
+    results = []
+    for batch_size in batch_sizes:
+        batch = [faces[i % len(faces)] for i in range(batch_size)]
+        stats = measure(lambda: embedder.embeddings(batch), iterations)
+        results.append({
+            'batch_size': batch_size,
+            **stats,
+            'per_face_ms': stats['mean_ms'] / batch_size,
+            'faces_per_second': batch_size * 1000.0 / stats['mean_ms']
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='keras,onnx',
+                        help='comma-separated kind[:model_path]; the first one is the parity reference')
+    parser.add_argument('--faces', default='database/ids', help='ID photos whose faces are embedded')
+    parser.add_argument('--count', type=int, default=64, help='faces used for the parity check')
+    parser.add_argument('--synthetic', action='store_true', help='random crops instead of detected faces')
+    parser.add_argument('--batch-sizes', default=','.join(str(size) for size in BATCH_SIZES))
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.97, help='match threshold for the decision agreement')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    if args.synthetic or not os.path.isdir(args.faces):
+        rng = np.random.default_rng(0)
+        faces = list(rng.integers(0, 255, (args.count, 160, 160, 3), dtype=np.uint8))
+    else:
+        faces = load_faces(args.faces, args.count)
+    if not faces:
+        parser.error(f"no faces found in {args.faces} (use --synthetic)")
+
+    report = {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'faces': len(faces),
+        'synthetic_faces': bool(args.synthetic or not os.path.isdir(args.faces)),
+        'backends': []
+    }
+
+    reference = None
+    for spec in args.backends.split(','):
+        kind, model_path = parse_backend(spec)
+        embedder = create_embedder(kind, model_path)
+        embeddings = normalized(embedder.embeddings(faces))
+        if reference is None:
+            reference = embeddings
+
+        report['backends'].append({
+            'backend': embedder.name,
+            'info': getattr(embedder, 'info', None),
+            'parity': parity_report(embeddings, reference, args.threshold),
+            'throughput': throughput_report(
+                embedder, faces, [int(size) for size in args.batch_sizes.split(',')], args.iterations
+            )
+        })
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
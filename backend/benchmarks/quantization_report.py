@@ -0,0 +1,118 @@
+"""
+Memory, latency and accuracy of quantized gallery scans (float16, int8)
+against the float32 scan and the compare_embeddings distances.
+
+Run from the backend directory:
+
+    python -m benchmarks.quantization_report --size 1000000
+    python -m benchmarks.quantization_report --store      # use database/ instead of synthetic data
+"""
+import json
+import time
+import argparse
+import numpy as np
+from numpy.linalg import norm
+from gallery import Gallery, ensure_normalized
+from embedding_store import EmbeddingStore
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes
+from benchmarks.ann_recall import latency_summary
+
+KINDS = ("float32", "float16", "int8")
+
+
+def first_pass_report(gallery, probes, exact_rows, k):
+    """How far the first-pass distances are from compare_embeddings, and how big the shortlist gets"""
+    deltas, shortlists, top1 = [], [], []
+    for probe, exact_distances in zip(probes, exact_rows):
+        probe = ensure_normalized(np.asarray(probe, dtype=np.float64))
+        sq_distances, margin = gallery.approximate_sq_distances(probe)
+        approximate = np.sqrt(np.maximum(sq_distances, 0.0))
+        deltas.append(np.abs(approximate - exact_distances))
+
+        kth = np.partition(sq_distances, min(k, len(sq_distances)) - 1)[min(k, len(sq_distances)) - 1]
+        shortlists.append(int(np.count_nonzero(sq_distances <= kth + margin)))
+        top1.append(int(np.argmin(sq_distances)) == int(np.argmin(exact_distances)))
+
+    deltas = np.concatenate(deltas)
+    return {
+        'mean_abs_distance_delta': float(deltas.mean()),
+        'max_abs_distance_delta': float(deltas.max()),
+        'first_pass_top1_agreement': float(np.mean(top1)),
+        'mean_shortlist': float(np.mean(shortlists)),
+        'max_shortlist': int(np.max(shortlists))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100000, help='synthetic gallery size')
+    parser.add_argument('--dimension', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--accuracy-queries', type=int, default=10,
+                        help='queries whose distances to every ID are compared with compare_embeddings')
+    parser.add_argument('--store', action='store_true', help='benchmark the gallery in database/')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    if args.store:
+        names, matrix, _ = EmbeddingStore("database").load()
+    else:
+        names, matrix = synthetic_gallery(args.size, args.dimension)
+    probes = synthetic_probes(np.asarray(matrix), args.queries)
+
+    # compare_embeddings distances from a few probes to every ID: the accuracy reference
+    reference = Gallery.from_matrix(names, matrix)
+    exact_rows = []
+    for probe in probes[:args.accuracy_queries]:
+        probe = ensure_normalized(np.asarray(probe, dtype=np.float64))
+        rows = np.asarray(reference.matrix, dtype=np.float64)
+        rows = rows / norm(rows, axis=1, keepdims=True)
+        exact_rows.append(norm(rows - probe, axis=1))
+
+    report = {
+        'gallery_size': len(names),
+        'dimension': int(matrix.shape[1]),
+        'queries': len(probes),
+        'k': args.k,
+        'kinds': []
+    }
+
+    truth = None
+    for kind in KINDS:
+        gallery = Gallery.from_matrix(names, matrix)
+        start = time.perf_counter()
+        gallery.quantize(kind)
+        quantize_seconds = time.perf_counter() - start
+
+        results, latencies = [], []
+        for probe in probes:
+            start = time.perf_counter()
+            results.append(gallery.search(probe, args.k))
+            latencies.append((time.perf_counter() - start) * 1000)
+        if truth is None:
+            truth = results
+
+        start = time.perf_counter()
+        gallery.search_batch(list(probes), args.k)
+        batch_ms = (time.perf_counter() - start) * 1000 / len(probes)
+
+        report['kinds'].append({
+            'kind': kind,
+            'scan_bytes': int(gallery.scan_nbytes),
+            'memory_saved_bytes': int(reference.scan_nbytes - gallery.scan_nbytes),
+            'quantize_seconds': quantize_seconds,
+            'results_identical_to_float32': all(r == t for r, t in zip(results, truth)),
+            **first_pass_report(gallery, probes[:args.accuracy_queries], exact_rows, args.k),
+            **latency_summary(np.array(latencies)),
+            'batch_mean_ms': batch_ms
+        })
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Search latency of a sharded gallery (see shards.py) against shard count.
+
+Writes a synthetic gallery to a scratch embedding store, then for each shard
+count starts that many local shard processes over it and times single-probe
+and batched searches through ShardedGallery, next to the in-process exact
+index. Every sharded result is checked against the in-process one. Shards
+scan in parallel, so latency should fall with the shard count until it
+reaches the number of cores (or memory bandwidth) of the machine.
+
+Run from the backend directory:
+
+    python -m benchmarks.shard_scaling --size 1000000 --shards 1,2,4,8
+"""
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+from gallery import Gallery
+from ann_index import ExactIndex
+from embedding_store import EmbeddingStore
+from shards import start_local_shards
+from benchmarks.ann_recall import latency_summary
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes
+
+
+def timed(search, probes, batch_size):
+    results, latencies = [], []
+    for start in range(0, len(probes), batch_size):
+        batch = probes[start:start + batch_size]
+        began = time.perf_counter()
+        results.extend(search(batch))
+        latencies.append((time.perf_counter() - began) * 1000)
+    return results, np.array(latencies)
+
+
+def same_results(results, reference):
+    return sum(
+        [name for name, _ in got] == [name for name, _ in expected]
+        for got, expected in zip(results, reference)
+    ) / len(reference)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=200000, help='synthetic gallery size')
+    parser.add_argument('--dimension', type=int, default=512)
+    parser.add_argument('--shards', default='1,2,4', help='comma-separated shard counts')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=32, help='probes per batched search')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    names, matrix = synthetic_gallery(args.size, args.dimension)
+    probes = synthetic_probes(matrix, args.queries)
+    report = {
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'size': args.size,
+        'dimension': args.dimension,
+        'results': []
+    }
+
+    index = ExactIndex(Gallery.from_matrix(names, matrix))
+    single, single_latencies = timed(lambda batch: [index.search(batch[0], args.k)], probes, 1)
+    _, batch_latencies = timed(lambda batch: index.search_batch(batch, args.k), probes, args.batch_size)
+    report['results'].append({
+        'shards': 0,
+        'single': latency_summary(single_latencies),
+        'batch': latency_summary(batch_latencies)
+    })
+
+    # Shards load the store from database/ in their working directory
+    workdir = tempfile.mkdtemp(prefix="face-shards-")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        EmbeddingStore("database").save(names, matrix)
+        for count in [int(value) for value in args.shards.split(',')]:
+            began = time.perf_counter()
+            sharded = start_local_shards(count)
+            startup = time.perf_counter() - began
+            try:
+                # One untimed round trip to open the connections
+                sharded.search(probes[0], args.k)
+                results, single_latencies = timed(lambda batch: [sharded.search(batch[0], args.k)], probes, 1)
+                _, batch_latencies = timed(lambda batch: sharded.search_batch(batch, args.k), probes, args.batch_size)
+            finally:
+                sharded.close()
+
+            report['results'].append({
+                'shards': count,
+                'startup_seconds': startup,
+                'single': latency_summary(single_latencies),
+                'batch': latency_summary(batch_latencies),
+                'speedup': report['results'][0]['single']['mean_ms'] / latency_summary(single_latencies)['mean_ms'],
+                'same_results': same_results(results, single)
+            })
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Per-stage benchmarks of the recognition pipeline, runnable offline.
+
+Times image decoding, EXIF handling, detection, embedding, gallery matching
+and gallery persistence separately, then whole requests through the Flask
+test client. Images and galleries (1k to 1M IDs) are synthetic, and MTCNN
+and FaceNet are replaced by stubs unless --models real is given, so no
+network or model weights are needed. Results are written as JSON; pass
+--baseline to compare with an earlier run.
+
+Run from the backend directory:
+
+    python -m benchmarks.stages --output results.json
+    python -m benchmarks.stages --sizes 1000,10000,100000,1000000 --baseline results.json
+    python -m benchmarks.stages --stages match,persist
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image, ExifTags
+from gallery import Gallery
+from ann_index import create_index
+from embedding_store import EmbeddingStore, RegistrationJournal, export_store_to_json
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes, synthetic_image
+from benchmarks.stubs import StubDetector, StubEmbedder
+
+STAGES = ("decode", "exif", "detect", "extract", "embed", "match", "persist", "e2e")
+
+
+def measure(function, iterations, warmup=1):
+    """Call function repeatedly and summarize its latency in milliseconds"""
+    for _ in range(warmup):
+        function()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.array(latencies)
+    return {
+        'iterations': iterations,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'min_ms': float(latencies.min())
+    }
+
+
+def create_system(models):
+    """A FaceRecognitionSystem with stub (or real) models and an empty gallery"""
+    from face_recognition import FaceRecognitionSystem
+
+    if models == "real":
+        return FaceRecognitionSystem(load_database=False)
+    return FaceRecognitionSystem(load_database=False, detector=StubDetector(), embedder=StubEmbedder())
+
+
+def install_gallery(system, names, matrix):
+    system.build_index(Gallery.from_matrix(names, matrix))
+
+
+def original_exif_rotate(image):
+    """The EXIF handling of the original extract_face"""
+    try:
+        for orientation in ExifTags.TAGS.keys():
+            if ExifTags.TAGS[orientation] == 'Orientation':
+                break
+        exif = dict(image._getexif().items())
+        if exif[orientation] == 3:
+            image = image.rotate(180, expand=True)
+        elif exif[orientation] == 6:
+            image = image.rotate(270, expand=True)
+        elif exif[orientation] == 8:
+            image = image.rotate(90, expand=True)
+    except (AttributeError, KeyError, IndexError):
+        pass
+    return image
+
+
+def bench_images(system, images, iterations, results):
+    """decode, exif, detect and extract stages for each synthetic image size"""
+    for label, data in images.items():
+        def decode_full():
+            np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+
+        def decode_draft():
+            image = Image.open(io.BytesIO(data))
+            scale = system.detection_max_side / max(image.size)
+            if scale < 1:
+                image.draft('RGB', (round(image.size[0] * scale), round(image.size[1] * scale)))
+            np.asarray(image.convert('RGB'))
+
+        if 'decode' in results['selected']:
+            results['stages'].append({'stage': 'decode', 'variant': 'full', 'image': label, **measure(decode_full, iterations)})
+            results['stages'].append({'stage': 'decode', 'variant': 'draft', 'image': label, **measure(decode_draft, iterations)})
+
+        if 'exif' in results['selected']:
+            full = Image.open(io.BytesIO(data))
+            full.load()
+
+            def exif_original():
+                original_exif_rotate(full)
+
+            def exif_tag_only():
+                full.getexif().get(ExifTags.Base.Orientation, 1)
+
+            results['stages'].append({'stage': 'exif', 'variant': 'rotate_full', 'image': label, **measure(exif_original, iterations)})
+            results['stages'].append({'stage': 'exif', 'variant': 'read_tag', 'image': label, **measure(exif_tag_only, iterations)})
+
+        if 'detect' in results['selected']:
+            pixels = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+            results['stages'].append({
+                'stage': 'detect', 'variant': type(system.detector).__name__, 'image': label,
+                **measure(lambda: system.detector.detect_faces(pixels), iterations)
+            })
+            # Haar first pass ahead of the detector; on a photo without a face
+            # this is the overhead of the fallback to a full-frame run
+            for mode in ('cascade', 'haar'):
+                _, path = system.cascade.detect(pixels, mode)
+                results['stages'].append({
+                    'stage': 'detect', 'variant': mode, 'path': path, 'image': label,
+                    **measure(lambda: system.cascade.detect(pixels, mode), iterations)
+                })
+
+        if 'extract' in results['selected']:
+            for fast in (False, True):
+                system.fast_decode = fast
+                results['stages'].append({
+                    'stage': 'extract', 'variant': 'fast' if fast else 'full', 'image': label,
+                    **measure(lambda: system.extract_face_and_box(io.BytesIO(data), system.required_size), iterations)
+                })
+            system.fast_decode = True
+
+
+def bench_embed(system, iterations, batch_sizes, results):
+    rng = np.random.default_rng(0)
+    for batch_size in batch_sizes:
+        faces = rng.integers(0, 255, (batch_size, *system.required_size, 3), dtype=np.uint8)
+        stats = measure(lambda: system.get_embeddings(list(faces)), iterations)
+        stats['per_face_ms'] = stats['mean_ms'] / batch_size
+        results['stages'].append({
+            'stage': 'embed', 'variant': type(system.embedder).__name__, 'batch_size': batch_size, **stats
+        })
+
+
+def bench_match(system, sizes, queries, loop_max, results):
+    for size in sizes:
+        names, matrix = synthetic_gallery(size)
+        probes = synthetic_probes(matrix, queries)
+        gallery = Gallery.from_matrix(names, matrix)
+        iterator = iter(np.tile(np.arange(len(probes)), 1000))
+
+        if size <= loop_max:
+            # The original /recognize loop: compare_embeddings against every ID
+            def loop():
+                probe = probes[next(iterator)]
+                best, best_distance = "Unknown", float('inf')
+                for name in gallery.names:
+                    is_match, distance = system.compare_embeddings(probe, gallery[name])
+                    if is_match and distance < best_distance:
+                        best, best_distance = name, distance
+            results['stages'].append({'stage': 'match', 'variant': 'compare_loop', 'gallery_size': size,
+                                      **measure(loop, min(queries, 10))})
+
+        results['stages'].append({'stage': 'match', 'variant': 'exact', 'gallery_size': size,
+                                  **measure(lambda: gallery.search(probes[next(iterator)], 1), queries)})
+
+        stats = measure(lambda: gallery.search_batch(list(probes), 1), 3)
+        stats['per_query_ms'] = stats['mean_ms'] / len(probes)
+        results['stages'].append({'stage': 'match', 'variant': 'exact_batch', 'gallery_size': size, **stats})
+
+        if size >= 10000:
+            ivf = create_index("ivf", gallery, min_train_size=1)
+            results['stages'].append({'stage': 'match', 'variant': 'ivf', 'gallery_size': size,
+                                      **measure(lambda: ivf.search(probes[next(iterator)], 1), queries)})
+
+
+def bench_persist(system, sizes, json_max, results):
+    for size in sizes:
+        names, matrix = synthetic_gallery(size)
+        store = EmbeddingStore("database")
+
+        stats = measure(lambda: store.save(names, matrix), 3)
+        results['stages'].append({'stage': 'persist', 'variant': 'store_save', 'gallery_size': size, **stats})
+        stats = measure(lambda: Gallery.from_matrix(*store.load()[:2]).search(matrix[0]), 5)
+        results['stages'].append({'stage': 'persist', 'variant': 'store_load_and_search', 'gallery_size': size, **stats})
+
+        if size <= json_max:
+            json_file = "database/embeddings.json"
+            stats = measure(lambda: export_store_to_json(json_file, store), 1, warmup=0)
+            results['stages'].append({'stage': 'persist', 'variant': 'json_save', 'gallery_size': size,
+                                      'bytes': os.path.getsize(json_file), **stats})
+            stats = measure(system.load_json_database, 1, warmup=0)
+            results['stages'].append({'stage': 'persist', 'variant': 'json_load', 'gallery_size': size, **stats})
+            os.remove(json_file)
+
+    journal = RegistrationJournal("database/embeddings.journal")
+    row = synthetic_gallery(1)[1][0]
+    results['stages'].append({'stage': 'persist', 'variant': 'journal_append',
+                              **measure(lambda: journal.append("benchmark", row), 50)})
+
+
+def bench_e2e(system, sizes, image, iterations, results):
+    """Whole requests through the Flask test client, against galleries of each size"""
+    import app as app_module
+
+    app_module._face_recognition_system = system
+    client = app_module.app.test_client()
+    for size in sizes:
+        names, matrix = synthetic_gallery(size)
+        install_gallery(system, names, matrix)
+        system.embedding_cache.clear()
+
+        def upload(name='photo.jpg'):
+            return (io.BytesIO(image), name)
+
+        # Distinct bytes per call so the embedding cache does not short-circuit the pipeline
+        counter = iter(range(10 ** 9))
+
+        def fresh():
+            return image + next(counter).to_bytes(8, 'little')
+
+        def recognize():
+            response = client.post('/recognize', data={'image': (io.BytesIO(fresh()), 'photo.jpg')})
+            assert response.status_code == 200, response.get_data(as_text=True)
+
+        def recognize_cached():
+            client.post('/recognize', data={'image': upload()})
+
+        def recognize_batch():
+            files = [(io.BytesIO(fresh()), f'{i}.jpg') for i in range(8)]
+            client.post('/recognize_batch', data={'images': files})
+
+        def verify():
+            client.post('/verify', data={'file1': (io.BytesIO(fresh()), 'a.jpg'), 'file2': (io.BytesIO(fresh()), 'b.jpg')})
+
+        for variant, function in (('recognize', recognize), ('recognize_cached', recognize_cached),
+                                  ('recognize_batch_8', recognize_batch), ('verify', verify)):
+            results['stages'].append({'stage': 'e2e', 'variant': variant, 'gallery_size': size,
+                                      **measure(function, iterations)})
+
+        stats = measure(lambda: client.get('/health'), iterations)
+        results['stages'].append({'stage': 'e2e', 'variant': 'health', 'gallery_size': size, **stats})
+
+
+def stage_key(entry):
+    return tuple((key, entry[key]) for key in ('stage', 'variant', 'image', 'gallery_size', 'batch_size') if key in entry)
+
+
+def compare(results, baseline_file):
+    """Print the mean latency of each stage relative to an earlier run"""
+    with open(baseline_file, 'r') as f:
+        baseline = {stage_key(entry): entry for entry in json.load(f)['stages']}
+
+    for entry in results['stages']:
+        previous = baseline.get(stage_key(entry))
+        if previous is None:
+            continue
+        ratio = entry['mean_ms'] / previous['mean_ms'] if previous['mean_ms'] else float('nan')
+        entry['baseline_mean_ms'] = previous['mean_ms']
+        label = " ".join(f"{key}={value}" for key, value in stage_key(entry))
+        print(f"{label:70s} {previous['mean_ms']:10.3f} -> {entry['mean_ms']:10.3f} ms  (x{ratio:.2f})",
+              file=sys.stderr)
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', default=",".join(STAGES), help='comma-separated subset of ' + ",".join(STAGES))
+    parser.add_argument('--models', choices=('stub', 'real'), default='stub')
+    parser.add_argument('--images', default='1280x960,4032x3024', help='synthetic photo sizes (WxH)')
+    parser.add_argument('--orientation', type=int, default=6, help='EXIF orientation of the synthetic photos')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='gallery sizes for match and e2e')
+    parser.add_argument('--persist-sizes', default='1000,10000,100000')
+    parser.add_argument('--json-max', type=int, default=10000, help='largest gallery persisted as JSON')
+    parser.add_argument('--loop-max', type=int, default=10000, help='largest gallery timed with the compare_embeddings loop')
+    parser.add_argument('--batch-sizes', default='1,8,32')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    selected = set(args.stages.split(','))
+    unknown = selected - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'models': args.models
+        },
+        'config': vars(args),
+        'selected': sorted(selected),
+        'stages': []
+    }
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    # Work in a scratch directory so database/ and uploads/ are never touched
+    workdir = tempfile.mkdtemp(prefix="face-benchmarks-")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    os.makedirs("database", exist_ok=True)
+    try:
+        system = create_system(args.models)
+        images = {}
+        for size in args.images.split(','):
+            width, height = (int(value) for value in size.split('x'))
+            images[size] = synthetic_image(width, height, orientation=args.orientation)
+
+        bench_images(system, images, args.iterations, results)
+        if 'embed' in selected:
+            bench_embed(system, args.iterations, parse_sizes(args.batch_sizes), results)
+        if 'match' in selected:
+            bench_match(system, parse_sizes(args.sizes), args.queries, args.loop_max, results)
+        if 'persist' in selected:
+            bench_persist(system, parse_sizes(args.persist_sizes), args.json_max, results)
+        if 'e2e' in selected:
+            bench_e2e(system, parse_sizes(args.sizes), next(iter(images.values())), args.iterations, results)
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if baseline:
+        compare(results, baseline)
+
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
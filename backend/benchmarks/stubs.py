@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class StubDetector:
+    """
+    MTCNN stand-in with the same result format: one centred face per image.
+    Lets the pipeline around detection be benchmarked without model weights.
+    """
+
+    def detect_faces(self, pixels):
+        height, width = pixels.shape[:2]
+        return [{
+            'box': [width // 4, height // 4, width // 2, height // 2],
+            'confidence': 0.99,
+            'keypoints': {}
+        }]
+
+
+class StubEmbedder:
+    """
+    FaceNet stand-in: a fixed random projection of the downsampled face crop,
+    L2-normalized. Deterministic, and similar crops get similar embeddings,
+    so recognition through the API behaves like the real thing.
+    """
+
+    def __init__(self, dimension=512, seed=0, stride=8):
+        self.dimension = dimension
+        self.seed = seed
+        self.stride = stride
+        self._projection = None
+
+    def embeddings(self, images):
+        faces = np.stack([np.asarray(image, dtype=np.float32)[::self.stride, ::self.stride] for image in images])
+        features = faces.reshape(len(faces), -1)
+        features -= features.mean(axis=1, keepdims=True)
+        if self._projection is None or self._projection.shape[0] != features.shape[1]:
+            rng = np.random.default_rng(self.seed)
+            self._projection = rng.standard_normal((features.shape[1], self.dimension)).astype(np.float32)
+
+        embeddings = features @ self._projection
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
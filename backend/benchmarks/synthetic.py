@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def synthetic_gallery(size, dimension=512, seed=0, clusters=None):
+    """
+    Synthetic, L2-normalized float32 gallery with FaceNet-like structure: rows
+    are drawn around a set of random centres instead of uniformly, so nearest
+    neighbours are meaningful. Returns (names, matrix).
+    """
+    rng = np.random.default_rng(seed)
+    clusters = clusters or max(1, size // 64)
+    centres = rng.standard_normal((clusters, dimension)).astype(np.float32)
+
+    matrix = np.empty((size, dimension), dtype=np.float32)
+    chunk_size = 65536
+    for start in range(0, size, chunk_size):
+        stop = min(size, start + chunk_size)
+        rows = centres[rng.integers(0, clusters, stop - start)]
+        rows += 0.8 * rng.standard_normal(rows.shape).astype(np.float32)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        matrix[start:stop] = rows
+
+    names = [f"id_{i:07d}" for i in range(size)]
+    return names, matrix
+
+
+def synthetic_probes(matrix, count, noise=0.3, seed=1):
+    """Noisy copies of random gallery rows, i.e. new photos of registered people"""
+    rng = np.random.default_rng(seed)
+    rows = matrix[rng.integers(0, matrix.shape[0], count)].astype(np.float32)
+    rows += noise * rng.standard_normal(rows.shape).astype(np.float32) / np.sqrt(matrix.shape[1])
+    rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+    return rows
+
+
+def synthetic_image(width=1280, height=960, seed=0, orientation=None, quality=90):
+    """
+    JPEG bytes of a synthetic photo: smooth gradients plus noise, so it
+    compresses like a real picture. orientation optionally sets the EXIF
+    Orientation tag (3, 6 or 8 rotate the image when it is displayed).
+    """
+    import io
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = rng.uniform(0, 255, 3).astype(np.float32)
+    pixels = np.empty((height, width, 3), dtype=np.float32)
+    for channel in range(3):
+        phase = rng.uniform(0, 2 * np.pi)
+        pixels[:, :, channel] = base[channel] + 60 * np.sin(xs / (width / 3) + phase) * np.cos(ys / (height / 2))
+    pixels += rng.normal(0, 12, pixels.shape)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    buffer = io.BytesIO()
+    if orientation:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image.save(buffer, 'JPEG', quality=quality, exif=exif.tobytes())
+    else:
+        image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
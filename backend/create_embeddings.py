@@ -1,263 +1,333 @@
 import os
 import json
+import hashlib
+import argparse
 import numpy as np
 import logging
+import multiprocessing
 from pathlib import Path
+from gallery import Gallery
+from embedding_store import EmbeddingStore, export_store_to_json
+from detectors import DETECTOR_MODES
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def extract_face(filename, required_size=(160, 160)):
-    """Extract face from image (from your Colab code)"""
-    
-    from PIL import Image, ExifTags
-    import numpy as np
-    import cv2
-    from mtcnn.mtcnn import MTCNN
-    
-    logger.info(f"Processing: {filename}")
-    
-    image = Image.open(filename)
-    
-    # Check and apply rotation based on EXIF data
-    try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
-        
-        if hasattr(image, '_getexif') and image._getexif() is not None:
-            exif = dict(image._getexif().items())
-            
-            if orientation in exif:
-                if exif[orientation] == 3:
-                    image = image.rotate(180, expand=True)
-                elif exif[orientation] == 6:
-                    image = image.rotate(270, expand=True)
-                elif exif[orientation] == 8:
-                    image = image.rotate(90, expand=True)
-                    
-    except (AttributeError, KeyError, IndexError):
-        pass  # No EXIF data or orientation tag
-    
-    image = image.convert('RGB')
-    pixels = np.asarray(image)
-    detector = MTCNN()
-    results = detector.detect_faces(pixels)
-    
-    if not results:
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+MANIFEST_VERSION = 1
+
+# One MTCNN detector (behind the detector mode's Haar first pass) per pool worker, created by _init_worker
+_detector = None
+
+
+def extract_face(filename, required_size=(160, 160), detector=None, max_side=None):
+    """
+    Detect and crop the face of an ID photo exactly as the server does for
+    an upload (FaceRecognitionSystem.extract_face_fast), so gallery and
+    probe crops go through the same decode and resampling
+    """
+    from face_recognition import FaceRecognitionSystem, DETECTION_MAX_SIDE
+
+    logger.debug(f"Processing: {filename}")
+    if detector is None:
+        from mtcnn.mtcnn import MTCNN
+        detector = MTCNN()
+
+    decoded = FaceRecognitionSystem.decode_for_detection(filename, max_side or DETECTION_MAX_SIDE)
+    results = detector.detect_faces(np.asarray(decoded[1]))
+    faces = FaceRecognitionSystem.crop_faces(decoded, results[:1], required_size)
+    if not faces:
         logger.warning(f"No face detected in {filename}")
         raise ValueError(f"No face detected in the image: {filename}")
-    
-    x1, y1, width, height = results[0]['box']
-    x1, y1 = abs(x1), abs(y1)
-    x2, y2 = x1 + width, y1 + height
-    
-    face = pixels[y1:y2, x1:x2]
-    face = cv2.resize(face, required_size)
-    
-    logger.info(f"Face extracted successfully from {filename}")
-    return face
+
+    logger.debug(f"Face extracted successfully from {filename}")
+    return faces[0][0]
 
 def ensure_normalized(v, tolerance=1e-3):
     """Normalize vector (from your Colab code)"""
     from numpy.linalg import norm
-    
+
     length = norm(v)
     if abs(length - 1.0) < tolerance:
         return v
     else:
         return v / length
 
-def create_embeddings_from_ids():
-    """Create embeddings.json from all ID photos"""
-    
+def file_sha256(path, chunk_size=1 << 20):
+    """Content hash of an ID photo, used to skip unchanged photos"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(manifest_file):
+    """Load the {image_file: {"sha256", "name"[, "evicted"]}} manifest of the last rebuild"""
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}
+        return manifest.get("files", {})
+    except (json.JSONDecodeError, OSError) as e:
+        logger.warning(f"Ignoring unreadable manifest {manifest_file}: {e}")
+        return {}
+
+def save_manifest(manifest_file, files):
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({"version": MANIFEST_VERSION, "files": files}, f, separators=(',', ':'))
+    os.replace(tmp_file, manifest_file)
+
+def read_registered_rows(store):
+    """
+    Templates registered through the API (no ID photo), as copied-out
+    (names, rows, source_files), which a rebuild must keep
+    """
+    names, rows, sources = [], [], []
+    if store.exists():
+        store_names, matrix, index = store.load()
+        for position, (name, source_file) in enumerate(zip(store_names, index["source_files"])):
+            if source_file == "registered_live":
+                names.append(name)
+                rows.append(np.array(matrix[position]))
+                sources.append(source_file)
+    return names, rows, sources
+
+def _init_worker(detector_mode="mtcnn"):
+    """Pool initializer: build this worker's MTCNN detector once"""
+    global _detector
+    from mtcnn.mtcnn import MTCNN
+    from detectors import CascadeDetector
+    _detector = CascadeDetector(MTCNN(), mode=detector_mode)
+
+def _detect(image_path):
+    """Pool task: decode one ID photo and detect its face"""
+    try:
+        return image_path, extract_face(image_path, detector=_detector), None
+    except Exception as e:
+        return image_path, None, str(e)
+
+def create_embeddings_from_ids(workers=None, batch_size=64, export_json=False, detector="mtcnn",
+                               max_templates=None, eviction=None):
+    """
+    Rebuild the embedding store from all ID photos.
+
+    Photos whose content hash matches the manifest of the previous run reuse
+    their stored embedding. The others are decoded and detected across a
+    process pool (one MTCNN per worker, run as the detector mode says, see
+    detectors.py) and embedded in batches.
+
+    Templates registered through the API are kept, next to the photo of an
+    ID that has one, and capped per ID like the server does (max_templates
+    and eviction default to FACE_MAX_TEMPLATES and FACE_TEMPLATE_EVICTION).
+    """
+    if max_templates is None:
+        max_templates = int(os.environ.get("FACE_MAX_TEMPLATES", "5"))
+    eviction = eviction or os.environ.get("FACE_TEMPLATE_EVICTION", "oldest")
+
     logger.info("="*60)
-    logger.info("CREATING EMBEDDINGS.JSON FROM ID PHOTOS")
+    logger.info("CREATING EMBEDDINGS FROM ID PHOTOS")
     logger.info("="*60)
-    
+
     # Paths
     ids_folder = "database/ids"
     embeddings_file = "database/embeddings.json"
-    
+    manifest_file = "database/ids_manifest.json"
+    store = EmbeddingStore("database")
+
     # Check if IDs folder exists
     if not os.path.exists(ids_folder):
         logger.warning(f"IDs folder not found: {ids_folder}. Creating it.")
         os.makedirs(ids_folder)
-    
+
     # Create database folder if it doesn't exist
     os.makedirs("database", exist_ok=True)
-    
+
     # Get all image files
-    image_files = []
-    for filename in os.listdir(ids_folder):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')):
-            image_files.append(filename)
-    
+    image_files = sorted(
+        filename for filename in os.listdir(ids_folder)
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
     logger.info(f"Found {len(image_files)} ID photos to process")
-    
-    if not image_files:
-        logger.warning("No image files found in the IDs folder. Creating an empty embeddings file.")
-        # Create an empty embeddings.json
-        final_data = {
-            "metadata": {
-                "total_ids": 0,
-                "embedding_dimension": None,
-                "model": "FaceNet",
-                "normalization": "L2"
-            },
-            "embeddings": {}
-        }
-        with open(embeddings_file, 'w') as f:
-            json.dump(final_data, f, indent=2)
-        logger.info(f"✅ Empty embeddings file created at {embeddings_file}")
-        return True
-    
-    logger.info(f"ID files: {image_files}")
-    
-    # Load FaceNet model
-    logger.info("Loading FaceNet model...")
-    from keras_facenet import FaceNet
-    embedder = FaceNet()
-    logger.info("FaceNet model loaded successfully")
-    
-    # Process each ID photo
-    embeddings_data = {}
-    successful_count = 0
-    
-    for i, image_file in enumerate(image_files, 1):
-        logger.info(f"\nProcessing {i}/{len(image_files)}: {image_file}")
-        
-        try:
-            # Extract person name from filename
-            person_name = os.path.splitext(image_file)[0]
-            image_path = os.path.join(ids_folder, image_file)
-            
-            logger.info(f"  Person: {person_name}")
-            
-            # Extract face
-            face = extract_face(image_path)
-            logger.info(f"  Face extracted: {face.shape}")
-            
-            # Generate embedding
-            embedding = embedder.embeddings([face])[0]
-            logger.info(f"  Embedding generated: {embedding.shape}")
-            
-            # Normalize embedding
-            embedding = ensure_normalized(embedding)
-            logger.info(f"  Embedding normalized")
-            
-            # Convert to list for JSON serialization
-            embedding_list = embedding.tolist()
-            
-            # Store in data dictionary
-            embeddings_data[person_name] = {
-                "embedding": embedding_list,
-                "source_file": image_file,
-                "embedding_shape": list(embedding.shape)
-            }
-            
-            successful_count += 1
-            logger.info(f"  ✅ Successfully processed {person_name}")
-            
-        except Exception as e:
-            logger.error(f"  ❌ Failed to process {image_file}: {e}")
-            # Continue with other images
-            continue
-    
-    # Save embeddings to JSON file
-    if embeddings_data:
-        logger.info(f"\nSaving embeddings to {embeddings_file}...")
-        
-        # Add metadata
-        embedding_dim = list(embeddings_data[list(embeddings_data.keys())[0]]["embedding_shape"]) if embeddings_data else None
-        final_data = {
-            "metadata": {
-                "total_ids": len(embeddings_data),
-                "embedding_dimension": embedding_dim,
-                "created_from": ids_folder,
-                "model": "FaceNet",
-                "normalization": "L2"
-            },
-            "embeddings": embeddings_data
-        }
-        
-        with open(embeddings_file, 'w') as f:
-            json.dump(final_data, f, indent=2)
-        
-        logger.info(f"✅ Embeddings saved successfully!")
-        logger.info(f"📊 Summary:")
-        logger.info(f"   Total IDs processed: {successful_count}/{len(image_files)}")
-        logger.info(f"   Embeddings file: {embeddings_file}")
-        logger.info(f"   File size: {os.path.getsize(embeddings_file)} bytes")
-        logger.info(f"   IDs included: {list(embeddings_data.keys())}")
-        
-        return True
-    else:
-        logger.warning("No embeddings generated, skipping save.")
-        return False
+
+    # Previous results: manifest of photo hashes plus the current store
+    manifest = load_manifest(manifest_file)
+    previous_rows = {}
+    if store.exists():
+        names, matrix, index = store.load()
+        for position, source_file in enumerate(index["source_files"]):
+            if source_file != "registered_live":
+                previous_rows[source_file] = np.array(matrix[position])
+
+    new_manifest = {}
+    rows = {}
+    to_process = []
+    for image_file in image_files:
+        sha256 = file_sha256(os.path.join(ids_folder, image_file))
+        person_name = os.path.splitext(image_file)[0]
+        new_manifest[image_file] = {"sha256": sha256, "name": person_name}
+
+        previous = manifest.get(image_file)
+        if previous and previous.get("sha256") == sha256 and image_file in previous_rows:
+            rows[image_file] = previous_rows[image_file]
+        elif previous and previous.get("sha256") == sha256 and previous.get("evicted"):
+            # Evicted past the template cap by registered templates: stays out
+            new_manifest[image_file]["evicted"] = True
+        else:
+            to_process.append(image_file)
+
+    logger.info(f"{len(rows)} unchanged photos reused, {len(to_process)} to process")
+
+    failed = 0
+    if to_process:
+        workers = workers or os.cpu_count() or 1
+        logger.info(f"Detecting faces with {workers} worker processes ({detector} detector)...")
+
+        # Spawned workers do not inherit this process's TensorFlow state
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes=workers, initializer=_init_worker, initargs=(detector,)) as pool:
+            # Load FaceNet model while the workers start up
+            # The same backend as the server (FACE_EMBEDDER), so gallery and probes match
+            logger.info("Loading FaceNet model...")
+            from embedders import create_embedder
+            embedder = create_embedder()
+            logger.info(f"FaceNet model loaded successfully ({embedder.name})")
+
+            def embed(batch):
+                embeddings = embedder.embeddings([face for _, face in batch])
+                for (image_file, _), embedding in zip(batch, embeddings):
+                    rows[image_file] = ensure_normalized(embedding).astype(np.float32)
+
+            paths = [os.path.join(ids_folder, image_file) for image_file in to_process]
+            batch = []
+            for i, (image_path, face, error) in enumerate(pool.imap_unordered(_detect, paths, chunksize=4), 1):
+                image_file = os.path.basename(image_path)
+                if face is None:
+                    logger.error(f"  ❌ Failed to process {image_file}: {error}")
+                    new_manifest.pop(image_file, None)
+                    failed += 1
+                else:
+                    batch.append((image_file, face))
+                    if len(batch) >= batch_size:
+                        embed(batch)
+                        batch = []
+
+                if i % 1000 == 0:
+                    logger.info(f"  Processed {i}/{len(to_process)} photos")
+
+            if batch:
+                embed(batch)
+
+    # Assemble the gallery in file order; later files win on duplicate names
+    photo_rows = {}
+    for image_file in image_files:
+        if image_file in rows:
+            photo_rows[new_manifest[image_file]["name"]] = (rows[image_file], image_file)
+
+    with store.lock():
+        # Templates registered through the API are kept: the only ones of IDs
+        # without a photo, or more templates of IDs with one. They are read
+        # under the lock, as a compaction may have folded new ones into the
+        # store while the photos were being embedded.
+        kept_names, kept_rows, kept_sources = read_registered_rows(store)
+
+        names = list(photo_rows.keys()) + kept_names
+        source_files = [source_file for _, source_file in photo_rows.values()] + kept_sources
+        matrix_rows = [row for row, _ in photo_rows.values()] + kept_rows
+        if matrix_rows:
+            matrix = np.stack(matrix_rows).astype(np.float32)
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+
+        # The photo is an ID's oldest template, so it is evicted first past the cap
+        gallery = Gallery.from_matrix(names, matrix).configure_templates(max_templates, eviction)
+        source_files = [source_files[position] for position in gallery.live_positions]
+        live_files = set(source_files)
+        for _, image_file in photo_rows.values():
+            if image_file not in live_files:
+                new_manifest[image_file]["evicted"] = True
+        store.save(gallery.names, gallery.matrix, source_files=source_files, metadata={"created_from": ids_folder})
+        save_manifest(manifest_file, new_manifest)
+
+    if export_json:
+        export_store_to_json(embeddings_file, store)
+
+    logger.info(f"✅ Embeddings saved successfully!")
+    logger.info(f"📊 Summary:")
+    logger.info(f"   ID photos embedded: {len(photo_rows)}/{len(image_files)} ({failed} failed)")
+    logger.info(f"   Total IDs in store: {len(gallery)} ({gallery.template_count} templates)")
+    logger.info(f"   Embedding store: {store.index_file}")
+
+    return len(gallery) > 0
 
 def verify_embeddings_file():
-    """Verify that the embeddings file was created correctly"""
-    
+    """Verify that the embedding store was created correctly"""
+
     logger.info("\n" + "="*60)
-    logger.info("VERIFYING EMBEDDINGS.JSON FILE")
+    logger.info("VERIFYING EMBEDDING STORE")
     logger.info("="*60)
-    
-    embeddings_file = "database/embeddings.json"
-    
-    if not os.path.exists(embeddings_file):
-        logger.error(f"❌ Embeddings file not found: {embeddings_file}")
+
+    store = EmbeddingStore("database")
+
+    if not store.exists():
+        logger.error(f"❌ Embedding store not found: {store.index_file}")
         return False
-    
+
     try:
-        with open(embeddings_file, 'r') as f:
-            data = json.load(f)
-        
-        logger.info(f"✅ Embeddings file loaded successfully")
-        
-        # Check structure
-        if "metadata" in data and "embeddings" in data:
-            metadata = data["metadata"]
-            embeddings = data["embeddings"]
-            
-            logger.info(f"📊 Metadata:")
-            logger.info(f"   Total IDs: {metadata.get('total_ids')}")
-            logger.info(f"   Embedding dimension: {metadata.get('embedding_dimension')}")
-            logger.info(f"   Model: {metadata.get('model')}")
-            
-            logger.info(f"📊 Embeddings:")
-            logger.info(f"   Number of people: {len(embeddings)}")
-            
-            for name, data in embeddings.items():
-                embedding_length = len(data["embedding"])
-                source_file = data["source_file"]
-                logger.info(f"   {name}: {embedding_length}D vector from {source_file}")
-            
-            logger.info(f"✅ Embeddings file structure is correct!")
-            return True
-        else:
-            logger.error(f"❌ Invalid file structure")
+        names, matrix, index = store.load()
+
+        logger.info(f"✅ Embedding store loaded successfully")
+        logger.info(f"📊 Metadata:")
+        logger.info(f"   Total IDs: {index.get('count')}")
+        logger.info(f"   Embedding dimension: {index.get('dimension')}")
+        logger.info(f"   Model: {index.get('metadata', {}).get('model')}")
+
+        if len(names) != matrix.shape[0] or len(index["source_files"]) != len(names):
+            logger.error(f"❌ Invalid store: names and embeddings do not line up")
             return False
-            
+
+        if len(names):
+            norms = np.linalg.norm(matrix, axis=1)
+            if not np.all(np.abs(norms - 1.0) < 1e-2):
+                logger.error(f"❌ Invalid store: embeddings are not L2-normalized")
+                return False
+
+        logger.info(f"✅ Embedding store structure is correct!")
+        return True
+
     except Exception as e:
-        logger.error(f"❌ Error reading embeddings file: {e}")
+        logger.error(f"❌ Error reading embedding store: {e}")
         return False
 
 def main():
     """Main execution function"""
+    parser = argparse.ArgumentParser(description="Rebuild the embedding store from database/ids")
+    parser.add_argument('--workers', type=int, default=None, help='detection processes (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=64, help='faces per FaceNet call')
+    parser.add_argument('--export-json', action='store_true', help='also write database/embeddings.json')
+    parser.add_argument('--detector', choices=DETECTOR_MODES, default='mtcnn',
+                        help='MTCNN on the whole photo, or behind a Haar first pass (see detectors.py)')
+    args = parser.parse_args()
+
     logger.info("🚀 Starting embeddings creation process...\n")
-    
+
     # Step 1: Create embeddings
-    embeddings_created = create_embeddings_from_ids()
-    
-    # Step 2: Verify the file (only if embeddings were actually created)
+    embeddings_created = create_embeddings_from_ids(
+        workers=args.workers, batch_size=args.batch_size, export_json=args.export_json, detector=args.detector
+    )
+
+    # Step 2: Verify the store (only if embeddings were actually created)
     if embeddings_created:
         verify_embeddings_file()
 
-    logger.info("\n🎉 SUCCESS! Your embeddings.json file is ready!")
-    logger.info(f"📁 Location: database/embeddings.json")
+    logger.info("\n🎉 SUCCESS! Your embedding store is ready!")
+    logger.info(f"📁 Location: database/embeddings.index.json")
     logger.info("🔄 You can now start your Flask app.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,154 @@
+import threading
+import numpy as np
+import cv2
+
+# How a single-face detection may run (FACE_DETECTOR):
+#   'mtcnn'   - MTCNN on the whole frame
+#   'cascade' - Haar proposal, then MTCNN on a small region around it;
+#               MTCNN on the whole frame only if either finds nothing
+#   'haar'    - as cascade, but a confident Haar box is used as is
+DETECTOR_MODES = ("mtcnn", "cascade", "haar")
+
+# Paths a detection can take, as reported by CascadeDetector.detect
+DETECTION_PATHS = ("haar", "mtcnn_roi", "mtcnn")
+
+
+def check_mode(mode):
+    if mode not in DETECTOR_MODES:
+        raise ValueError(f"Unknown face detector mode: {mode} (expected one of {', '.join(DETECTOR_MODES)})")
+    return mode
+
+
+class HaarDetector:
+    """
+    OpenCV's bundled frontal-face Haar cascade, with MTCNN's detect_faces()
+    result format. Runs on a grayscale copy of at most max_side pixels and
+    only looks for faces at least min_face_fraction of the shorter side, so
+    it costs a few milliseconds on an ID photo. Results are sorted by area,
+    largest first, and carry the cascade's level 'weight' (not a probability).
+    """
+
+    def __init__(self, cascade_file=None, max_side=480, min_face_fraction=0.2, scale_factor=1.1, min_neighbors=5):
+        self.cascade_file = cascade_file or cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+        self.max_side = max_side
+        self.min_face_fraction = min_face_fraction
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        # A CascadeClassifier is not safe to share between threads
+        self._local = threading.local()
+
+    def _classifier(self):
+        classifier = getattr(self._local, "classifier", None)
+        if classifier is None:
+            classifier = cv2.CascadeClassifier(self.cascade_file)
+            if classifier.empty():
+                raise RuntimeError(f"Could not load the Haar cascade {self.cascade_file}")
+            self._local.classifier = classifier
+        return classifier
+
+    def detect_faces(self, pixels):
+        height, width = pixels.shape[:2]
+        scale = min(1.0, self.max_side / max(height, width))
+        gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+        if scale < 1:
+            gray = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                              interpolation=cv2.INTER_AREA)
+        gray = cv2.equalizeHist(gray)
+
+        min_side = max(20, int(min(gray.shape) * self.min_face_fraction))
+        boxes, _, weights = self._classifier().detectMultiScale3(
+            gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=(min_side, min_side), outputRejectLevels=True
+        )
+
+        results = []
+        for (x, y, w, h), weight in zip(boxes, np.ravel(weights)):
+            results.append({
+                'box': [int(round(x / scale)), int(round(y / scale)), int(round(w / scale)), int(round(h / scale))],
+                'weight': float(weight)
+            })
+        results.sort(key=lambda result: result['box'][2] * result['box'][3], reverse=True)
+        return results
+
+
+class CascadeDetector:
+    """
+    Cheap first pass ahead of MTCNN for photos with one large face.
+
+    The Haar detector proposes the largest face; MTCNN then only runs on
+    the region around it, padded by roi_padding of the box size on every
+    side and scaled down to roi_side pixels, which is a fraction of the
+    pyramid it builds over the whole frame. Its boxes are mapped back to
+    the frame, so crops match those of a full-frame MTCNN run. In 'haar'
+    mode a proposal with a weight of at least min_weight is used directly
+    and MTCNN does not run at all. Whenever Haar finds no face, or MTCNN
+    finds none with min_confidence in the region, MTCNN runs on the whole
+    frame.
+
+    detect_faces(pixels) uses the default mode, so this is a drop-in
+    replacement for the MTCNN detector; detect(pixels, mode) also returns
+    the path taken ('haar', 'mtcnn_roi' or 'mtcnn').
+    """
+
+    def __init__(self, detector, fast_detector=None, mode="cascade", roi_padding=0.3, roi_side=320,
+                 min_confidence=0.9, min_weight=4.0):
+        self.detector = detector
+        self.fast_detector = fast_detector or HaarDetector()
+        self.mode = check_mode(mode)
+        self.roi_padding = roi_padding
+        self.roi_side = roi_side
+        self.min_confidence = min_confidence
+        self.min_weight = min_weight
+
+    def detect_faces(self, pixels):
+        results, _ = self.detect(pixels)
+        return results
+
+    def detect(self, pixels, mode=None):
+        """Detect faces in an RGB array; returns (results, path)"""
+        mode = check_mode(mode or self.mode)
+        if mode != "mtcnn":
+            proposals = self.fast_detector.detect_faces(pixels)
+            if proposals:
+                proposal = proposals[0]
+                if mode == "haar" and proposal['weight'] >= self.min_weight:
+                    return [proposal], "haar"
+                results = self._detect_roi(pixels, proposal['box'])
+                if results:
+                    return results, "mtcnn_roi"
+
+        return self.detector.detect_faces(pixels), "mtcnn"
+
+    def _detect_roi(self, pixels, box):
+        height, width = pixels.shape[:2]
+        x, y, w, h = box
+        pad = int(round(self.roi_padding * max(w, h)))
+        x1, y1 = max(0, x - pad), max(0, y - pad)
+        x2, y2 = min(width, x + w + pad), min(height, y + h + pad)
+        if x2 <= x1 or y2 <= y1:
+            return []
+
+        region = pixels[y1:y2, x1:x2]
+        scale = min(1.0, self.roi_side / max(region.shape[:2]))
+        if scale < 1:
+            region = cv2.resize(region, (max(1, round(region.shape[1] * scale)), max(1, round(region.shape[0] * scale))),
+                                interpolation=cv2.INTER_AREA)
+
+        results = []
+        for result in self.detector.detect_faces(np.ascontiguousarray(region)):
+            if result.get('confidence', 1.0) < self.min_confidence:
+                continue
+            # Back to frame coordinates
+            rx, ry, rw, rh = result['box']
+            mapped = {
+                **result,
+                'box': [int(round(rx / scale)) + x1, int(round(ry / scale)) + y1,
+                        int(round(rw / scale)), int(round(rh / scale))]
+            }
+            if 'keypoints' in result:
+                mapped['keypoints'] = {
+                    name: (int(round(px / scale)) + x1, int(round(py / scale)) + y1)
+                    for name, (px, py) in result['keypoints'].items()
+                }
+            results.append(mapped)
+        return results
@@ -0,0 +1,313 @@
+import os
+import json
+import logging
+import argparse
+import threading
+import numpy as np
+from numpy.linalg import norm
+
+logger = logging.getLogger(__name__)
+
+FACE_SHAPE = (160, 160, 3)
+
+# Exported models, relative to the backend directory (see `python embedders.py export`)
+DEFAULT_MODELS = {
+    "onnx": "models/facenet.onnx",
+    "tflite": "models/facenet.tflite",
+}
+
+
+def _prewhiten(faces):
+    """Per-image standardization, as in the original FaceNet prewhiten()"""
+    faces = faces.astype(np.float32)
+    mean = faces.mean(axis=(1, 2, 3), keepdims=True)
+    std = np.maximum(faces.std(axis=(1, 2, 3), keepdims=True), np.float32(1.0 / np.sqrt(faces[0].size)))
+    return (faces - mean) / std
+
+
+def _fixed_standardization(faces):
+    return (faces.astype(np.float32) - 127.5) / 128.0
+
+
+def _raw(faces):
+    return faces.astype(np.float32)
+
+
+# Input scalings an exported graph may need to reproduce keras_facenet's
+# FaceNet.embeddings(); export picks the one that matches it and records it
+PREPROCESSING = {
+    "prewhiten": _prewhiten,
+    "fixed": _fixed_standardization,
+    "raw": _raw,
+}
+
+
+def _stack(faces):
+    return np.stack([np.asarray(face, dtype=np.uint8) for face in faces])
+
+
+def read_model_info(model_path):
+    """Metadata written next to an exported model (preprocessing, quantization)"""
+    with open(f"{model_path}.json", 'r') as f:
+        return json.load(f)
+
+
+class KerasEmbedder:
+    """keras_facenet's FaceNet on TensorFlow: the float32 reference"""
+
+    kind = "keras"
+
+    def __init__(self):
+        from keras_facenet import FaceNet
+        self.facenet = FaceNet()
+        self.name = "keras"
+
+    def embeddings(self, faces):
+        return self.facenet.embeddings(faces)
+
+
+class OnnxEmbedder:
+    """FaceNet exported to ONNX (float32 or int8), run by ONNX Runtime on the CPU"""
+
+    kind = "onnx"
+
+    def __init__(self, model_path, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        # Sessions are thread-safe, so concurrent batches need no lock
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.info = read_model_info(model_path)
+        self.preprocess = PREPROCESSING[self.info["preprocessing"]]
+        self.name = f"onnx:{os.path.basename(model_path)}"
+
+    def embeddings(self, faces):
+        return self.session.run(None, {self.input_name: self.preprocess(_stack(faces))})[0]
+
+
+class TFLiteEmbedder:
+    """
+    FaceNet converted to TensorFlow Lite (float32 or full int8). Uses the
+    small tflite_runtime package when installed instead of importing all of
+    TensorFlow. The interpreter is resized whenever the batch size changes.
+    """
+
+    kind = "tflite"
+
+    def __init__(self, model_path, threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.interpreter = Interpreter(model_path=model_path, num_threads=threads)
+        self._input = self.interpreter.get_input_details()[0]['index']
+        self._output = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        # An interpreter runs one batch at a time
+        self._lock = threading.Lock()
+        self.info = read_model_info(model_path)
+        self.preprocess = PREPROCESSING[self.info["preprocessing"]]
+        self.name = f"tflite:{os.path.basename(model_path)}"
+
+    def embeddings(self, faces):
+        batch = self.preprocess(_stack(faces))
+        with self._lock:
+            if batch.shape[0] != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input, batch.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = batch.shape[0]
+            self.interpreter.set_tensor(self._input, batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output).copy()
+
+
+EMBEDDER_TYPES = {
+    KerasEmbedder.kind: KerasEmbedder,
+    OnnxEmbedder.kind: OnnxEmbedder,
+    TFLiteEmbedder.kind: TFLiteEmbedder,
+}
+
+
+def create_embedder(kind=None, model_path=None, threads=None):
+    """
+    Build a FaceNet embedder by name: 'keras' (default), 'onnx' or 'tflite'.
+    Defaults come from FACE_EMBEDDER, FACE_EMBEDDER_MODEL and
+    FACE_EMBEDDER_THREADS.
+    """
+    kind = kind or os.environ.get("FACE_EMBEDDER", "keras")
+    if kind not in EMBEDDER_TYPES:
+        raise ValueError(f"Unknown embedder backend: {kind}")
+    if kind == KerasEmbedder.kind:
+        return KerasEmbedder()
+
+    model_path = model_path or os.environ.get("FACE_EMBEDDER_MODEL") or DEFAULT_MODELS[kind]
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(
+            f"No {kind} FaceNet model at {model_path}; create it with: python embedders.py export --format {kind}"
+        )
+    threads = threads or int(os.environ.get("FACE_EMBEDDER_THREADS", "0")) or None
+    return EMBEDDER_TYPES[kind](model_path, threads=threads)
+
+
+def load_faces(folder="database/ids", limit=200):
+    """160x160 face crops of up to limit ID photos, for calibration and parity checks"""
+    from mtcnn.mtcnn import MTCNN
+    from create_embeddings import extract_face, IMAGE_EXTENSIONS
+
+    detector = MTCNN()
+    faces = []
+    for filename in sorted(os.listdir(folder)):
+        if len(faces) >= limit:
+            break
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            try:
+                faces.append(extract_face(os.path.join(folder, filename), detector=detector))
+            except Exception as e:
+                logger.warning(f"Skipping {filename}: {e}")
+    return faces
+
+
+def _normalized(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    return embeddings / norm(embeddings, axis=1, keepdims=True)
+
+
+def detect_preprocessing(facenet, faces):
+    """Name of the PREPROCESSING that makes the bare Keras model match FaceNet.embeddings"""
+    reference = _normalized(facenet.embeddings(faces))
+    batch = _stack(faces)
+    errors = {}
+    for name, preprocess in PREPROCESSING.items():
+        output = _normalized(facenet.model.predict(preprocess(batch), verbose=0))
+        errors[name] = float(norm(output - reference, axis=1).max())
+    best = min(errors, key=errors.get)
+    if errors[best] > 1e-3:
+        raise RuntimeError(f"Could not reproduce FaceNet.embeddings preprocessing (distances: {errors})")
+    return best
+
+
+def _export_onnx(model, output, calibration):
+    import tensorflow as tf
+    import tf2onnx
+
+    signature = (tf.TensorSpec((None, *FACE_SHAPE), tf.float32, name="faces"),)
+    if calibration is None:
+        tf2onnx.convert.from_keras(model, input_signature=signature, opset=13, output_path=output)
+        return
+
+    float_model = f"{output}.float.onnx"
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=13, output_path=float_model)
+    try:
+        quantize_onnx(float_model, output, calibration)
+    finally:
+        os.remove(float_model)
+
+
+def quantize_onnx(float_model, output, calibration):
+    """
+    Static post-training quantization of an ONNX model: int8 weights (per
+    output channel) and int8 activations, whose ranges are calibrated by
+    running the preprocessed calibration batch through the model.
+    """
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    prepared_model = f"{output}.prepared.onnx"
+    # ONNX shape inference is enough for FaceNet's conv graph; the symbolic one needs sympy
+    quant_pre_process(float_model, prepared_model, skip_symbolic_shape=True)
+
+    class Faces(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.batches = iter(calibration[i:i + 1] for i in range(len(calibration)))
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {self.input_name: batch}
+
+    try:
+        session = onnxruntime.InferenceSession(prepared_model, providers=["CPUExecutionProvider"])
+        quantize_static(
+            prepared_model, output, Faces(session.get_inputs()[0].name), quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8, per_channel=True
+        )
+    finally:
+        os.remove(prepared_model)
+
+
+def _export_tflite(model, output, calibration):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if calibration is not None:
+        # Full-integer post-training quantization, keeping float32 input and output
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([calibration[i:i + 1]] for i in range(len(calibration)))
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(output, 'wb') as f:
+        f.write(converter.convert())
+
+
+def export_model(model_format, output=None, int8=False, faces_folder="database/ids", calibration_size=200):
+    """
+    Export the Keras FaceNet model to ONNX or TFLite, optionally with
+    post-training int8 quantization calibrated on ID photo faces. Writes the
+    model plus a .json with the input preprocessing. Returns the model path.
+    """
+    if output is None:
+        root, extension = os.path.splitext(DEFAULT_MODELS[model_format])
+        output = f"{root}.int8{extension}" if int8 else DEFAULT_MODELS[model_format]
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+    faces = load_faces(faces_folder, calibration_size)
+    if not faces:
+        raise ValueError(f"No faces found in {faces_folder}; they are needed to export and calibrate the model")
+
+    facenet = KerasEmbedder().facenet
+    preprocessing = detect_preprocessing(facenet, faces)
+    logger.info(f"FaceNet input preprocessing: {preprocessing}")
+    calibration = PREPROCESSING[preprocessing](_stack(faces)) if int8 else None
+
+    logger.info(f"Exporting FaceNet to {output}...")
+    if model_format == "onnx":
+        _export_onnx(facenet.model, output, calibration)
+    else:
+        _export_tflite(facenet.model, output, calibration)
+
+    with open(f"{output}.json", 'w') as f:
+        json.dump({
+            "format": model_format,
+            "preprocessing": preprocessing,
+            "quantization": "int8" if int8 else None,
+            "calibration_faces": len(faces) if int8 else 0,
+            "input_shape": list(FACE_SHAPE)
+        }, f, indent=2)
+
+    logger.info(f"✅ Exported {output} ({os.path.getsize(output) / 1e6:.1f} MB)")
+    logger.info(f"Check it with: python -m benchmarks.embedder_report --backends keras,{model_format}:{output}")
+    return output
+
+
+def main():
+    """Export FaceNet for the ONNX Runtime and TFLite embedder backends"""
+    parser = argparse.ArgumentParser(description="Export the Keras FaceNet model for the CPU embedder backends")
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('--format', choices=sorted(DEFAULT_MODELS), default='onnx')
+    parser.add_argument('--int8', action='store_true', help='post-training int8 quantization')
+    parser.add_argument('--output', help='model path (default: models/facenet[.int8].<format>)')
+    parser.add_argument('--faces', default='database/ids', help='ID photos used for calibration')
+    parser.add_argument('--calibration-size', type=int, default=200)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    export_model(args.format, args.output, args.int8, args.faces, args.calibration_size)
+
+
+if __name__ == "__main__":
+    main()
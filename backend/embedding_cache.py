@@ -0,0 +1,170 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of per-image results (detected box and embedding),
+    keyed by a hash of the uploaded bytes plus the detector/model
+    configuration. Entries expire after ttl_seconds; the least recently used
+    entry is evicted once max_entries is reached.
+    """
+
+    def __init__(self, max_entries=4096, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(data, config=""):
+        """Cache key for raw image bytes under a given pipeline configuration"""
+        digest = hashlib.blake2b(data, digest_size=20)
+        digest.update(config.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Cached value for key, or None on a miss"""
+        if self.max_entries <= 0:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, stored_at = entry
+            if self.ttl_seconds is not None and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+class _Flight:
+    """One in-flight computation; followers wait() for the leader's result"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def resolve(self, value):
+        self._value = value
+        self._done.set()
+
+    def fail(self, error):
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent computations, keyed like the embedding
+    cache. The first caller for a key leads and computes; callers that
+    arrive while it is in flight wait for its result (or its exception)
+    instead of repeating the work. Nothing is kept once the leader is done:
+    that is the cache's job.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.coalesced = 0
+
+    def begin(self, key):
+        """
+        (flight, leader) for key. A leader must call finish(key, value) or
+        finish(key, error=e); a follower calls flight.wait().
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            self.leaders += 1
+            return flight, True
+
+    def finish(self, key, value=None, error=None):
+        with self._lock:
+            flight = self._flights.pop(key)
+        if error is not None:
+            flight.fail(error)
+        else:
+            flight.resolve(value)
+
+    def do(self, key, compute):
+        """compute() once for all concurrent callers with the same key"""
+        flight, leader = self.begin(key)
+        if not leader:
+            return flight.wait()
+        try:
+            value = compute()
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            calls = self.leaders + self.coalesced
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'coalesced_rate': self.coalesced / calls if calls else 0.0
+            }
@@ -0,0 +1,436 @@
+import os
+import sys
+import json
+import zlib
+import struct
+import logging
+import shutil
+import threading
+from contextlib import contextmanager
+import numpy as np
+from gallery import Gallery, ensure_normalized
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+
+# Journal record header: magic, name length, embedding dimension, CRC32 of the payload
+JOURNAL_MAGIC = b'FRJ1'
+JOURNAL_HEADER = struct.Struct('<4sIII')
+
+
+def _fsync_write(path, write):
+    """Write a file through a temporary name, fsync it and atomically move it into place"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore:
+    """
+    Binary embedding store.
+
+    The gallery is kept as a raw little-endian float32 (N, D) matrix file that
+    is memory-mapped read-only on load, so startup does not parse any floats
+    and the pages are shared between worker processes through the page cache.
+    Names and metadata live in a small JSON index next to it. Each save writes
+    a new matrix generation and then atomically swaps the index, so readers
+    never see a matrix that does not match its names.
+    """
+
+    def __init__(self, directory="database", name="embeddings"):
+        self.directory = directory
+        self.name = name
+        self.index_file = os.path.join(directory, f"{name}.index.json")
+
+    def exists(self):
+        return os.path.exists(self.index_file)
+
+    def lock(self):
+        """Exclusive inter-process lock for read-modify-write cycles on the store"""
+        return _file_lock(f"{self.index_file}.lock")
+
+    def _matrix_file(self, generation):
+        return os.path.join(self.directory, f"{self.name}.{generation}.f32")
+
+    def read_index(self):
+        with open(self.index_file, 'r') as f:
+            index = json.load(f)
+
+        if index.get("format") != STORE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported embedding store format: {index.get('format')}")
+        return index
+
+    def load(self):
+        """
+        Load the store. Returns (names, matrix, index) where matrix is a
+        read-only np.memmap of shape (N, D).
+        """
+        index = self.read_index()
+        count = index["count"]
+        dimension = index["dimension"] or 0
+        matrix_file = self._matrix_file(index["generation"])
+
+        if count == 0:
+            matrix = np.empty((0, dimension), dtype=np.float32)
+        else:
+            expected_size = count * dimension * 4
+            actual_size = os.path.getsize(matrix_file)
+            if actual_size < expected_size:
+                raise ValueError(
+                    f"Matrix file {matrix_file} is truncated ({actual_size} < {expected_size} bytes)"
+                )
+            matrix = np.memmap(matrix_file, dtype='<f4', mode='r', shape=(count, dimension))
+
+        return index["names"], matrix, index
+
+    def save(self, names, matrix, source_files=None, metadata=None):
+        """Write a new generation of the store and atomically publish it"""
+        os.makedirs(self.directory, exist_ok=True)
+        matrix = np.ascontiguousarray(matrix, dtype='<f4')
+        if len(names) != matrix.shape[0]:
+            raise ValueError(f"Got {len(names)} names for {matrix.shape[0]} embeddings")
+
+        previous_generation = None
+        if self.exists():
+            try:
+                previous_generation = self.read_index()["generation"]
+            except (ValueError, KeyError, json.JSONDecodeError):
+                pass
+        generation = (previous_generation or 0) + 1
+
+        _fsync_write(self._matrix_file(generation), lambda f: f.write(matrix.tobytes()))
+
+        index = {
+            "format": STORE_FORMAT_VERSION,
+            "generation": generation,
+            "dtype": "float32",
+            "count": len(names),
+            "dimension": int(matrix.shape[1]) if matrix.ndim == 2 and len(names) else None,
+            "metadata": {
+                "model": "FaceNet",
+                "normalization": "L2",
+                **(metadata or {})
+            },
+            "names": list(names),
+            "source_files": list(source_files) if source_files is not None else ["registered_live"] * len(names)
+        }
+        _fsync_write(self.index_file, lambda f: f.write(json.dumps(index, separators=(',', ':')).encode('utf-8')))
+
+        # Readers that still map the previous generation keep their pages until they let go
+        if previous_generation is not None and previous_generation != generation:
+            try:
+                os.remove(self._matrix_file(previous_generation))
+            except FileNotFoundError:
+                pass
+
+        return generation
+
+
+@contextmanager
+def _file_lock(path, exclusive=True):
+    """Advisory inter-process lock on a sidecar file (no-op where fcntl is unavailable)"""
+    if fcntl is None:
+        yield
+        return
+
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class StoreWatcher:
+    """
+    Polls an EmbeddingStore for newly published generations (create_embeddings.py,
+    compaction, another process) and calls on_change(generation) from a
+    background thread. Only the index file's stat is checked on each poll; the
+    index itself is read when that changes.
+    """
+
+    def __init__(self, store, on_change, interval=5.0):
+        self.store = store
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._signature = self._stat()
+        # Threads do not survive fork (gunicorn --preload): restart in the child
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._restart_after_fork)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.store.index_file)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except FileNotFoundError:
+            return None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="store-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def _restart_after_fork(self):
+        if self._thread is not None and not self._stop.is_set():
+            self.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                self.on_change(self.store.read_index().get("generation"))
+            except Exception as e:
+                logger.error(f"❌ Reload after store change failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+
+class RegistrationJournal:
+    """
+    Append-only log of registrations made since the last compaction.
+
+    Each record is a small binary header followed by the UTF-8 name and the
+    float32 embedding, written and fsync'd in one append, so registering an
+    identity costs O(1) disk I/O regardless of the gallery size. A record that
+    was torn by a crash fails its length or CRC check and is dropped, together
+    with anything after it, on the next replay.
+
+    Appends hold a shared lock and rotation an exclusive one, so several
+    worker processes can write to the same journal.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.compacting_path = f"{path}.compacting"
+        self.lock_path = f"{path}.lock"
+        self._lock = threading.Lock()
+        self.record_count = 0
+
+    def append(self, name, embedding):
+        """Durably append one registration record"""
+        name_bytes = name.encode('utf-8')
+        vector_bytes = np.ascontiguousarray(embedding, dtype='<f4').tobytes()
+        payload = name_bytes + vector_bytes
+        header = JOURNAL_HEADER.pack(JOURNAL_MAGIC, len(name_bytes), len(vector_bytes) // 4, zlib.crc32(payload))
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, _file_lock(self.lock_path, exclusive=False):
+            with open(self.path, 'ab') as f:
+                f.write(header + payload)
+                f.flush()
+                os.fsync(f.fileno())
+            self.record_count += 1
+
+    @staticmethod
+    def _read_records(path):
+        """Yield (name, embedding, end_offset) for each valid record in a journal file"""
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(JOURNAL_HEADER.size)
+                if len(header) < JOURNAL_HEADER.size:
+                    break
+                magic, name_length, dimension, checksum = JOURNAL_HEADER.unpack(header)
+                if magic != JOURNAL_MAGIC:
+                    break
+                payload = f.read(name_length + dimension * 4)
+                if len(payload) < name_length + dimension * 4 or zlib.crc32(payload) != checksum:
+                    break
+
+                name = payload[:name_length].decode('utf-8')
+                embedding = np.frombuffer(payload[name_length:], dtype='<f4')
+                yield name, embedding, f.tell()
+
+    def _replay_file(self, path):
+        records = []
+        valid_end = 0
+        for name, embedding, valid_end in self._read_records(path):
+            records.append((name, embedding))
+
+        if valid_end < os.path.getsize(path):
+            logger.warning(f"Discarding torn record at the end of {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(valid_end)
+        return records
+
+    def replay(self, include_compacting=True):
+        """
+        Return all (name, embedding) records, oldest first: an interrupted
+        compaction's journal followed by the live one. A torn tail is
+        truncated away.
+        """
+        paths = (self.compacting_path, self.path) if include_compacting else (self.path,)
+        records = []
+        with self._lock, _file_lock(self.lock_path):
+            for path in paths:
+                if os.path.exists(path):
+                    records.extend(self._replay_file(path))
+            self.record_count = len(records)
+        return records
+
+    def rotate(self):
+        """
+        Start a new, empty journal. Records written so far move to the
+        compacting journal until discard_compacted() is called.
+        """
+        with self._lock, _file_lock(self.lock_path):
+            if not os.path.exists(self.path):
+                pass
+            elif os.path.exists(self.compacting_path):
+                # A previous compaction did not finish: keep its records first
+                with open(self.compacting_path, 'ab') as dst, open(self.path, 'rb') as src:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.compacting_path)
+            self.record_count = 0
+
+    def compacting_records(self):
+        """Records of the journal currently being compacted"""
+        with self._lock, _file_lock(self.lock_path):
+            if not os.path.exists(self.compacting_path):
+                return []
+            return self._replay_file(self.compacting_path)
+
+    def discard_compacted(self):
+        """Drop the compacting journal once its records are in the main store"""
+        with self._lock, _file_lock(self.lock_path):
+            try:
+                os.remove(self.compacting_path)
+            except FileNotFoundError:
+                pass
+
+
+def compact_store(store, journal, json_file="database/embeddings.json", max_templates=1, eviction="oldest"):
+    """
+    Fold the journal into the main store: rotate the journal, apply its
+    records on top of the current store and publish a new store generation.
+    Templates are capped per identity as in Gallery.configure_templates.
+
+    Works from what is on disk rather than any process's in-memory gallery,
+    so registrations made by other workers are never lost. Registrations made
+    while compaction runs go to the fresh journal.
+    """
+    with store.lock():
+        journal.rotate()
+        records = journal.compacting_records()
+
+        if not store.exists() and os.path.exists(json_file):
+            # Seed from the legacy JSON gallery so it is not shadowed by the new store
+            convert_json_to_store(json_file, store)
+
+        if store.exists():
+            names, matrix, index = store.load()
+            source_files = list(index["source_files"])
+            metadata = index.get("metadata")
+        else:
+            names, matrix, source_files, metadata = [], np.empty((0, 0), dtype=np.float32), [], None
+
+        gallery = Gallery.from_matrix(names, matrix).configure_templates(max_templates, eviction)
+        for name, embedding in records:
+            gallery.add(name, embedding)
+
+        if records:
+            # One source per row, appended rows included, then only the templates still live
+            source_files += ["registered_live"] * (gallery.rows.shape[0] - len(source_files))
+            source_files = [source_files[position] for position in gallery.live_positions]
+            store.save(gallery.names, gallery.matrix, source_files=source_files, metadata=metadata)
+        journal.discard_compacted()
+
+    logger.info(f"✅ Compacted {len(records)} journal records into {store.index_file}")
+    return len(records)
+
+
+def convert_json_to_store(json_file="database/embeddings.json", store=None):
+    """Convert a legacy embeddings.json file into the binary store"""
+    store = store or EmbeddingStore()
+
+    with open(json_file, 'r') as f:
+        data = json.load(f)
+
+    if "embeddings" not in data:
+        raise ValueError("Invalid embeddings file format - missing 'embeddings' key")
+
+    names = []
+    rows = []
+    source_files = []
+    for person_name, person_data in data["embeddings"].items():
+        names.append(person_name)
+        rows.append(ensure_normalized(np.array(person_data["embedding"])).astype(np.float32))
+        source_files.append(person_data.get("source_file", "unknown"))
+
+    matrix = np.stack(rows) if rows else np.empty((0, 0), dtype=np.float32)
+    metadata = {key: value for key, value in data.get("metadata", {}).items()
+                if key not in ("total_ids", "embedding_dimension")}
+    store.save(names, matrix, source_files=source_files, metadata=metadata)
+
+    logger.info(f"✅ Converted {len(names)} embeddings from {json_file} to {store.index_file}")
+    return len(names)
+
+
+def export_store_to_json(json_file="database/embeddings.json", store=None):
+    """
+    Export the binary store back to the embeddings.json format, which holds
+    one embedding per ID: the latest template of each is exported.
+    """
+    store = store or EmbeddingStore()
+    names, matrix, index = store.load()
+
+    embeddings_data = {}
+    for position, person_name in enumerate(names):
+        embeddings_data[person_name] = {
+            "embedding": matrix[position].astype(np.float64).tolist(),
+            "source_file": index["source_files"][position]
+        }
+
+    final_data = {
+        "metadata": {
+            "total_ids": len(names),
+            "embedding_dimension": [index["dimension"]] if index["dimension"] else None,
+            **index.get("metadata", {})
+        },
+        "embeddings": embeddings_data
+    }
+
+    with open(json_file, 'w') as f:
+        json.dump(final_data, f, indent=2)
+
+    logger.info(f"✅ Exported {len(names)} embeddings to {json_file}")
+    return len(names)
+
+
+def main():
+    """Convert between embeddings.json and the binary store"""
+    usage = "Usage: python embedding_store.py [convert|export] [embeddings.json]"
+    if len(sys.argv) < 2 or sys.argv[1] not in ("convert", "export"):
+        print(usage)
+        return 1
+
+    json_file = sys.argv[2] if len(sys.argv) > 2 else "database/embeddings.json"
+    if sys.argv[1] == "convert":
+        convert_json_to_store(json_file)
+    else:
+        export_store_to_json(json_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
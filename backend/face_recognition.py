@@ -1,49 +1,206 @@
 import os
+import io
 import json
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 from PIL import Image, ExifTags
-from mtcnn.mtcnn import MTCNN
-from keras_facenet import FaceNet
 from numpy.linalg import norm
 import logging
+import threading
+import metrics
+from batching import MicroBatcher
+from embedding_cache import EmbeddingCache, SingleFlight
+from gallery import Gallery, VersionedGallery
+from ann_index import create_index
+from embedding_store import EmbeddingStore, RegistrationJournal, StoreWatcher, compact_store
+from inference_pool import RemoteDetector, RemoteEmbedder
+from embedders import create_embedder
+from detectors import CascadeDetector, check_mode
+from shards import connect_shards, shard_of
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Faces are detected on a copy of at most this many pixels per side (fast_decode)
+DETECTION_MAX_SIDE = 1024
+
 class FaceRecognitionSystem:
-    def __init__(self):
+    def __init__(self, index_type=None, inference_pool=None, load_database=True, detector=None, embedder=None,
+                 shard=None):
         self.logger = logging.getLogger(__name__)
 
+        # In a shard process (see shards.py): (shard, shard count). Only the IDs
+        # whose name hashes to this shard are loaded, and no models.
+        self.shard = shard
+
         self.threshold = 0.97
+
+        # Gallery search index: 'exact' (full matrix scan) or 'ivf' (approximate)
+        self.index_type = index_type or os.environ.get("FACE_GALLERY_INDEX", "exact")
+        # First-pass scan over 'float16' or 'int8' codes, re-scored exactly (None: float32)
+        self.quantization = os.environ.get("FACE_GALLERY_QUANTIZATION") or None
+        # Templates kept per ID (one per registered photo), which one a new photo
+        # evicts past the cap ('oldest' or 'redundant'), and how searches score
+        # an ID from them ('best', 'centroid' or 'centroid_prefilter')
+        self.max_templates = int(os.environ.get("FACE_MAX_TEMPLATES", "5"))
+        self.template_eviction = os.environ.get("FACE_TEMPLATE_EVICTION", "oldest")
+        self.template_aggregation = os.environ.get("FACE_TEMPLATE_AGGREGATION", "best")
+        
+        # With an inference pool, MTCNN and FaceNet only run in its worker processes.
+        # A detector and embedder can also be passed in (e.g. benchmark stubs).
+        self.inference_pool = inference_pool
+        if detector is not None and embedder is not None:
+            self.detector = detector
+            self.embedder = embedder
+        elif shard is not None:
+            # Faces are detected and embedded by the coordinator
+            self.detector = self.embedder = None
+        elif inference_pool is not None:
+            self.detector = RemoteDetector(inference_pool)
+            self.embedder = RemoteEmbedder(inference_pool)
+        else:
+            self.load_models()
+
+        # Single-face detection per endpoint (FACE_DETECTOR, FACE_DETECTOR_REGISTER, ...):
+        # 'mtcnn', or a Haar first pass with MTCNN on the region around its
+        # proposal ('cascade') or only when it is unsure ('haar'), see detectors.py.
+        # Crowd mode and video streams always run MTCNN on the whole frame.
+        self.detector_mode = check_mode(os.environ.get("FACE_DETECTOR", "mtcnn"))
+        self.detector_modes = {
+            endpoint: check_mode(os.environ.get(f"FACE_DETECTOR_{endpoint.upper()}", self.detector_mode))
+            for endpoint in ("register", "verify", "recognize")
+        }
+        self.cascade = CascadeDetector(self.detector, mode=self.detector_mode)
+
+        # Faces from concurrent requests are embedded together in one forward pass
+        self.max_batch_size = 32
+        self.max_batch_wait_ms = 2
+        # FaceNet batch sizes run once by warm_up so real requests never pay for graph setup
+        self.warmup_batch_sizes = (1, self.max_batch_size)
+        self.warm = False
+        self.embedding_batcher = MicroBatcher(
+            self.get_embeddings,
+            max_batch_size=self.max_batch_size,
+            max_wait_ms=self.max_batch_wait_ms,
+            name="facenet-batcher"
+        )
+        
+        # Detect on a reduced-size decode and crop the face from the full-resolution image
+        self.fast_decode = True
+        self.detection_max_side = DETECTION_MAX_SIDE
+
+        # Repeated uploads of the same bytes skip MTCNN and FaceNet entirely
+        self.required_size = (160, 160)
+        self.embedding_cache = EmbeddingCache(max_entries=4096, ttl_seconds=3600)
+        # Identical images in concurrent requests are detected and embedded once
+        self.in_flight = SingleFlight()
         
+        # Matrix-backed search gallery, published as immutable versioned snapshots
+        # that requests search without locking, and its on-disk store
+        gallery = self.configure_gallery(Gallery())
+        self.versions = VersionedGallery(gallery, create_index("exact", gallery))
+        self.store = EmbeddingStore("database")
+
+        # Registrations are appended to a journal and folded into the store in the background
+        self.journal = RegistrationJournal("database/embeddings.journal")
+        self.compact_after = 1000
+        self._compaction_thread = None
+
+        # Reloads build a new gallery and index aside and swap them in; the models stay loaded
+        self._reload_lock = threading.Lock()
+        self.database_version = 0
+        self.loaded_generation = None
+        self.store_watcher = None
+
+        # With FACE_SHARDS the gallery is partitioned across shard processes (a
+        # number of local ones, or host:port addresses of `python shards.py serve`)
+        # that are searched scatter-gather; they load the store themselves.
+        # Model-only systems (inference workers) have no gallery to shard.
+        self.shards = None
+        if shard is None and load_database and os.environ.get("FACE_SHARDS"):
+            self.shards = connect_shards(os.environ["FACE_SHARDS"])
+            self.versions = self.shards
+            load_database = False
+        
+        # Load embeddings from the binary store (or the legacy JSON file) plus the journal
+        if load_database:
+            self.load_database()
+
+    def load_models(self):
+        """Load the MTCNN detector and the FaceNet embedder (FACE_EMBEDDER backend) into this process"""
+        from mtcnn.mtcnn import MTCNN
+
         # Initialize MTCNN detector
         self.logger.info("Loading MTCNN model...")
         self.detector = MTCNN()
         self.logger.info("MTCNN model loaded.")
 
-        # Load FaceNet model
+        # Load FaceNet model: Keras, or an exported ONNX Runtime / TFLite model
         self.logger.info("Loading FaceNet model...")
-        self.embedder = FaceNet()
-        self.logger.info("FaceNet model loaded.")
-        
-        # Initialize embeddings dictionary
-        self.id_embeddings = {}
-        
-        # Load embeddings from JSON file
-        self.load_database()
+        self.embedder = create_embedder()
+        self.logger.info(f"FaceNet model loaded ({self.embedder.name}).")
+
+    def warm_up(self):
+        """
+        Run dummy forward passes through MTCNN and FaceNet (at each of
+        warmup_batch_sizes) so that the first real request is not slowed down
+        by lazy graph building and memory allocation.
+        """
+        if self.inference_pool is not None:
+            # Pool workers warm up their own models as they start
+            self.inference_pool.warm_up()
+        else:
+            self.logger.info("Warming up models...")
+            rng = np.random.default_rng(0)
+            side = min(self.detection_max_side, 640)
+            pixels = rng.integers(0, 255, (side, side, 3), dtype=np.uint8)
+            self.detector.detect_faces(pixels)
+            if any(mode != "mtcnn" for mode in (self.detector_mode, *self.detector_modes.values())):
+                self.cascade.fast_detector.detect_faces(pixels)
+            for batch_size in self.warmup_batch_sizes:
+                self.embedder.embeddings(list(np.zeros((batch_size, *self.required_size, 3), dtype=np.uint8)))
+            self.logger.info("✅ Models warmed up.")
+        self.warm = True
+
+    @property
+    def gallery(self):
+        """The current gallery snapshot"""
+        return self.versions.current.gallery
 
+    @property
+    def index(self):
+        """Search index of the current gallery snapshot"""
+        return self.versions.current.index
+
+    @property
+    def id_embeddings(self):
+        """Read-only {name: embedding} view of the gallery"""
+        return self.gallery
     
     def extract_face(self, filename, required_size=(160, 160)):
         """
         Extract face from image - EXACT copy from your Colab notebook
         """
-        if isinstance(filename, str):
-            image = Image.open(filename)
-        else:
-            # Handle file-like object
-            image = Image.open(filename)
+        face, _, _ = self.extract_face_and_box(filename, required_size)
+        return face
+
+    def extract_face_and_box(self, filename, required_size=(160, 160), detector=None):
+        """
+        extract_face, also returning the detected [x, y, width, height] box
+        and the detection path taken with the detector mode (default:
+        detector_mode)
+        """
+        if self.fast_decode:
+            return self.extract_face_fast(filename, required_size, detector)
+
+        with metrics.stage("decode"):
+            if isinstance(filename, str):
+                image = Image.open(filename)
+            else:
+                # Handle file-like object
+                image = Image.open(filename)
+            image.load()
 
         # Check and apply rotation based on EXIF data.
         # This block of code avoids the issue of rotation of images when being imported
@@ -66,11 +223,11 @@ class FaceRecognitionSystem:
 
         image = image.convert('RGB')
         pixels = np.asarray(image)
-        results = self.detector.detect_faces(pixels)
+        results, path = self.detect_single_face(pixels, detector)
 
         if not results:
             self.logger.warning("No face detected in the image")
-            return None
+            return None, None, path
 
         x1, y1, width, height = results[0]['box']
         x1, y1 = abs(x1), abs(y1)
@@ -78,15 +235,253 @@ class FaceRecognitionSystem:
 
         face = pixels[y1:y2, x1:x2]
         face = cv2.resize(face, required_size)
-        return face
+        return face, [int(x1), int(y1), int(width), int(height)], path
+
+    # Same rotations as extract_face: EXIF orientation -> Image.rotate angle
+    ORIENTATION_ANGLES = {3: 180, 6: 270, 8: 90}
+
+    @staticmethod
+    def _unrotate_box(box, orientation, size):
+        """Map an (x1, y1, x2, y2) box in the rotated frame back to the stored frame"""
+        x1, y1, x2, y2 = box
+        width, height = size
+        if orientation == 3:
+            return width - x2, height - y2, width - x1, height - y1
+        if orientation == 6:
+            return y1, height - x2, y2, height - x1
+        if orientation == 8:
+            return width - y2, x1, width - y1, x2
+        return box
+
+    def extract_face_fast(self, filename, required_size=(160, 160), detector=None):
+        """
+        Reduced-resolution variant of extract_face for large uploads. JPEGs
+        are decoded straight at 1/2, 1/4 or 1/8 scale (draft mode); MTCNN
+        runs on a copy of no more than detection_max_side pixels rotated per
+        EXIF, and only the face region is rotated and cropped, never the
+        whole frame (see crop_faces).
+        """
+        faces, path = self._detect_and_crop(
+            filename, required_size, self.detection_max_side, first_only=True, detector=detector
+        )
+        if not faces:
+            self.logger.warning("No face detected in the image")
+            return None, None, path
+
+        face, box, _ = faces[0]
+        return face, box, path
+
+    def extract_faces(self, filename, required_size=(160, 160), min_confidence=0.9):
+        """
+        Extract every face detected with at least min_confidence, for group
+        photos and camera frames. Returns a list of (face, box, confidence).
+        """
+        max_side = self.detection_max_side if self.fast_decode else None
+        faces, _ = self._detect_and_crop(filename, required_size, max_side, min_confidence=min_confidence)
+        return faces
+
+    def _detect_and_crop(self, filename, required_size, max_side, first_only=False, min_confidence=None,
+                         detector=None):
+        decoded = self.decode_for_detection(filename, max_side)
+        small = decoded[1]
+        if first_only:
+            results, path = self.detect_single_face(np.asarray(small), detector)
+            results = results[:1]
+        else:
+            results, path = self.detect_faces(np.asarray(small)), "mtcnn"
+            if min_confidence is not None:
+                results = [result for result in results if result.get('confidence', 1.0) >= min_confidence]
+        return self.crop_faces(decoded, results, required_size), path
+
+    @staticmethod
+    def decode_for_detection(filename, max_side=None):
+        """
+        Decode an image for detection, to be passed on to crop_faces. With
+        max_side, a JPEG is decoded in draft mode at the largest 1/2, 1/4 or
+        1/8 scale that is still above max_side. Returns (image, small,
+        orientation, full_size, filename): the decoded RGB image as stored,
+        an upright (EXIF-rotated) copy of at most max_side pixels to detect
+        on, the EXIF orientation and the stored size at full resolution.
+        """
+        with metrics.stage("decode"):
+            image = Image.open(filename)
+            try:
+                orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+            except Exception:
+                orientation = 1
+            angle = FaceRecognitionSystem.ORIENTATION_ANGLES.get(orientation)
+            full_size = image.size
+
+            scale = max_side / max(full_size) if max_side else 1.0
+            target = (max(1, round(full_size[0] * scale)), max(1, round(full_size[1] * scale)))
+            if scale < 1 and image.format == 'JPEG':
+                image.draft('RGB', target)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.load()
+
+        if scale < 1:
+            # Integer box-filter reduction first, then a small bilinear resize
+            factor = int(image.size[0] / target[0])
+            small = image.reduce(factor) if factor > 1 else image
+            if small.size != target:
+                small = small.resize(target, Image.BILINEAR)
+        else:
+            small = image
+
+        # Rotating the small detection copy is cheap
+        if angle is not None:
+            small = small.rotate(angle, expand=True)
+        return image, small, orientation, full_size, filename
+
+    @staticmethod
+    def crop_faces(decoded, results, required_size=(160, 160)):
+        """
+        Crop detections on the small copy of a decode_for_detection result.
+        A face is cropped from the decoded image if it is at least
+        required_size there; smaller faces of a draft-mode decode are cropped
+        from the image decoded again at full resolution. Returns a list of
+        (face, box, confidence), with boxes in the upright full-resolution
+        frame.
+        """
+        image, small, orientation, full_size, filename = decoded
+        angle = FaceRecognitionSystem.ORIENTATION_ANGLES.get(orientation)
+        if not results:
+            return []
+
+        rotated_size = full_size if angle in (None, 180) else (full_size[1], full_size[0])
+        scale_x = rotated_size[0] / small.size[0]
+        scale_y = rotated_size[1] / small.size[1]
+        # Decoded image pixels per full-resolution pixel (below 1 after a draft decode)
+        decoded_scale = image.size[0] / full_size[0]
+        full_image = None
+
+        faces = []
+        for result in results:
+            # Scale the box to the full-resolution (rotated) frame
+            x, y, width, height = result['box']
+            x, y = abs(x), abs(y)
+            x1 = min(int(round(x * scale_x)), rotated_size[0])
+            y1 = min(int(round(y * scale_y)), rotated_size[1])
+            x2 = min(int(round((x + width) * scale_x)), rotated_size[0])
+            y2 = min(int(round((y + height) * scale_y)), rotated_size[1])
+            if x2 <= x1 or y2 <= y1:
+                continue
+
+            # Crop the region in the stored frame, then rotate just the crop
+            region = FaceRecognitionSystem._unrotate_box((x1, y1, x2, y2), orientation if angle else 1, full_size)
+            if min(x2 - x1, y2 - y1) * decoded_scale >= min(required_size):
+                source = image
+                region = tuple(int(round(value * decoded_scale)) for value in region)
+            else:
+                if full_image is None:
+                    full_image = image if decoded_scale == 1 else FaceRecognitionSystem._decode_full(filename)
+                source = full_image
+            region = source.crop(region)
+            if angle is not None:
+                region = region.rotate(angle, expand=True)
+
+            face = cv2.resize(np.asarray(region), required_size)
+            faces.append((face, [x1, y1, x2 - x1, y2 - y1], float(result.get('confidence', 1.0))))
+
+        return faces
+
+    @staticmethod
+    def _decode_full(filename):
+        """Decode an image again at full resolution, for faces too small in its draft decode"""
+        with metrics.stage("decode"):
+            if hasattr(filename, 'seek'):
+                filename.seek(0)
+            image = Image.open(filename)
+            return image if image.mode == 'RGB' else image.convert('RGB')
+
+    def detect_faces(self, pixels):
+        """Run the face detector on an RGB array"""
+        with metrics.stage("detect"):
+            return self.detector.detect_faces(pixels)
+
+    def detect_single_face(self, pixels, detector=None):
+        """
+        Detect the face of a one-face photo with a detector mode ('mtcnn',
+        'cascade' or 'haar'; default: detector_mode). Returns (results, path).
+        """
+        with metrics.stage("detect"):
+            return self.cascade.detect(pixels, detector or self.detector_mode)
+
+    @property
+    def cache_config(self):
+        """Pipeline settings that change the result for the same image bytes"""
+        return "|".join([
+            type(self.detector).__name__,
+            "x".join(str(size) for size in self.required_size),
+            f"fast{self.detection_max_side}" if self.fast_decode else "full",
+            getattr(self.embedder, "name", type(self.embedder).__name__)
+        ])
+
+    def _read_upload(self, file):
+        if isinstance(file, str):
+            with open(file, 'rb') as f:
+                return f.read()
+        return file.read()
+
+    def embed_image(self, file, detector=None):
+        """
+        Detect and embed the face in an image (path or file-like object),
+        with a detector mode (default: detector_mode). Identical bytes seen
+        before are served from the embedding cache, and identical bytes being
+        processed for another request wait for its result. Returns (embedding, box,
+        path); embedding and box are None if no face was detected, and path
+        is the detection path that was taken.
+        """
+        detector = detector or self.detector_mode
+        data = self._read_upload(file)
+        key = self.embedding_cache.key(data, f"{self.cache_config}|{detector}")
+        cached = self.embedding_cache.get(key)
+        if cached is not None:
+            return cached
+
+        def compute():
+            embedding, box, path = self.embed_image_data(data, detector)
+            metrics.DETECTIONS.labels(path).inc()
+            if embedding is not None:
+                embedding.flags.writeable = False
+            self.embedding_cache.put(key, (embedding, box, path))
+            return embedding, box, path
+
+        return self.in_flight.do(key, compute)
+
+    def embed_image_data(self, data, detector=None):
+        """Uncached embed_image on raw image bytes"""
+        face, box, path = self.extract_face_data(data, detector)
+        embedding = np.asarray(self.get_embedding(face)) if face is not None else None
+        return embedding, box, path
+
+    def extract_face_data(self, data, detector=None):
+        """
+        extract_face_and_box on raw image bytes, in an inference worker when
+        there is a pool. The crop is embedded by the caller, so that crops of
+        concurrent requests share the micro-batcher's FaceNet calls.
+        """
+        if self.inference_pool is not None:
+            return self.inference_pool.extract_face(data, detector)
+        return self.extract_face_and_box(io.BytesIO(data), self.required_size, detector)
     
     def get_embedding(self, face_array):
         """
-        Generate embedding - EXACT copy from your Colab
+        Generate embedding - EXACT copy from your Colab, except that the face
+        is batched with faces from concurrent requests by the micro-batcher
         """
-        # Wrap in a list since .embeddings() expects a batch
-        embedding = self.embedder.embeddings([face_array])[0]
-        return embedding
+        if face_array is None:
+            raise ValueError("No face could be detected in the image.")
+        return self.embedding_batcher.submit(face_array)
+
+    def get_embeddings(self, face_arrays):
+        """Generate embeddings for a batch of faces in a single FaceNet call"""
+        if len(face_arrays) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        metrics.observe_batch("embed", len(face_arrays))
+        with metrics.stage("embed"):
+            return self.embedder.embeddings(list(face_arrays))
     
     def ensure_normalized(self, v, tolerance=1e-3):
         """
@@ -117,11 +512,355 @@ class FaceRecognitionSystem:
         is_match = distance < threshold
 
         return is_match, distance
+
+    def compare_embeddings_batch(self, embeddings1, embeddings2, threshold=None):
+        """
+        compare_embeddings for many pairs at once: row i of embeddings1 is
+        compared with row i of embeddings2. Returns (is_match, distance) arrays.
+        """
+        if threshold is None:
+            threshold = self.threshold
+
+        def normalize_rows(rows, tolerance=1e-3):
+            # Row-wise ensure_normalized: only rescale rows that are not unit length
+            rows = np.asarray(rows, dtype=np.float64)
+            lengths = norm(rows, axis=1, keepdims=True)
+            return np.where(np.abs(lengths - 1.0) < tolerance, rows, rows / lengths)
+
+        distances = norm(normalize_rows(embeddings1) - normalize_rows(embeddings2), axis=1)
+        return distances < threshold, distances
+
+    def embed_faces(self, file, min_confidence=0.9):
+        """
+        Detect every face in one image (crowd mode) and embed all crops in a
+        single FaceNet call. Returns a list of (embedding, box, confidence).
+        """
+        data = self._read_upload(file)
+        key = self.embedding_cache.key(data, f"{self.cache_config}|crowd{min_confidence}")
+        cached = self.embedding_cache.get(key)
+        if cached is not None:
+            return cached
+
+        def compute():
+            results = self.embed_faces_data(data, min_confidence)
+            for embedding, _, _ in results:
+                embedding.flags.writeable = False
+
+            self.embedding_cache.put(key, results)
+            return results
+
+        return self.in_flight.do(key, compute)
+
+    def embed_faces_data(self, data, min_confidence=0.9):
+        """Uncached embed_faces on raw image bytes"""
+        faces = self.extract_faces_data(data, min_confidence)
+        results = []
+        if faces:
+            embeddings = self.get_embeddings([face for face, _, _ in faces])
+            for (_, box, confidence), embedding in zip(faces, embeddings):
+                results.append((np.array(embedding), box, confidence))
+        return results
+
+    def embed_images(self, files, detector=None):
+        """
+        Detect a face in each image, then embed all detected faces in a single
+        FaceNet call. Cached images skip both steps, and images in flight in
+        another request wait for its result. Returns (embeddings,
+        errors, paths): one entry per image, with the embedding or None, None
+        or an error message, and the detection path taken (None on error).
+        """
+        detector = detector or self.detector_mode
+        embeddings, errors, paths = [], [], []
+        misses = []
+        for i, file in enumerate(files):
+            embeddings.append(None)
+            errors.append(None)
+            paths.append(None)
+            try:
+                data = self._read_upload(file)
+                key = self.embedding_cache.key(data, f"{self.cache_config}|{detector}")
+                cached = self.embedding_cache.get(key)
+                if cached is not None:
+                    embeddings[i], _, paths[i] = cached
+                else:
+                    misses.append((i, key, data))
+            except Exception as e:
+                self.logger.error(f"Face extraction error: {e}")
+                errors[i] = f'Could not process image: {e}'
+
+        # Images already in flight (in another request, or earlier in this
+        # batch) are waited for once this batch's own images are done
+        leading, following = [], []
+        for i, key, data in misses:
+            flight, leader = self.in_flight.begin(key)
+            if leader:
+                leading.append((i, key, data))
+            else:
+                following.append((i, flight))
+
+        if leading:
+            datas = [data for _, _, data in leading]
+            try:
+                results = self.embed_images_data(datas, detector)
+            except Exception as e:
+                for _, key, _ in leading:
+                    self.in_flight.finish(key, error=e)
+                raise
+            for (i, key, _), (embedding, box, error, path) in zip(leading, results):
+                if error is not None:
+                    errors[i] = error
+                    self.in_flight.finish(key, error=ValueError(error))
+                    continue
+                metrics.DETECTIONS.labels(path).inc()
+                if embedding is not None:
+                    embedding.flags.writeable = False
+                self.embedding_cache.put(key, (embedding, box, path))
+                self.in_flight.finish(key, (embedding, box, path))
+                embeddings[i] = embedding
+                paths[i] = path
+
+        for i, flight in following:
+            try:
+                embeddings[i], _, paths[i] = flight.wait()
+            except Exception as e:
+                errors[i] = str(e)
+
+        for i, embedding in enumerate(embeddings):
+            if embedding is None and errors[i] is None:
+                errors[i] = 'No face could be detected in the image.'
+
+        return embeddings, errors, paths
+
+    def embed_images_data(self, datas, detector=None):
+        """
+        Uncached embed_images on raw image bytes. Returns one (embedding,
+        box, error, path) per image.
+        """
+        results = []
+        pending = []
+        for i, (face, box, error, path) in enumerate(self.extract_images_data(datas, detector)):
+            results.append((None, None, error, path))
+            if face is not None:
+                pending.append((i, face, box, path))
+
+        if pending:
+            batch = self.get_embeddings([face for _, face, _, _ in pending])
+            for (i, _, box, path), embedding in zip(pending, batch):
+                results[i] = (np.array(embedding), box, None, path)
+
+        return results
+
+    def extract_faces_data(self, data, min_confidence=0.9):
+        """extract_faces on raw image bytes, in an inference worker when there is a pool"""
+        if self.inference_pool is not None:
+            return self.inference_pool.extract_faces(data, min_confidence)
+        return self.extract_faces(io.BytesIO(data), self.required_size, min_confidence)
+
+    def extract_images_data(self, datas, detector=None):
+        """
+        extract_face_and_box on each of several raw images, in one inference
+        worker job when there is a pool. Returns one (face, box, error, path)
+        per image.
+        """
+        if self.inference_pool is not None:
+            return self.inference_pool.extract_images(datas, detector)
+        results = []
+        for data in datas:
+            try:
+                face, box, path = self.extract_face_and_box(io.BytesIO(data), self.required_size, detector)
+                results.append((face, box, None, path))
+            except Exception as e:
+                self.logger.error(f"Face extraction error: {e}")
+                results.append((None, None, f'Could not process image: {e}', None))
+        return results
+
+    def configure_gallery(self, gallery):
+        """Apply the template cap, eviction policy and aggregation to a new gallery"""
+        return gallery.configure_templates(self.max_templates, self.template_eviction, self.template_aggregation)
+
+    def add_identity(self, name, embedding):
+        """
+        Add a template to an ID (evicting one past max_templates) by
+        publishing a new gallery version; concurrent calls are batched into one. Searches in progress keep
+        their snapshot. Returns the version that contains the ID.
+        """
+        return self.versions.add(name, embedding)
+
+    def register_identity(self, name, embedding):
+        """
+        Durably register an ID: append one fsync'd record to the journal, then
+        publish it in the in-memory gallery. With shards, the shard that owns
+        the ID journals it in its own database. Returns the gallery version
+        that contains the ID.
+        """
+        row = self.ensure_normalized(embedding).astype(np.float32)
+        with metrics.stage("save"):
+            if self.shards is not None:
+                return self.add_identity(name, row)
+            # Journaled first, so a reload that misses the new version replays it
+            self.journal.append(name, row)
+            version = self.add_identity(name, row)
+
+        if self.journal.record_count >= self.compact_after:
+            self.compact_database(background=True)
+        return version
+
+    def compact_database(self, background=False):
+        """Fold the registration journal into the binary store"""
+        if not background:
+            return compact_store(self.store, self.journal, max_templates=self.max_templates,
+                                 eviction=self.template_eviction)
+
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return None
+
+        def run():
+            try:
+                compact_store(self.store, self.journal, max_templates=self.max_templates,
+                              eviction=self.template_eviction)
+            except Exception as e:
+                self.logger.error(f"❌ Background compaction failed: {e}")
+
+        self._compaction_thread = threading.Thread(target=run, name="journal-compaction", daemon=True)
+        self._compaction_thread.start()
+        return None
+
+    def search_gallery(self, embedding, k=1, threshold=None, nprobe=None):
+        """
+        Find the k closest IDs to an embedding through the gallery index.
+        nprobe tunes the recall/latency trade-off of approximate indexes.
+        Returns a list of (name, distance, is_match) tuples, nearest first.
+        """
+        if threshold is None:
+            threshold = self.threshold
+
+        with metrics.stage("match"):
+            results = self.index.search(embedding, k, nprobe=nprobe)
+        return [(name, distance, distance < threshold) for name, distance in results]
+    
+    def search_gallery_batch(self, embeddings, k=1, threshold=None, nprobe=None):
+        """search_gallery for many embeddings, ranked with one matrix-matrix product"""
+        if threshold is None:
+            threshold = self.threshold
+
+        metrics.observe_batch("match", len(embeddings))
+        with metrics.stage("match"):
+            batch = self.index.search_batch(embeddings, k, nprobe=nprobe)
+        return [
+            [(name, distance, distance < threshold) for name, distance in results]
+            for results in batch
+        ]
     
     def load_database(self):
-        """Load ID embeddings from embeddings.json file"""
+        """
+        (Re)load ID embeddings, preferring the memory-mapped binary store over
+        embeddings.json, plus the registration journal. The new gallery and its
+        index are built aside while searches keep using the current ones, then
+        swapped in together; the models are never reloaded. Returns the number
+        of IDs loaded. With shards, each shard reloads its own part.
+        """
+        if self.shards is not None:
+            stats = self.shards.reload()
+            self.loaded_generation = stats[0]['generation']
+            self.database_version += 1
+            count = sum(shard['ids'] for shard in stats)
+            self.logger.info(f"Reloaded {len(stats)} gallery shards: {count} IDs (version {self.database_version})")
+            return count
+
+        with self._reload_lock:
+            gallery, generation = self.read_gallery()
+            self.configure_gallery(gallery)
+            records = self.read_journal()
+            for name, embedding in records:
+                gallery.add(name, embedding)
+            if records:
+                self.logger.info(f"Replayed {len(records)} journaled registrations")
+            gallery.quantize(self.quantization)
+            index = create_index(self.index_type, gallery)
+
+            with self.versions.write_lock:
+                # Catch up with registrations journaled while the new gallery was
+                # being built. Only the new records: replaying one that has been
+                # evicted since would evict a newer template.
+                for name, embedding in self.read_journal()[len(records):]:
+                    gallery.add(name, embedding)
+                index.add()
+                self.versions.publish(gallery, index)
+                self.loaded_generation = generation
+                self.database_version += 1
+
+        self.logger.info(
+            f"Gallery index: {self.index_type} over {len(gallery)} IDs, {gallery.template_count} templates "
+            f"(version {self.database_version})"
+        )
+        return len(gallery)
+
+    def read_gallery(self):
+        """
+        Build a new gallery from the store (or embeddings.json if there is no
+        store). Returns (gallery, store generation). A load that fails because
+        a save published a new generation meanwhile (and removed the one being
+        read) is retried once; any other store error is raised.
+        """
+        if not self.store.exists():
+            return self.load_json_database(), None
+
+        self.logger.info(f"Loading embeddings from {self.store.index_file}...")
+        generation = self.store.read_index().get("generation")
+        try:
+            names, matrix, index = self.store.load()
+        except (OSError, ValueError):
+            if self.store.read_index().get("generation") == generation:
+                raise
+            self.logger.info("Embedding store generation changed while loading, retrying...")
+            names, matrix, index = self.store.load()
+
+        if self.shard is not None:
+            # Copy this shard's rows out of the mapped store
+            rows = [position for position, name in enumerate(names) if self.owns(name)]
+            names, matrix = [names[position] for position in rows], np.asarray(matrix[rows])
+        gallery = Gallery.from_matrix(names, matrix)
+        self.logger.info(f"✅ Successfully mapped {len(gallery)} ID embeddings")
+        self.logger.info(f"Embedding dimension: {index.get('dimension')}")
+        self.logger.info(f"Model used: {index.get('metadata', {}).get('model')}")
+        return gallery, index.get("generation")
+
+    def build_index(self, gallery=None):
+        """(Re)build the configured search index over the current (or the given) gallery and publish it"""
+        gallery = self.gallery if gallery is None else self.configure_gallery(gallery)
+        self.versions.publish(gallery, create_index(self.index_type, gallery))
+        self.logger.info(f"Gallery index: {self.index_type} over {len(gallery)} IDs")
+
+    def owns(self, name):
+        """Whether this system holds the ID: always, unless it is one shard of a sharded gallery"""
+        return self.shard is None or shard_of(name, self.shard[1]) == self.shard[0]
+
+    def read_journal(self):
+        """Registrations that have not been compacted into the store yet"""
+        try:
+            return [(name, embedding) for name, embedding in self.journal.replay() if self.owns(name)]
+        except Exception as e:
+            self.logger.error(f"Error replaying registration journal: {e}")
+            return []
+
+    def watch_database(self, interval=5.0):
+        """Reload the gallery in the background whenever a new store generation is published"""
+        if self.store_watcher is None:
+            self.store_watcher = StoreWatcher(self.store, self._on_store_change, interval=interval)
+            self.store_watcher.start()
+        return self.store_watcher
+
+    def _on_store_change(self, generation):
+        if generation != self.loaded_generation:
+            self.logger.info(f"Embedding store generation {generation} published, reloading...")
+            self.load_database()
+
+    def load_json_database(self):
+        """Load ID embeddings from the legacy embeddings.json file into a new gallery"""
         
         embeddings_file = "database/embeddings.json"
+        id_embeddings = {}
+        gallery = Gallery()
         
         try:
             self.logger.info(f"Loading embeddings from {embeddings_file}...")
@@ -130,7 +869,7 @@ class FaceRecognitionSystem:
             if not os.path.exists(embeddings_file):
                 self.logger.warning(f"Embeddings file not found: {embeddings_file}")
                 self.logger.warning("Run create_embeddings.py to generate embeddings from ID photos")
-                return
+                return gallery
             
             # Load JSON data
             with open(embeddings_file, 'r') as f:
@@ -142,16 +881,19 @@ class FaceRecognitionSystem:
                 
                 # Convert each embedding back to numpy array
                 for person_name, person_data in embeddings_data.items():
+                    if not self.owns(person_name):
+                        continue
                     embedding_list = person_data["embedding"]
                     embedding_array = np.array(embedding_list)
                     
                     # Store in id_embeddings dictionary
-                    self.id_embeddings[person_name] = embedding_array
+                    id_embeddings[person_name] = embedding_array
                     
                     self.logger.debug(f"Loaded embedding for {person_name}: {embedding_array.shape}")
                 
-                self.logger.info(f"✅ Successfully loaded {len(self.id_embeddings)} ID embeddings")
-                self.logger.info(f"Loaded IDs: {list(self.id_embeddings.keys())}")
+                gallery = Gallery.from_embeddings(id_embeddings)
+                self.logger.info(f"✅ Successfully loaded {len(gallery)} ID embeddings")
+                self.logger.info("Run 'python embedding_store.py convert' to switch to the faster binary store")
                 
                 # Log metadata if available
                 if "metadata" in data:
@@ -174,33 +916,18 @@ class FaceRecognitionSystem:
             import traceback
             self.logger.error(traceback.format_exc())
 
+        return gallery
+
     def save_database(self):
-        """Save the current in-memory ID embeddings to the embeddings.json file."""
-        embeddings_file = "database/embeddings.json"
-        self.logger.info(f"Saving {len(self.id_embeddings)} embeddings to {embeddings_file}...")
-
-        # Prepare data for JSON serialization
-        embeddings_data_to_save = {}
-        for person_name, embedding_array in self.id_embeddings.items():
-            embeddings_data_to_save[person_name] = {
-                "embedding": embedding_array.tolist(),
-                "source_file": "registered_live" 
-            }
-
-        final_data = {
-            "metadata": {
-                "total_ids": len(self.id_embeddings),
-                "model": "FaceNet",
-                "normalization": "L2"
-            },
-            "embeddings": embeddings_data_to_save
-        }
+        """Save the current in-memory ID embeddings to the binary embedding store."""
+        gallery = self.gallery
+        self.logger.info(f"Saving {len(gallery)} embeddings to {self.store.index_file}...")
 
         try:
-            with open(embeddings_file, 'w') as f:
-                json.dump(final_data, f, indent=2)
-            self.logger.info("✅ Successfully saved embeddings file.")
+            with metrics.stage("save"):
+                self.store.save(gallery.names, gallery.matrix)
+            self.logger.info("✅ Successfully saved embedding store.")
             return True
         except Exception as e:
-            self.logger.error(f"❌ Failed to save embeddings file: {e}")
-            return False
\ No newline at end of file
+            self.logger.error(f"❌ Failed to save embedding store: {e}")
+            return False
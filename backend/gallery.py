@@ -0,0 +1,849 @@
+import copy
+import heapq
+import bisect
+import logging
+import itertools
+import threading
+from collections.abc import Mapping
+import numpy as np
+from numpy.linalg import norm
+from quantization import quantize_rows
+
+logger = logging.getLogger(__name__)
+
+# Squared-distance slack used when building the re-scoring shortlist. The
+# float32 scan is only used to rank candidates, so anything within this margin
+# of the k-th best is re-scored exactly before the final ordering is decided.
+SHORTLIST_MARGIN = 1e-4
+
+# Template eviction policies and aggregations (see Gallery.configure_templates)
+EVICTION_POLICIES = ("oldest", "redundant")
+AGGREGATIONS = ("best", "centroid", "centroid_prefilter")
+# Identities whose templates are re-scored per requested result, after the centroid scan
+CENTROID_PREFILTER = 16
+
+
+def ensure_normalized(v, tolerance=1e-3):
+    """Normalize vector (same rule as FaceRecognitionSystem.ensure_normalized)"""
+    length = norm(v)
+    if abs(length - 1.0) < tolerance:
+        return v
+    else:
+        return v / length
+
+
+class TemplateRows:
+    """
+    The first count template rows by position: a read-only base segment that
+    is never copied (e.g. the memory-mapped matrix of the store) followed by
+    the rows added in memory since. Indexing returns arrays like an (N, D)
+    matrix would; only a slice across both segments is joined into a copy.
+    """
+
+    def __init__(self, base, delta, count):
+        self.base = base
+        self.delta = delta
+        self.base_count = 0 if base is None else base.shape[0]
+        self.count = count
+        self.shape = (count, (base if base is not None else delta).shape[1])
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def segments(self):
+        """(first position, rows) of each non-empty segment"""
+        if self.base_count:
+            yield 0, self.base[:min(self.count, self.base_count)]
+        if self.count > self.base_count:
+            yield self.base_count, self.delta[:self.count - self.base_count]
+
+    def __getitem__(self, key):
+        base_count = self.base_count
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.count)
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            if stop <= base_count:
+                return self.base[start:stop]
+            if start >= base_count:
+                return self.delta[start - base_count:stop - base_count]
+            return np.concatenate((self.base[start:], self.delta[:stop - base_count]))
+        if isinstance(key, (int, np.integer)):
+            return self.base[key] if key < base_count else self.delta[key - base_count]
+
+        positions = np.asarray(key, dtype=np.int64)
+        if self.count <= base_count:
+            return self.base[positions]
+        if not base_count:
+            return self.delta[positions]
+        in_base = positions < base_count
+        rows = np.empty((positions.shape[0], self.shape[1]), dtype=np.float32)
+        rows[in_base] = self.base[positions[in_base]]
+        rows[~in_base] = self.delta[positions[~in_base] - base_count]
+        return rows
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:self.count], dtype=dtype)
+
+    def dot(self, probes32):
+        """rows . probe for one (D,) probe, or (P, count) products for (P, D) probes, segment by segment"""
+        scores = np.empty(probes32.shape[:-1] + (self.count,), dtype=np.float32)
+        for start, rows in self.segments():
+            if probes32.ndim == 1:
+                scores[start:start + rows.shape[0]] = rows @ probes32
+            else:
+                scores[:, start:start + rows.shape[0]] = probes32 @ rows.T
+        return scores
+
+
+class Gallery(Mapping):
+    """
+    ID embeddings kept as one contiguous, pre-normalized float32 matrix plus a
+    parallel array of names, so a 1:N search is a single matrix-vector product.
+
+    An identity can own several rows (templates, e.g. one per registered
+    photo), up to max_templates; adding one more evicts one of them according
+    to the eviction policy. Every row also carries its identity's number, so
+    a search still scans the matrix once and then keeps the best row of each
+    identity with a vectorized group reduction over the nearest rows. See
+    configure_templates() for the centroid aggregations.
+
+    The gallery is also a read-only {name: embedding} mapping over the
+    identities, giving each one's latest template. It can wrap a
+    memory-mapped matrix from the binary store without copying it: that
+    matrix stays the read-only base segment of the rows, and templates added
+    later go to an in-memory delta matrix that searches scan alongside it
+    (see TemplateRows).
+
+    After quantize('float16' or 'int8') the first-pass scan reads compact
+    codes instead of the float32 matrix. The shortlist is widened by a
+    per-probe bound on the quantization error, so the exactly re-scored
+    results are the same as without quantization, while the float32 rows of
+    a memory-mapped gallery are only paged in for the shortlist.
+
+    Once published (see VersionedGallery) a gallery is never modified:
+    extended() returns the next version, which may append rows to buffers it
+    shares with this one but never writes a row this one can see. Rows are
+    never rewritten: an evicted template stays in the matrix and is skipped by
+    the searches of the versions that evicted it, until the next reload.
+    """
+
+    def __init__(self, capacity=1024):
+        self._initial_capacity = max(1, int(capacity))
+        # Append-only, possibly shared with later versions: only the first
+        # _count rows and _identity_count identities belong to this gallery
+        self._names = []
+        self._count = 0
+        self._identities = []
+        self._identity_count = 0
+        # Name to identity number, each identity's first row, and the later
+        # rows of identities with several (shared; the lists only grow)
+        self._numbers = {}
+        self._first_rows = np.empty(0, dtype=np.int64)
+        self._more_rows = {}
+        # This version's evicted rows
+        self._dead = np.empty(0, dtype=np.int64)
+        # Original embeddings, used to re-score the shortlist exactly. None
+        # means the float32 rows themselves are the reference vectors.
+        self._vectors = []
+        # Read-only base rows (positions below _base_count, never written)
+        # and the appended rows after them, shared with later versions
+        self._base = None
+        self._base_count = 0
+        self._delta = None
+        self._sq_norms = None
+        # Identity number of each row, with the same capacity as the rows
+        self._labels = None
+        # Optional quantized copy of the rows for the first-pass scan
+        self._quantization = None
+        self._codes = None
+        self._codes_trained_on = 0
+
+        self.max_templates = 1
+        self.eviction = "oldest"
+        self.aggregation = "best"
+        # One mean template per identity, for the centroid aggregations
+        self._centroids = None
+        # (sorted names, how many identities they cover) for list_identities;
+        # later versions reuse it and only sort the identities they added
+        self._sorted_names = None
+
+    @classmethod
+    def from_embeddings(cls, id_embeddings):
+        """Build a gallery from a {name: embedding} mapping, keeping its order"""
+        gallery = cls(capacity=len(id_embeddings))
+        for name, embedding in id_embeddings.items():
+            gallery.add(name, embedding)
+        return gallery
+
+    @classmethod
+    def from_matrix(cls, names, matrix):
+        """
+        Wrap an existing (N, D) float32 matrix of normalized rows, e.g. a
+        read-only np.memmap, without copying it. Repeated names are several
+        templates of one identity.
+        """
+        if len(names) != matrix.shape[0]:
+            raise ValueError(f"Got {len(names)} names for {matrix.shape[0]} embeddings")
+
+        gallery = cls()
+        gallery._names = list(names)
+        gallery._count = len(gallery._names)
+        gallery._identities = None
+        gallery._numbers = None
+        gallery._vectors = None
+        if len(names):
+            gallery._base = matrix
+            gallery._base_count = matrix.shape[0]
+        return gallery
+
+    def __len__(self):
+        self._identity_index()
+        return self._identity_count
+
+    def __bool__(self):
+        # Identities are never evicted entirely, so no need to index them
+        return self._count > 0
+
+    def __iter__(self):
+        self._identity_index()
+        return itertools.islice(self._identities, self._identity_count)
+
+    def __contains__(self, name):
+        number = self._identity_index().get(name)
+        return number is not None and number < self._identity_count
+
+    def __getitem__(self, name):
+        position = self.position(name)
+        if position is None:
+            raise KeyError(name)
+        return self._reference(position)
+
+    def _identity_index(self):
+        """Name to identity number, built on first use for a wrapped matrix"""
+        if self._numbers is None:
+            count = self._count
+            numbers = {}
+            labels = np.array([numbers.setdefault(name, len(numbers)) for name in self._names[:count]], dtype=np.int32)
+            if len(numbers) == count:
+                first_rows, more_rows = np.arange(count), {}
+            else:
+                # Numbers are handed out in row order, so a row is its identity's first when it raises the maximum
+                first = np.ones(count, dtype=bool)
+                maxima = np.maximum.accumulate(labels)
+                first[1:] = maxima[1:] > maxima[:-1]
+                first_rows, more_rows = np.flatnonzero(first), {}
+                for position in np.flatnonzero(~first).tolist():
+                    more_rows.setdefault(int(labels[position]), []).append(position)
+
+            capacity = max(count, self._capacity, 1)
+            self._labels = np.empty(capacity, dtype=np.int32)
+            self._labels[:count] = labels
+            self._first_rows, self._more_rows = first_rows, more_rows
+            self._identities, self._identity_count = list(numbers), len(numbers)
+            self._numbers = numbers
+        return self._numbers
+
+    def _live_rows(self, name):
+        """Rows of an identity's templates in this version, oldest first"""
+        number = self._identity_index().get(name)
+        if number is None or number >= self._identity_count:
+            # Unknown, or added by a later version
+            return []
+        rows = [int(self._first_rows[number])]
+        more = self._more_rows.get(number)
+        if more:
+            rows += more[:bisect.bisect_left(more, self._count)]
+        if self._dead.size:
+            rows = [position for position, dead in zip(rows, np.isin(rows, self._dead)) if not dead]
+        return rows
+
+    def position(self, name):
+        """Row of an identity's latest template in this version, or None"""
+        rows = self._live_rows(name)
+        return rows[-1] if rows else None
+
+    def templates(self, name):
+        """Embeddings of an identity's templates, oldest first"""
+        return [self._reference(position) for position in self._live_rows(name)]
+
+    def list_identities(self, prefix="", after=None, limit=100):
+        """
+        Up to limit identity names in sorted order that start with prefix and
+        sort after the cursor `after` (the last name of the previous page).
+        Returns (names, whether more follow). The sorted names are kept for
+        later versions, so a page costs O(log N + limit) plus sorting the
+        identities added since the last full sort.
+        """
+        self._identity_index()
+        count = self._identity_count
+        sorted_names, sorted_count = self._sorted_names or ([], 0)
+        if count - sorted_count > max(1024, sorted_count // 8):
+            sorted_names, sorted_count = sorted(itertools.islice(self._identities, count)), count
+            self._sorted_names = (sorted_names, sorted_count)
+        added = sorted(self._identities[sorted_count:count])
+
+        def tail(names):
+            if after is not None and after >= prefix:
+                start = bisect.bisect_right(names, after)
+            else:
+                start = bisect.bisect_left(names, prefix)
+            return (names[position] for position in range(start, len(names)))
+
+        page = []
+        for name in heapq.merge(tail(sorted_names), tail(added)):
+            if not name.startswith(prefix) or len(page) == limit:
+                return page, len(page) == limit and name.startswith(prefix)
+            page.append(name)
+        return page, False
+
+    @property
+    def names(self):
+        """Identity of each template row, parallel to matrix (repeated for several templates)"""
+        names = self._names[:self._count]
+        if self._dead.size:
+            dead = set(self._dead.tolist())
+            names = [name for position, name in enumerate(names) if position not in dead]
+        return names
+
+    @property
+    def template_count(self):
+        return self._count - self._dead.size
+
+    @property
+    def live_positions(self):
+        """Positions of the rows in matrix (those that were not evicted)"""
+        positions = np.arange(self._count)
+        if self._dead.size:
+            positions = np.delete(positions, self._dead)
+        return positions
+
+    @property
+    def dimension(self):
+        if self._base is not None:
+            return self._base.shape[1]
+        if self._delta is not None:
+            return self._delta.shape[1]
+        return None
+
+    @property
+    def _capacity(self):
+        """Positions the base and the delta matrix have room for"""
+        return self._base_count + (0 if self._delta is None else self._delta.shape[0])
+
+    @property
+    def matrix(self):
+        """The (N, D) float32 template rows, parallel to names"""
+        if self.dimension is None:
+            return np.empty((0, 0), dtype=np.float32)
+        if self._dead.size:
+            return self.rows[self.live_positions]
+        return self.rows[:self._count]
+
+    @property
+    def rows(self):
+        """Every row of this version by position, including evicted ones (for indexes)"""
+        if self.dimension is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return TemplateRows(self._base, self._delta, self._count)
+
+    def configure_templates(self, max_templates=1, eviction="oldest", aggregation="best"):
+        """
+        Keep up to max_templates per identity, evicting the 'oldest' or the
+        most 'redundant' one (the older of the two most similar templates)
+        when another is added. Identities over a lowered cap are trimmed now.
+
+        aggregation decides how an identity is scored: 'best' is its closest
+        template, 'centroid' the distance to the normalized mean of its
+        templates (one row per identity to scan), and 'centroid_prefilter'
+        scans the means first, then scores every template of the
+        CENTROID_PREFILTER * k closest identities. The centroid aggregations
+        scan the means in full and ignore the candidates of an IVF index.
+        Only for galleries that have not been published.
+        """
+        if int(max_templates) < 1:
+            raise ValueError(f"max_templates must be at least 1, got {max_templates}")
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown template eviction policy: {eviction}")
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown template aggregation: {aggregation}")
+        self.max_templates = int(max_templates)
+        self.eviction = eviction
+        self.aggregation = aggregation
+
+        if len(self) < self.template_count:
+            evicted = []
+            for number, more in list(self._more_rows.items()):
+                if len(more) >= self.max_templates:
+                    evicted.extend(self._evict(self._live_rows(self._identities[number])))
+            if evicted:
+                self._dead = np.append(self._dead, evicted)
+
+        self._centroids = None if aggregation == "best" else self._build_centroids()
+        return self
+
+    def _evict(self, rows):
+        """Remove templates from rows (oldest first) down to the cap; returns the evicted rows"""
+        evicted = []
+        while len(rows) > self.max_templates:
+            if self.eviction == "oldest":
+                victim = rows[0]
+            else:
+                # The older of the two most similar templates adds the least
+                templates = np.asarray(self.rows[rows], dtype=np.float32)
+                similarity = templates @ templates.T
+                np.fill_diagonal(similarity, -np.inf)
+                first, second = np.unravel_index(np.argmax(similarity), similarity.shape)
+                victim = rows[min(first, second)]
+            rows.remove(victim)
+            evicted.append(victim)
+        return evicted
+
+    def _build_centroids(self):
+        """A gallery of one normalized mean template per identity"""
+        names = list(self)
+        if len(names) == self.template_count:
+            # One template each: the templates are their own means
+            return Gallery.from_matrix(self.names, self.matrix)
+
+        positions = self.live_positions
+        labels = self._labels[positions]
+        centroids = np.empty((len(names), self.dimension), dtype=np.float32)
+        single = np.bincount(labels, minlength=len(names))[labels] == 1
+        centroids[labels[single]] = self.rows[positions[single]]
+
+        # Sum the templates of each identity that has several in one reduction
+        positions, labels = positions[~single], labels[~single]
+        order = np.argsort(labels, kind='stable')
+        positions, labels = positions[order], labels[order]
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        sums = np.add.reduceat(np.asarray(self.rows[positions], dtype=np.float64), starts, axis=0)
+        centroids[labels[starts]] = sums / norm(sums, axis=1, keepdims=True)
+        return Gallery.from_matrix(names, centroids)
+
+    def _update_centroid(self, name, rows):
+        total = np.asarray(self.rows[rows], dtype=np.float64).sum(axis=0)
+        self._centroids.add(name, total / norm(total))
+
+    @property
+    def quantization(self):
+        return self._quantization
+
+    def quantize(self, kind):
+        """Scan a quantized copy of the rows ('float16' or 'int8'); None scans the float32 matrix"""
+        self._quantization = None if kind in (None, "none", "float32") else kind
+        self._codes = None
+        if self._quantization is not None and self._count:
+            self._train_codes()
+        return self
+
+    def _train_codes(self):
+        self._codes = quantize_rows(self._quantization, self.rows, capacity=self._capacity)
+        self._codes_trained_on = self._count
+
+    @property
+    def scan_nbytes(self):
+        """Bytes read by a full first-pass scan"""
+        if self._codes is not None:
+            return self._count * self._codes.codes.itemsize * self._codes.codes.shape[1]
+        return self.rows.nbytes
+
+    def _squared_norms(self):
+        # Computed lazily so wrapping a memory-mapped matrix stays O(1)
+        count = self._count
+        if self._sq_norms is None or self._sq_norms.shape[0] < count:
+            sq_norms = np.empty(max(count, self._capacity), dtype=np.float32)
+            for start, rows in self.rows.segments():
+                sq_norms[start:start + rows.shape[0]] = np.einsum('ij,ij->i', rows, rows)
+            self._sq_norms = sq_norms
+        return self._sq_norms[:count]
+
+    def _reserve(self, dimension):
+        count = self._count
+        if self.dimension is None:
+            self._delta = np.empty((self._initial_capacity, dimension), dtype=np.float32)
+            self._sq_norms = np.empty(self._initial_capacity, dtype=np.float32)
+            self._labels = np.empty(self._initial_capacity, dtype=np.int32)
+            return
+
+        if self.dimension != dimension:
+            raise ValueError(
+                f"Embedding dimension {dimension} does not match gallery dimension {self.dimension}"
+            )
+
+        if count == self._capacity:
+            # Grow the delta geometrically so repeated registrations stay
+            # amortized O(1); the base rows are never copied, only their
+            # norms and labels
+            sq_norms = self._squared_norms()
+            delta_count = count - self._base_count
+            delta = np.empty((max(self._initial_capacity, delta_count * 2), dimension), dtype=np.float32)
+            if delta_count:
+                delta[:delta_count] = self._delta[:delta_count]
+            new_capacity = self._base_count + delta.shape[0]
+            new_sq_norms = np.empty(new_capacity, dtype=np.float32)
+            new_sq_norms[:count] = sq_norms
+            labels = np.empty(new_capacity, dtype=np.int32)
+            labels[:count] = self._labels[:count]
+            self._delta, self._sq_norms, self._labels = delta, new_sq_norms, labels
+
+    def extended(self, records):
+        """
+        The next version of this gallery, with (name, embedding) templates
+        added; this gallery stays unchanged for its readers. New rows go into
+        the spare capacity of the delta matrix shared with this version, which
+        never reads past its own count, so the delta is only copied when it
+        is full and the base rows never are.
+        """
+        # Build the lazy structures once, before they are shared
+        self._identity_index()
+        if self.dimension is not None:
+            self._squared_norms()
+
+        gallery = copy.copy(self)
+        if self._centroids is not None:
+            gallery._centroids = self._centroids.extended([])
+        for name, embedding in records:
+            gallery.add(name, embedding)
+        return gallery
+
+    def _detach(self):
+        """Take private copies of the buffers shared with other versions"""
+        count = self._count
+        self._names = self._names[:count]
+        identity_count = self._identity_count
+        self._identities = self._identities[:identity_count]
+        self._numbers = {name: number for name, number in self._numbers.items() if number < identity_count}
+        first_rows = np.empty(max(2 * identity_count, 16), dtype=np.int64)
+        first_rows[:identity_count] = self._first_rows[:identity_count]
+        self._first_rows = first_rows
+        self._more_rows = {
+            number: more[:bisect.bisect_left(more, count)]
+            for number, more in self._more_rows.items() if number < identity_count
+        }
+        if self._vectors is not None:
+            self._vectors = self._vectors[:count]
+        if self.dimension is not None:
+            sq_norms = self._squared_norms()
+            if self._delta is not None:
+                # The base rows are read-only, so only the delta is shared
+                delta_count = count - self._base_count
+                delta = np.empty((max(self._delta.shape[0], delta_count + 1), self._delta.shape[1]), dtype=np.float32)
+                delta[:delta_count] = self._delta[:delta_count]
+                self._delta = delta
+            capacity = max(self._capacity, count + 1)
+            self._sq_norms = np.empty(capacity, dtype=np.float32)
+            self._sq_norms[:count] = sq_norms
+            labels = np.empty(capacity, dtype=np.int32)
+            labels[:count] = self._labels[:count]
+            self._labels = labels
+        if self._codes is not None:
+            self._train_codes()
+
+    def add(self, name, embedding):
+        """
+        Add a template to an identity, creating the identity if needed. Past
+        max_templates, one of its templates is evicted. A template equal to
+        one the identity already has is ignored, so replaying a journal
+        record twice is harmless. Only for galleries that have not been
+        published; use extended() (through VersionedGallery) for those.
+        """
+        embedding = np.asarray(embedding)
+        row = ensure_normalized(embedding).astype(np.float32)
+        self._identity_index()
+        if len(self._names) != self._count:
+            # Another version has appended to the shared buffers since this one was made
+            self._detach()
+        self._reserve(row.shape[0])
+
+        rows = self._live_rows(name)
+        if any(np.array_equal(self._row(position), row) for position in rows):
+            return
+
+        position = self._count
+        if rows:
+            label = self._labels[rows[0]]
+            self._more_rows.setdefault(int(label), []).append(position)
+        else:
+            label = self._identity_count
+            if label == self._first_rows.shape[0]:
+                first_rows = np.empty(max(2 * label, 16), dtype=np.int64)
+                first_rows[:label] = self._first_rows[:label]
+                self._first_rows = first_rows
+            self._first_rows[label] = position
+            self._identities.append(name)
+            self._numbers[name] = label
+            self._identity_count += 1
+        self._names.append(name)
+        if self._vectors is not None:
+            self._vectors.append(embedding)
+        self._delta[position - self._base_count] = row
+        self._sq_norms[position] = np.dot(row, row)
+        self._labels[position] = label
+        self._count += 1
+
+        rows.append(position)
+        evicted = self._evict(rows)
+        if evicted:
+            self._dead = np.append(self._dead, evicted)
+
+        if self._quantization is not None:
+            # Re-fit the quantizer whenever the gallery has doubled (amortized O(1))
+            if self._codes is None or self._count >= 2 * self._codes_trained_on:
+                self._train_codes()
+            else:
+                self._codes.set(position, row)
+
+        if self._centroids is not None:
+            self._update_centroid(name, rows)
+
+    def search(self, embedding, k=1, candidates=None):
+        """
+        Return the k closest identities as a list of (name, distance) pairs,
+        nearest first. Distances are identical to compare_embeddings (against
+        the best template, or the centroid; see configure_templates).
+
+        candidates optionally restricts the scan to an array of row positions,
+        e.g. the inverted lists picked by an approximate index.
+        """
+        count = self._count
+        if count == 0 or k < 1:
+            return []
+
+        if self._centroids is not None:
+            if self.aggregation == "centroid":
+                return self._centroids.search(embedding, k)
+            candidates = self._prefilter(embedding, k)
+
+        probe = ensure_normalized(np.asarray(embedding))
+        if candidates is not None:
+            candidates = np.asarray(candidates, dtype=np.int64)
+            if candidates.size == 0:
+                return []
+
+        sq_distances, margin = self.approximate_sq_distances(probe, candidates)
+        return self._rescore(probe, sq_distances, k, candidates, margin)
+
+    def _prefilter(self, embedding, k):
+        """Rows of every template of the identities with the closest centroids"""
+        nearest = self._centroids.search(embedding, k * CENTROID_PREFILTER)
+        return np.array([position for name, _ in nearest for position in self._live_rows(name)], dtype=np.int64)
+
+    def approximate_sq_distances(self, probe, candidates=None):
+        """
+        First-pass squared distances from a normalized probe to every row (or
+        to the candidate rows), plus the shortlist margin that guarantees the
+        exact top-k survives re-scoring.
+        """
+        count = self._count
+        probe32 = np.asarray(probe, dtype=np.float32)
+
+        # ||g - q||^2 = ||g||^2 - 2 g.q + ||q||^2, one BLAS gemv for the whole gallery
+        sq_norms = self._squared_norms()
+        if self._codes is not None:
+            dots = self._codes.dot(probe32, count, candidates)
+            # |true - approximate| <= 2 * error on each side of the k-th distance
+            margin = SHORTLIST_MARGIN + 4.0 * float(self._codes.error_bound(probe32))
+        elif candidates is None:
+            dots = self.rows.dot(probe32)
+            margin = SHORTLIST_MARGIN
+        else:
+            dots = self.rows[candidates] @ probe32
+            margin = SHORTLIST_MARGIN
+
+        sq_distances = (sq_norms if candidates is None else sq_norms[candidates]) - 2.0 * dots
+        sq_distances += np.dot(probe32, probe32)
+        if self._dead.size:
+            # Evicted templates
+            if candidates is None:
+                sq_distances[self._dead] = np.inf
+            else:
+                sq_distances[np.isin(candidates, self._dead)] = np.inf
+        return sq_distances, margin
+
+    def search_batch(self, embeddings, k=1, chunk_size=256):
+        """
+        search() for many probes at once: the whole batch is ranked with one
+        matrix-matrix product per chunk of probes.
+        """
+        count = self._count
+        if count == 0 or k < 1:
+            return [[] for _ in embeddings]
+
+        if self._centroids is not None:
+            if self.aggregation == "centroid":
+                return self._centroids.search_batch(embeddings, k, chunk_size)
+            # Each probe re-scores the templates of its own identities
+            return [self.search(embedding, k) for embedding in embeddings]
+
+        probes = [ensure_normalized(np.asarray(embedding)) for embedding in embeddings]
+        results = []
+        sq_norms = self._squared_norms()
+        for start in range(0, len(probes), chunk_size):
+            chunk = probes[start:start + chunk_size]
+            probes32 = np.stack(chunk).astype(np.float32)
+            if self._codes is not None:
+                dots = self._codes.dot_batch(probes32, count)
+                margins = SHORTLIST_MARGIN + 4.0 * self._codes.error_bound(probes32)
+            else:
+                dots = self.rows.dot(probes32)
+                margins = np.full(len(chunk), SHORTLIST_MARGIN)
+            sq_distances = sq_norms[None, :] - 2.0 * dots
+            sq_distances += np.einsum('ij,ij->i', probes32, probes32)[:, None]
+            if self._dead.size:
+                sq_distances[:, self._dead] = np.inf
+            for probe, row, margin in zip(chunk, sq_distances, margins):
+                results.append(self._rescore(probe, row, k, margin=float(margin)))
+        return results
+
+    def _kth_distance(self, sq_distances, k, candidates=None):
+        """
+        Approximate squared distance of the k-th closest identity. An identity
+        has at most max_templates rows, so the best row of each of the k
+        closest is among the k * max_templates nearest rows, where one group
+        reduction over their identity numbers finds it.
+        """
+        count = sq_distances.shape[0]
+        nearest_count = min(k * self.max_templates, count)
+        if nearest_count < count:
+            nearest = np.argpartition(sq_distances, nearest_count - 1)[:nearest_count]
+        else:
+            nearest = np.arange(count)
+        if self.max_templates == 1:
+            return sq_distances[nearest].max()
+
+        self._identity_index()
+        labels = self._labels[nearest if candidates is None else candidates[nearest]]
+        distances = sq_distances[nearest]
+        # Sort by (identity, distance) and keep the first row of each identity
+        order = np.lexsort((distances, labels))
+        labels, distances = labels[order], distances[order]
+        best = distances[np.r_[True, labels[1:] != labels[:-1]]]
+        k = min(k, best.size)
+        return np.partition(best, k - 1)[k - 1]
+
+    def _rescore(self, probe, sq_distances, k, candidates=None, margin=SHORTLIST_MARGIN):
+        """Shortlist from approximate squared distances, then re-score exactly per identity"""
+        keep = sq_distances <= self._kth_distance(sq_distances, k, candidates) + margin
+        if self._dead.size:
+            keep &= np.isfinite(sq_distances)
+        shortlist = np.flatnonzero(keep)
+        if candidates is not None:
+            shortlist = candidates[shortlist]
+
+        # Exact re-scoring with the same float64 arithmetic as compare_embeddings,
+        # keeping the best template of each identity
+        best = {}
+        for position in shortlist:
+            distance = norm(probe - ensure_normalized(self._reference(position)))
+            name = self._names[position]
+            if distance < best.get(name, np.inf):
+                best[name] = distance
+
+        return sorted(best.items(), key=lambda item: item[1])[:k]
+
+    def _row(self, position):
+        if position < self._base_count:
+            return self._base[position]
+        return self._delta[position - self._base_count]
+
+    def _reference(self, position):
+        if self._vectors is not None:
+            return self._vectors[position]
+        return self._row(position)
+
+
+class GallerySnapshot:
+    """One published version of the gallery and its search index; never modified"""
+
+    def __init__(self, gallery, index, version):
+        self.gallery = gallery
+        self.index = index
+        self.version = version
+
+
+class VersionedGallery:
+    """
+    The current GallerySnapshot, replaced as a whole on every write.
+
+    Readers take `current` (a single attribute read, no lock) and can keep
+    searching it for as long as they like. Writers never touch a published
+    snapshot: add() queues its record and whichever writer gets the write
+    lock first applies every queued record in one new version, so a burst of
+    concurrent registrations is published once.
+    """
+
+    def __init__(self, gallery, index):
+        self.current = GallerySnapshot(gallery, index, 0)
+        # Held while a new version is built and published (reentrant for reloads)
+        self.write_lock = threading.RLock()
+        self._queue_lock = threading.Lock()
+        self._pending = []
+        self._tickets = itertools.count(1)
+        self._applied = 0
+        self._errors = {}
+
+        self.batches = 0
+        self.records = 0
+
+    def add(self, name, embedding):
+        """Add one template to an identity; returns the version that contains it"""
+        with self._queue_lock:
+            ticket = next(self._tickets)
+            self._pending.append((ticket, name, embedding))
+
+        with self.write_lock:
+            if self._applied < ticket:
+                self._apply_pending()
+            error = self._errors.pop(ticket, None)
+            version = self.current.version
+        if error is not None:
+            raise error
+        return version
+
+    def _apply_pending(self):
+        with self._queue_lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        current = self.current
+        try:
+            gallery, index = self._extend(current, [(name, embedding) for _, name, embedding in batch])
+        except Exception:
+            # One bad record must not fail the registrations batched with it
+            gallery, index = current.gallery, current.index
+            for ticket, name, embedding in batch:
+                try:
+                    gallery, index = self._extend(GallerySnapshot(gallery, index, None), [(name, embedding)])
+                except Exception as e:
+                    self._errors[ticket] = e
+
+        self.current = GallerySnapshot(gallery, index, current.version + 1)
+        self._applied = batch[-1][0]
+        self.batches += 1
+        self.records += len(batch)
+
+    @staticmethod
+    def _extend(snapshot, records):
+        gallery = snapshot.gallery.extended(records)
+        index = snapshot.index.extended(gallery, [name for name, _ in records])
+        return gallery, index
+
+    def publish(self, gallery, index):
+        """Replace the whole gallery, e.g. after a reload from the store"""
+        with self.write_lock:
+            self.current = GallerySnapshot(gallery, index, self.current.version + 1)
+            return self.current.version
+
+    def stats(self):
+        return {
+            'version': self.current.version,
+            'batches': self.batches,
+            'records': self.records
+        }
@@ -0,0 +1,29 @@
+import os
+
+# Gunicorn settings, used by the Dockerfile: gunicorn --config gunicorn.conf.py app:app
+bind = "0.0.0.0:5000"
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+# Request threads let the FaceNet micro-batcher combine concurrent requests into one forward pass
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = 300
+
+# With PRELOAD_MODELS=1, importing app loads MTCNN and FaceNet. Importing it once in the
+# master before forking lets every worker share the weights copy-on-write. Inference pool
+# processes are spawned rather than forked, so with INFERENCE_WORKERS > 0 each gunicorn
+# worker imports (and starts its pool) itself.
+preload_app = (
+    os.environ.get("PRELOAD_MODELS", "0") == "1"
+    and int(os.environ.get("INFERENCE_WORKERS", "0")) == 0
+)
+
+# TensorFlow's thread pools do not survive a fork once they have run a graph, so a
+# preloading master never runs the models: each worker runs the warm-up passes itself,
+# right after the fork and before it accepts requests.
+if preload_app:
+    os.environ["WARM_UP_AFTER_FORK"] = "1"
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+        app.warm_up_models()
@@ -0,0 +1,352 @@
+import os
+import io
+import csv
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+import numpy as np
+from detectors import DETECTOR_MODES
+from create_embeddings import IMAGE_EXTENSIONS
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ('csv', 'jsonl')
+OUTPUT_FIELDS = ('file', 'name', 'distance', 'detector', 'box', 'candidates', 'error')
+
+# Closes a stage's input queue: one per thread of the stage
+_DONE = object()
+
+
+def list_probes(probe_dir):
+    """Probe photos under probe_dir (recursively), as sorted paths relative to it"""
+    probes = []
+    for root, _, filenames in os.walk(probe_dir):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                probes.append(os.path.relpath(os.path.join(root, filename), probe_dir).replace(os.sep, '/'))
+    return sorted(probes)
+
+
+def output_format_of(output_file):
+    return 'csv' if output_file.lower().endswith('.csv') else 'jsonl'
+
+
+def completed_probes(output_file, output_format):
+    """
+    Probes already in the output of an earlier run. A last line cut short by
+    an interruption is truncated, so that appending resumes cleanly.
+    """
+    if not os.path.exists(output_file):
+        return set()
+
+    with open(output_file, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            logger.warning(f"Dropping an incomplete last line from {output_file}")
+            f.truncate(end)
+            data = data[:end]
+
+    text = data.decode('utf-8')
+    if output_format == 'csv':
+        return {row['file'] for row in csv.DictReader(io.StringIO(text))}
+    return {json.loads(line)['file'] for line in text.splitlines() if line.strip()}
+
+
+class ResultWriter:
+    """Appends result rows to a CSV or JSONL file, flushed after every batch"""
+
+    def __init__(self, output_file, output_format):
+        self.output_format = output_format
+        new_file = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
+        self.file = open(output_file, 'a', encoding='utf-8', newline='')
+        if output_format == 'csv':
+            self.writer = csv.DictWriter(self.file, fieldnames=OUTPUT_FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            if self.output_format == 'csv':
+                # Lists as JSON, so every row stays one line
+                self.writer.writerow({
+                    **row,
+                    'box': json.dumps(row['box']) if row['box'] is not None else '',
+                    'candidates': json.dumps(row['candidates']) if row['candidates'] else ''
+                })
+            else:
+                self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def result_row(probe, candidates=None, box=None, detection=None, error=None):
+    """One output row, with the best match under the threshold as /recognize reports it"""
+    row = {'file': probe, 'name': None, 'distance': None, 'detector': detection, 'box': box,
+           'candidates': None, 'error': error}
+    if candidates:
+        name, distance, is_match = candidates[0]
+        row['name'] = name if is_match else "Unknown"
+        row['distance'] = float(distance) if is_match else None
+        row['candidates'] = [
+            {'name': name, 'distance': float(distance), 'match': bool(is_match)}
+            for name, distance, is_match in candidates
+        ]
+    return row
+
+
+def _put(items, item, stop):
+    """Queue.put that gives up once the pipeline is stopped"""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(items, stop):
+    """Queue.get that returns _DONE once the pipeline is stopped"""
+    while not stop.is_set():
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def identify_probes(probe_dir, output_file, output_format=None, k=3, batch_size=32, decode_threads=4,
+                    detect_threads=2, queue_size=64, detector=None, nprobe=None, system=None):
+    """
+    Identify every probe photo under probe_dir against the gallery.
+
+    Probes stream through four stages connected by bounded queues, so that
+    decoding, detection, FaceNet and matching overlap however many probes
+    there are. Decoded photos are the large items: at most two per detect
+    thread wait for detection, on top of the ones being decoded and
+    detected. Up to queue_size face crops wait for FaceNet:
+
+      decode - decode_threads threads decode each photo once, with an
+               upright copy downscaled for detection (as the server does)
+      detect - detect_threads threads find the one face (detector mode,
+               default: the /recognize one) and crop it at full resolution
+      embed  - FaceNet on batches of batch_size faces
+      match  - one matrix search of the gallery per batch; the rows are
+               appended to the output and flushed
+
+    Rows are written in completion order. Probes already in the output are
+    skipped, so an interrupted run is resumed by running it again. Returns a
+    summary, or None if the gallery is empty.
+    """
+    output_format = output_format or output_format_of(output_file)
+    probes = list_probes(probe_dir)
+    completed = completed_probes(output_file, output_format)
+    pending = [probe for probe in probes if probe not in completed]
+    logger.info(f"Found {len(probes)} probe photos: {len(probes) - len(pending)} already identified, "
+                f"{len(pending)} to process")
+    summary = {'probes': len(probes), 'skipped': len(probes) - len(pending), 'identified': 0, 'matched': 0,
+               'failed': 0, 'seconds': 0.0}
+    if not pending:
+        return summary
+
+    if system is None:
+        from face_recognition import FaceRecognitionSystem
+        system = FaceRecognitionSystem()
+    if not system.gallery:
+        logger.error("❌ No IDs in the gallery; run create_embeddings.py first")
+        return None
+
+    detector = detector or system.detector_modes['recognize']
+    max_side = system.detection_max_side if system.fast_decode else None
+
+    paths = queue.Queue()
+    for probe in pending:
+        paths.put(probe)
+    for _ in range(decode_threads):
+        paths.put(_DONE)
+    # Decoded photos are megabytes each: only a few wait for detection
+    decoded = queue.Queue(maxsize=2 * detect_threads)
+    faces = queue.Queue(maxsize=queue_size)
+    batches = queue.Queue(maxsize=max(2, queue_size // batch_size))
+
+    stop = threading.Event()
+    failures = []
+
+    def decode(probe):
+        try:
+            return probe, system.decode_for_detection(os.path.join(probe_dir, probe), max_side), None
+        except Exception as e:
+            return probe, None, f'Could not process image: {e}'
+
+    def detect(item):
+        probe, image, error = item
+        if image is None:
+            return probe, None, None, None, error
+        try:
+            results, path = system.detect_single_face(np.asarray(image[1]), detector)
+            cropped = system.crop_faces(image, results[:1], system.required_size)
+        except Exception as e:
+            return probe, None, None, None, f'Could not process image: {e}'
+        if not cropped:
+            return probe, None, None, path, 'No face could be detected in the image.'
+        face, box, _ = cropped[0]
+        return probe, face, box, path, None
+
+    def worker(stage, inputs, outputs):
+        """A decode or detect thread"""
+        def run():
+            try:
+                while True:
+                    item = _get(inputs, stop)
+                    if item is _DONE or not _put(outputs, stage(item), stop):
+                        return
+            except Exception as e:
+                failures.append(e)
+                stop.set()
+        return run
+
+    def embed():
+        try:
+            finished = False
+            while not finished:
+                batch = []
+                while len(batch) < batch_size:
+                    item = _get(faces, stop)
+                    if item is _DONE:
+                        if stop.is_set():
+                            return
+                        finished = True
+                        break
+                    batch.append(item)
+                if not batch:
+                    continue
+
+                found = [i for i, (_, face, _, _, _) in enumerate(batch) if face is not None]
+                embeddings = [None] * len(batch)
+                if found:
+                    for i, embedding in zip(found, system.get_embeddings([batch[i][1] for i in found])):
+                        embeddings[i] = np.asarray(embedding)
+                if not _put(batches, (batch, embeddings), stop):
+                    return
+            _put(batches, _DONE, stop)
+        except Exception as e:
+            failures.append(e)
+            stop.set()
+
+    def match():
+        writer = ResultWriter(output_file, output_format)
+        started = time.perf_counter()
+        try:
+            while True:
+                item = _get(batches, stop)
+                if item is _DONE:
+                    return
+                batch, embeddings = item
+                found = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+                candidates = [None] * len(batch)
+                if found:
+                    results = system.search_gallery_batch([embeddings[i] for i in found], k=k, nprobe=nprobe)
+                    for i, result in zip(found, results):
+                        candidates[i] = result
+
+                rows = [
+                    result_row(probe, candidates[i], box, path, error)
+                    for i, (probe, _, box, path, error) in enumerate(batch)
+                ]
+                writer.write(rows)
+
+                before = summary['identified']
+                summary['identified'] += len(rows)
+                summary['matched'] += sum(1 for row in rows if row['name'] not in (None, "Unknown"))
+                summary['failed'] += sum(1 for row in rows if row['error'] is not None)
+                if summary['identified'] // 1000 > before // 1000:
+                    rate = summary['identified'] / (time.perf_counter() - started)
+                    logger.info(f"  Identified {summary['identified']}/{len(pending)} probes ({rate:.1f}/s)")
+        except Exception as e:
+            failures.append(e)
+            stop.set()
+        finally:
+            writer.close()
+
+    threads = [threading.Thread(target=worker(decode, paths, decoded), name=f"decode-{i}", daemon=True)
+               for i in range(decode_threads)]
+    detect_workers = [threading.Thread(target=worker(detect, decoded, faces), name=f"detect-{i}", daemon=True)
+                      for i in range(detect_threads)]
+    threads += detect_workers
+    threads += [threading.Thread(target=embed, name="embed", daemon=True),
+                threading.Thread(target=match, name="match", daemon=True)]
+
+    def close(workers, outputs, consumers):
+        """Once a stage's threads are done, tell the next stage's threads"""
+        for thread in workers:
+            thread.join()
+        for _ in range(consumers):
+            _put(outputs, _DONE, stop)
+
+    # The detect threads stop on one _DONE each from the decode stage
+    threads.append(threading.Thread(target=close, args=(threads[:decode_threads], decoded, detect_threads),
+                                    daemon=True))
+    threads.append(threading.Thread(target=close, args=(detect_workers, faces, 1), daemon=True))
+
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            # Short joins, so that Ctrl-C is handled promptly
+            while thread.is_alive():
+                thread.join(0.5)
+    finally:
+        stop.set()
+    if failures:
+        raise RuntimeError(f"Identification stopped after {summary['identified']} probes: {failures[0]}") from failures[0]
+
+    summary['seconds'] = time.perf_counter() - began
+    return summary
+
+
+def main():
+    """Main execution function"""
+    parser = argparse.ArgumentParser(description="Identify a directory of probe photos against the gallery")
+    parser.add_argument('probe_dir', help='directory of probe photos (searched recursively)')
+    parser.add_argument('--output', required=True, help='results file, appended to and resumed (.csv or .jsonl)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=None, help='default: from the output extension')
+    parser.add_argument('--k', type=int, default=3, help='candidates per probe')
+    parser.add_argument('--batch-size', type=int, default=32, help='faces per FaceNet call and gallery search')
+    parser.add_argument('--decode-threads', type=int, default=4)
+    parser.add_argument('--detect-threads', type=int, default=2)
+    parser.add_argument('--queue-size', type=int, default=64, help='face crops held between detection and FaceNet')
+    parser.add_argument('--detector', choices=DETECTOR_MODES, default=None,
+                        help='single-face detector mode (default: FACE_DETECTOR_RECOGNIZE or FACE_DETECTOR)')
+    parser.add_argument('--nprobe', type=int, default=None, help='IVF lists to scan (FACE_GALLERY_INDEX=ivf)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.probe_dir):
+        parser.error(f"not a directory: {args.probe_dir}")
+
+    logger.info("🚀 Starting bulk identification...\n")
+    summary = identify_probes(
+        args.probe_dir, args.output, output_format=args.format, k=args.k, batch_size=args.batch_size,
+        decode_threads=args.decode_threads, detect_threads=args.detect_threads, queue_size=args.queue_size,
+        detector=args.detector, nprobe=args.nprobe
+    )
+    if summary is None:
+        return
+
+    logger.info(f"✅ Results written to {args.output}")
+    logger.info(f"📊 Summary:")
+    logger.info(f"   Probes identified: {summary['identified']} in {summary['seconds']:.1f}s "
+                f"({summary['skipped']} already in the output)")
+    logger.info(f"   Matched an ID: {summary['matched']}")
+    logger.info(f"   Failed (unreadable or no face): {summary['failed']}")
+
+if __name__ == "__main__":
+    main()
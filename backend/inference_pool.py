@@ -0,0 +1,175 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Model-only FaceRecognitionSystem of this worker process, created by _init_worker
+_system = None
+
+
+def _init_worker():
+    """Pool initializer: load MTCNN and FaceNet once per worker process"""
+    global _system
+    from face_recognition import FaceRecognitionSystem
+    _system = FaceRecognitionSystem(load_database=False)
+    # Results are cached by the HTTP process, which sees every request
+    _system.embedding_cache.max_entries = 0
+    _system.warm_up()
+    # Stage timings are recorded by the HTTP process, which serves /metrics
+    metrics.forward_observations()
+    logger.info(f"Inference worker {os.getpid()} ready.")
+
+
+def _run_job(function, *args):
+    """Run a job function, returning its result and the metrics it observed"""
+    result = function(*args)
+    return result, metrics.drain()
+
+
+def _ping():
+    return os.getpid()
+
+
+def _extract_face(data, detector):
+    return _system.extract_face_data(data, detector)
+
+
+def _extract_faces(data, min_confidence):
+    return _system.extract_faces_data(data, min_confidence)
+
+
+def _extract_images(datas, detector):
+    return _system.extract_images_data(datas, detector)
+
+
+def _detect_faces(pixels):
+    return _system.detector.detect_faces(pixels)
+
+
+def _embeddings(face_arrays):
+    # Timed by the calling FaceRecognitionSystem in the HTTP process
+    return _system.embedder.embeddings(face_arrays)
+
+
+class InferencePool:
+    """
+    Runs MTCNN and FaceNet in worker processes instead of request threads.
+
+    Each of the N spawned workers loads its own models and takes one job at a
+    time from the executor's queue, so inference scales with cores and a slow
+    upload only ever occupies one worker; request threads just wait on a
+    future, and endpoints that need no inference (/health, /database) are
+    never queued behind it. The gallery is never sent to the workers:
+    matching is one matrix product over the memory-mapped store in the HTTP
+    process.
+
+    Extraction jobs carry raw image bytes in and face crops and boxes out.
+    The crops are embedded through the micro-batcher of the HTTP process,
+    which sees every request, so FaceNet calls from concurrent requests
+    become one embeddings job; a worker that took a whole request would only
+    ever batch that request's own faces. This costs a second round trip per
+    image (a 160x160 crop each way), which is small next to a FaceNet pass.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._executor = self._start()
+
+        self.jobs = 0
+        self.in_flight = 0
+        self.restarts = 0
+
+    def _start(self):
+        logger.info(f"Starting {self.workers} inference worker processes...")
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=self._context, initializer=_init_worker
+        )
+
+    def _current_executor(self):
+        # Called with self._lock held
+        if self._pid != os.getpid():
+            # Forked after the pool started: its queue threads and pipes belong to the parent
+            self._pid = os.getpid()
+            self._executor = self._start()
+        return self._executor
+
+    def run(self, function, *args):
+        """Run one job in a worker and block until its result is ready"""
+        with self._lock:
+            executor = self._current_executor()
+            self.jobs += 1
+            self.in_flight += 1
+        try:
+            with metrics.INFERENCE_JOB_SECONDS.labels(function.__name__.lstrip('_')).time():
+                result, observations = executor.submit(_run_job, function, *args).result()
+            metrics.replay(observations)
+            return result
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); replace the whole pool once
+            with self._lock:
+                if self._executor is executor:
+                    logger.error("❌ Inference worker died, restarting the pool")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = self._start()
+                    self.restarts += 1
+            raise RuntimeError("Inference worker failed, please retry the request")
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def warm_up(self):
+        """Spawn every worker process and wait for them to answer; returns their pids"""
+        with self._lock:
+            executor = self._current_executor()
+        futures = [executor.submit(_ping) for _ in range(self.workers)]
+        return sorted({future.result() for future in futures})
+
+    def extract_face(self, data, detector=None):
+        return self.run(_extract_face, data, detector)
+
+    def extract_faces(self, data, min_confidence):
+        return self.run(_extract_faces, data, min_confidence)
+
+    def extract_images(self, datas, detector=None):
+        return self.run(_extract_images, datas, detector)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'jobs': self.jobs,
+                'in_flight': self.in_flight,
+                'restarts': self.restarts
+            }
+
+    def close(self):
+        with self._lock:
+            self._executor.shutdown(wait=True)
+
+
+class RemoteDetector:
+    """MTCNN stand-in for the HTTP process: detect_faces runs in a pool worker"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def detect_faces(self, pixels):
+        return self.pool.run(_detect_faces, pixels)
+
+
+class RemoteEmbedder:
+    """FaceNet stand-in for the HTTP process: embeddings runs in a pool worker"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def embeddings(self, face_arrays):
+        return self.pool.run(_embeddings, list(face_arrays))
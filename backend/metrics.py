@@ -0,0 +1,295 @@
+import math
+import time
+import bisect
+import threading
+
+# Seconds: from sub-millisecond gallery matches to full-resolution MTCNN runs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# name -> metric, in registration order (the /metrics output order)
+REGISTRY = {}
+
+# Set in inference worker processes: observations are queued here and shipped
+# back to the HTTP process with each job result instead of being kept locally
+_forwarded = None
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """
+    Base of the in-process Prometheus metrics. Children are created once per
+    combination of label values and then updated under their own lock, so
+    recording costs a dict lookup and a few additions.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        if name in REGISTRY:
+            raise ValueError(f"Metric already registered: {name}")
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Label values as passed -> child (lookup cache); label strings -> child (rendered)
+        self._children = {}
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            text = tuple(str(value) for value in values)
+            with self._lock:
+                child = self._series.get(text)
+                if child is None:
+                    child = self._series[text] = self._new_child(text)
+                self._children[values] = child
+        return child
+
+    def _new_child(self, values):
+        raise NotImplementedError
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in list(self._series.items()):
+            lines.extend(child.render(self, values))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+    def render(self, metric, values):
+        return [f"{metric.name}{metric._label_text(values)} {_format_value(self.value)}"]
+
+
+class Counter(Metric):
+    """Monotonic total. set() is for totals kept elsewhere and read at scrape time."""
+
+    type = "counter"
+
+    def _new_child(self, values):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Gauge(Metric):
+    """Value that goes up and down (in-flight requests, gallery size)"""
+
+    type = "gauge"
+
+    def _new_child(self, values):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _HistogramValues:
+    def __init__(self, metric, values):
+        self.metric = metric
+        self.values = values
+        # Per-bucket (non-cumulative) counts; the last slot is +Inf
+        self.counts = [0] * (len(metric.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        if _forwarded is not None:
+            _forwarded.append((self.metric.name, self.values, value))
+            return
+        position = bisect.bisect_left(self.metric.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the elapsed seconds of its block"""
+        return _Timer(self)
+
+    def render(self, metric, values):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(metric.buckets + (math.inf,), counts):
+            cumulative += count
+            labels = metric._label_text(values, [("le", _format_value(bound))])
+            lines.append(f"{metric.name}_bucket{labels} {cumulative}")
+        lines.append(f"{metric.name}_sum{metric._label_text(values)} {_format_value(total)}")
+        lines.append(f"{metric.name}_count{metric._label_text(values)} {cumulative}")
+        return lines
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(float(bound) for bound in buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self, values):
+        return _HistogramValues(self, values)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+REQUEST_SECONDS = Histogram(
+    "face_http_request_duration_seconds", "Flask request latency, including streamed responses",
+    ("endpoint", "method", "status")
+)
+REQUESTS_IN_FLIGHT = Gauge("face_http_requests_in_flight", "Requests being handled", ("endpoint",))
+STAGE_SECONDS = Histogram(
+    "face_stage_duration_seconds", "Latency of the decode, detect, embed, match and save stages", ("stage",)
+)
+BATCH_SIZE = Histogram(
+    "face_batch_size", "Faces per FaceNet call (embed) and probes per gallery search (match)",
+    ("stage",), buckets=BATCH_SIZE_BUCKETS
+)
+INFERENCE_JOB_SECONDS = Histogram(
+    "face_inference_job_duration_seconds", "Inference pool jobs, including the wait for a free worker", ("job",)
+)
+INFERENCE_IN_FLIGHT = Gauge("face_inference_jobs_in_flight", "Inference pool jobs submitted and not finished")
+INFERENCE_WORKERS = Gauge("face_inference_workers", "Inference worker processes")
+INFERENCE_RESTARTS = Counter("face_inference_pool_restarts_total", "Inference pool restarts after a worker died")
+DETECTIONS = Counter(
+    "face_detections_total", "Single-face detections by path taken (haar, mtcnn_roi or mtcnn)", ("path",)
+)
+GALLERY_SIZE = Gauge("face_gallery_size", "Registered IDs in the loaded gallery")
+DATABASE_VERSION = Gauge("face_database_version", "Gallery reloads since startup")
+GALLERY_VERSION = Gauge("face_gallery_version", "Gallery snapshots published since startup (registrations are batched)")
+MODELS_READY = Gauge("face_models_ready", "1 once the models are loaded and warmed up")
+CACHE_ENTRIES = Gauge("face_embedding_cache_entries", "Images in the embedding cache")
+CACHE_HITS = Counter("face_embedding_cache_hits_total", "Embedding cache hits")
+CACHE_MISSES = Counter("face_embedding_cache_misses_total", "Embedding cache misses")
+CACHE_HIT_RATIO = Gauge("face_embedding_cache_hit_ratio", "Embedding cache hits over lookups since startup")
+INFERENCE_LEADERS = Counter(
+    "face_inference_leaders_total", "Images detected and embedded for a request (cache misses not already in flight)"
+)
+INFERENCE_COALESCED = Counter(
+    "face_inference_coalesced_total", "Cache misses that waited on an identical image already in flight instead"
+)
+INFERENCE_IN_FLIGHT_IMAGES = Gauge("face_inference_images_in_flight", "Distinct images being detected and embedded")
+
+
+def stage(name):
+    """Time a pipeline stage: with stage('detect'): ..."""
+    return STAGE_SECONDS.labels(name).time()
+
+
+def observe_batch(name, size):
+    BATCH_SIZE.labels(name).observe(size)
+
+
+def forward_observations():
+    """Queue this process's histogram observations for drain() (inference workers)"""
+    global _forwarded
+    _forwarded = []
+
+
+def drain():
+    """Observations queued since the last drain, as (name, label values, value)"""
+    observations = list(_forwarded or ())
+    if _forwarded:
+        del _forwarded[:len(observations)]
+    return observations
+
+
+def replay(observations):
+    """Record observations drained in another process"""
+    for name, values, value in observations:
+        REGISTRY[name].labels(*values).observe(value)
+
+
+def update_system_metrics(system):
+    """Copy gauges and totals kept by the system and its helpers into the metrics"""
+    GALLERY_SIZE.set(len(system.gallery))
+    DATABASE_VERSION.set(system.database_version)
+    GALLERY_VERSION.set(system.versions.current.version)
+    MODELS_READY.set(1 if system.warm else 0)
+
+    cache = system.embedding_cache.stats()
+    CACHE_ENTRIES.set(cache['entries'])
+    CACHE_HITS.set(cache['hits'])
+    CACHE_MISSES.set(cache['misses'])
+    CACHE_HIT_RATIO.set(cache['hit_rate'])
+
+    in_flight = system.in_flight.stats()
+    INFERENCE_LEADERS.set(in_flight['leaders'])
+    INFERENCE_COALESCED.set(in_flight['coalesced'])
+    INFERENCE_IN_FLIGHT_IMAGES.set(in_flight['in_flight'])
+
+    if system.inference_pool is not None:
+        pool = system.inference_pool.stats()
+        INFERENCE_WORKERS.set(pool['workers'])
+        INFERENCE_IN_FLIGHT.set(pool['in_flight'])
+        INFERENCE_RESTARTS.set(pool['restarts'])
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,148 @@
+import numpy as np
+
+# Rows converted back to float32 at a time by the quantized scans; small
+# enough for the converted block to stay in L2 cache while it is multiplied
+SCAN_CHUNK_ROWS = 256
+
+
+class Float16Codes:
+    """
+    Half-precision copy of the gallery rows, for a first-pass scan that reads
+    half the bytes of the float32 matrix.
+
+    Each float16 component is within a relative 2**-11 of the original, so
+    for unit-length rows and probes the approximate dot products are off by
+    at most 2**-11 (Cauchy-Schwarz); error_bound returns that bound.
+    """
+
+    kind = "float16"
+
+    def __init__(self, dimension, capacity=1024):
+        self.codes = np.empty((max(1, capacity), dimension), dtype=np.float16)
+
+    @classmethod
+    def train(cls, rows, capacity=None):
+        count = rows.shape[0]
+        codes = cls(rows.shape[1], capacity or count)
+        for start in range(0, count, 65536):
+            codes.set(slice(start, min(count, start + 65536)), rows[start:start + 65536])
+        return codes
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def _ensure_capacity(self, stop):
+        if stop > self.codes.shape[0]:
+            codes = np.empty((max(stop, self.codes.shape[0] * 2), self.codes.shape[1]), dtype=self.codes.dtype)
+            codes[:self.codes.shape[0]] = self.codes
+            self.codes = codes
+
+    def set(self, position, rows):
+        """Encode one row (int position) or a block of rows (slice)"""
+        stop = position.stop if isinstance(position, slice) else position + 1
+        self._ensure_capacity(stop)
+        self.codes[position] = rows
+
+    def _weights(self, probes32):
+        return probes32, 0.0
+
+    def error_bound(self, probes32):
+        # Half the float16 spacing, relative; subnormals add at most 2**-25 per component
+        return 2.0 ** -11 * np.linalg.norm(probes32, axis=-1) + probes32.shape[-1] * 2.0 ** -25
+
+    def dot(self, probe32, count, candidates=None):
+        """Approximate gallery . probe for rows [0, count) or the given row positions"""
+        weights, offset = self._weights(probe32[None, :])
+        return self.dot_batch_weighted(weights, offset, count, candidates)[0]
+
+    def dot_batch(self, probes32, count):
+        weights, offset = self._weights(probes32)
+        return self.dot_batch_weighted(weights, offset, count)
+
+    def dot_batch_weighted(self, weights, offset, count, candidates=None):
+        rows = count if candidates is None else len(candidates)
+        scores = np.empty((weights.shape[0], rows), dtype=np.float32)
+        for start in range(0, rows, SCAN_CHUNK_ROWS):
+            stop = min(rows, start + SCAN_CHUNK_ROWS)
+            if candidates is None:
+                block = self.codes[start:stop].astype(np.float32)
+            else:
+                block = self.codes[candidates[start:stop]].astype(np.float32)
+            scores[:, start:stop] = weights @ block.T
+        scores += np.asarray(offset, dtype=np.float32).reshape(-1, 1)
+        return scores
+
+
+class Int8Codes(Float16Codes):
+    """
+    Per-dimension affine int8 quantization of the gallery rows: a quarter of
+    the bytes of the float32 matrix.
+
+    Dimension d is stored as code = round((x - low[d]) / scale[d]) - 128, so
+    gallery . probe = codes . (probe * scale) + probe . (low + 128 * scale).
+    errors[d] bounds |x - decoded x| over every stored row (half a step, or
+    more for rows registered later that had to be clipped), so error_bound
+    is sum(|probe| * errors).
+    """
+
+    kind = "int8"
+
+    def __init__(self, dimension, capacity=1024, low=None, scale=None):
+        self.codes = np.empty((max(1, capacity), dimension), dtype=np.int8)
+        self.low = np.zeros(dimension, dtype=np.float32) if low is None else low
+        self.scale = np.ones(dimension, dtype=np.float32) if scale is None else scale
+        self.errors = self.scale / 2
+
+    @classmethod
+    def train(cls, rows, capacity=None):
+        count, dimension = rows.shape
+        low = np.full(dimension, np.inf, dtype=np.float32)
+        high = np.full(dimension, -np.inf, dtype=np.float32)
+        for start in range(0, count, 65536):
+            block = np.asarray(rows[start:start + 65536], dtype=np.float32)
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        if count == 0:
+            low, high = np.zeros(dimension, dtype=np.float32), np.zeros(dimension, dtype=np.float32)
+
+        scale = (high - low) / 255.0
+        scale[scale <= 0] = 1e-12
+        codes = cls(dimension, capacity or count, low=low, scale=scale.astype(np.float32))
+        for start in range(0, count, 65536):
+            codes.set(slice(start, min(count, start + 65536)), rows[start:start + 65536])
+        return codes
+
+    def set(self, position, rows):
+        stop = position.stop if isinstance(position, slice) else position + 1
+        self._ensure_capacity(stop)
+        rows = np.asarray(rows, dtype=np.float32)
+        codes = np.clip(np.rint((rows - self.low) / self.scale) - 128, -128, 127)
+        # Track the worst reconstruction error per dimension (clipping can exceed half a step)
+        decoded = (codes + 128) * self.scale + self.low
+        error = np.abs(rows - decoded)
+        if error.ndim == 2:
+            error = error.max(axis=0) if error.shape[0] else self.errors
+        self.errors = np.maximum(self.errors, error)
+        self.codes[position] = codes.astype(np.int8)
+
+    def _weights(self, probes32):
+        offset = probes32 @ (self.low + 128.0 * self.scale)
+        return probes32 * self.scale, offset
+
+    def error_bound(self, probes32):
+        # Plus float32 rounding of the offset term
+        return np.abs(probes32) @ self.errors + 1e-6
+
+
+QUANTIZERS = {
+    Float16Codes.kind: Float16Codes,
+    Int8Codes.kind: Int8Codes,
+}
+
+
+def quantize_rows(kind, rows, capacity=None):
+    """Quantized codes of an (N, D) matrix ('float16' or 'int8')"""
+    if kind not in QUANTIZERS:
+        raise ValueError(f"Unknown gallery quantization: {kind}")
+    return QUANTIZERS[kind].train(rows, capacity)
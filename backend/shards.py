@@ -0,0 +1,361 @@
+import os
+import sys
+import heapq
+import queue
+import hashlib
+import logging
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from gallery import GallerySnapshot
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a shard's answer, and for spawned local shards to load their gallery
+SHARD_TIMEOUT = 30.0
+SHARD_START_TIMEOUT = 600.0
+
+
+def shard_of(name, shards):
+    """Shard that owns an identity: a stable hash of its name (unlike hash(), the same in every process)"""
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % shards
+
+
+def merge_top_k(answers, k, count):
+    """
+    Merge the shards' answers (per shard, a top-k list of (name, distance)
+    for each of count probes) into each probe's overall top-k
+    """
+    return [
+        heapq.nsmallest(k, (candidate for answer in answers for candidate in answer[i]), key=lambda c: c[1])
+        for i in range(count)
+    ]
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class ShardServer:
+    """
+    One shard of a sharded gallery: a FaceRecognitionSystem without models
+    that only loads, journals in and searches the identities hashed to it,
+    served over multiprocessing.connection (one thread per coordinator
+    connection). Searches return raw (name, distance) candidates; the
+    coordinator applies the threshold. Registrations are journaled (and
+    compacted) by the shard that owns them, in its own database/.
+    """
+
+    METHODS = ("search_batch", "add", "templates", "list_identities", "stats", "reload")
+
+    def __init__(self, shard, shards):
+        from face_recognition import FaceRecognitionSystem
+        self.system = FaceRecognitionSystem(shard=(shard, shards))
+        self.shard = shard
+        self.shards = shards
+
+    def search_batch(self, probes, k, nprobe=None):
+        snapshot = self.system.versions.current
+        if not snapshot.gallery:
+            return [[] for _ in probes]
+        return [
+            [(name, float(distance)) for name, distance in results]
+            for results in snapshot.index.search_batch(probes, k, nprobe=nprobe)
+        ]
+
+    def add(self, name, embedding):
+        """Register a template in this shard's journal and gallery, so it survives a restart"""
+        if shard_of(name, self.shards) != self.shard:
+            raise ValueError(f"{name} belongs to shard {shard_of(name, self.shards)}, not {self.shard}")
+        return self.system.register_identity(name, embedding)
+
+    def templates(self, name):
+        return [np.asarray(template) for template in self.system.gallery.templates(name)]
+
+    def list_identities(self, prefix="", after=None, limit=100):
+        return self.system.gallery.list_identities(prefix=prefix, after=after, limit=limit)
+
+    def state(self):
+        """Version and size of this shard's gallery, sent along with every reply"""
+        snapshot = self.system.versions.current
+        return {
+            'version': snapshot.version,
+            'ids': len(snapshot.gallery),
+            'templates': snapshot.gallery.template_count
+        }
+
+    def stats(self):
+        return {
+            'shard': self.shard,
+            'shards': self.shards,
+            'pid': os.getpid(),
+            **self.state(),
+            'generation': self.system.loaded_generation
+        }
+
+    def reload(self):
+        self.system.load_database()
+        return self.stats()
+
+    def _handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if method not in self.METHODS:
+                        raise ValueError(f"Unknown shard method: {method}")
+                    reply = ("ok", getattr(self, method)(*args))
+                except Exception as e:
+                    reply = ("error", f"{type(e).__name__}: {e}")
+                connection.send((*reply, self.state()))
+
+    def serve_forever(self, listener):
+        logger.info(f"✅ Shard {self.shard}/{self.shards} serving {len(self.system.gallery)} IDs on {listener.address}")
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception as e:
+                # A client that failed authentication, or went away while connecting
+                logger.warning(f"Shard {self.shard}: rejected connection: {e}")
+                continue
+            threading.Thread(target=self._handle, args=(connection,), name="shard-connection", daemon=True).start()
+
+
+def run_shard(shard, shards, address, authkey, ready=None):
+    """Load one shard and serve it; a spawned local shard reports its address on ready"""
+    logging.basicConfig(level=logging.INFO)
+    server = ShardServer(shard, shards)
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.put((shard, listener.address))
+        server.serve_forever(listener)
+
+
+class _Shard:
+    """Connections to one shard server, reused across requests (one per concurrent request)"""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def connect(self):
+        if self._pid != os.getpid():
+            # Forked (e.g. gunicorn workers): the inherited sockets belong to the parent
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return Client(self.address, authkey=self.authkey)
+
+    def release(self, connection):
+        self._idle.put(connection)
+
+
+class ShardedGallery:
+    """
+    Coordinator side of a gallery partitioned across shard processes by a
+    hash of the identity name (see shard_of), local or on other machines.
+
+    Searches are scatter-gather: the probes are sent to every shard before
+    any answer is read, so the shards scan their part of the gallery in
+    parallel, and each probe's top-k is merged from the shards' top-k
+    lists. An identity and all of its templates live on one shard, so the
+    merged result is the one a single gallery would return. Registrations
+    go to the owning shard only, which journals them.
+
+    Stands in for the VersionedGallery of a FaceRecognitionSystem: current
+    is a GallerySnapshot whose gallery and index are this object, and whose
+    version is the sum of the shard versions. Every shard reply carries the
+    shard's version and size, which are kept here, so current, len() and
+    template_count never wait on a shard.
+    """
+
+    def __init__(self, addresses, authkey, timeout=SHARD_TIMEOUT, processes=()):
+        self.shards = [_Shard(address, authkey) for address in addresses]
+        self.timeout = timeout
+        # Local shard processes started by start_local_shards
+        self.processes = list(processes)
+        # Shard versions and sizes as of their last replies
+        self._states = [None] * len(self.shards)
+        self._snapshot = None
+
+        for shard, stats in enumerate(self.stats()):
+            if (stats['shard'], stats['shards']) != (shard, len(self.shards)):
+                raise ValueError(
+                    f"{addresses[shard]} serves shard {stats['shard']} of {stats['shards']}, "
+                    f"expected {shard} of {len(self.shards)}"
+                )
+
+    def _call(self, calls):
+        """Send each (shard, method, args) before reading any reply; returns the results in order"""
+        sent = []
+        try:
+            for shard, method, args in calls:
+                connection = self.shards[shard].connect()
+                sent.append((shard, connection))
+                connection.send((method, args))
+
+            results = []
+            while sent:
+                shard, connection = sent[0]
+                if not connection.poll(self.timeout):
+                    raise TimeoutError(f"Shard {shard} did not answer within {self.timeout}s")
+                status, result, state = connection.recv()
+                sent.pop(0)
+                self.shards[shard].release(connection)
+                self._states[shard] = state
+                if status != "ok":
+                    raise RuntimeError(f"Shard {shard}: {result}")
+                results.append(result)
+            return results
+        except (EOFError, OSError) as e:
+            raise RuntimeError(f"Shard {sent[0][0] if sent else '?'} unavailable: {e}") from e
+        finally:
+            # Replies that were not read would be mistaken for the next request's
+            for _, connection in sent:
+                connection.close()
+
+    def _scatter(self, method, *args):
+        return self._call([(shard, method, args) for shard in range(len(self.shards))])
+
+    def owner(self, name):
+        return shard_of(name, len(self.shards))
+
+    # VersionedGallery
+
+    @property
+    def current(self):
+        """Snapshot as of the shards' last replies; asks no shard"""
+        version = sum(state['version'] for state in self._states)
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            snapshot = self._snapshot = GallerySnapshot(self, self, version)
+        return snapshot
+
+    def add(self, name, embedding):
+        """Add one template to an identity on its shard; returns the version that contains it"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._call([(self.owner(name), "add", (name, embedding))])
+        return self.current.version
+
+    # Gallery
+
+    def __len__(self):
+        return sum(state['ids'] for state in self._states)
+
+    def __bool__(self):
+        return any(state['ids'] for state in self._states)
+
+    @property
+    def template_count(self):
+        return sum(state['templates'] for state in self._states)
+
+    def templates(self, name):
+        return self._call([(self.owner(name), "templates", (name,))])[0]
+
+    def list_identities(self, prefix="", after=None, limit=100):
+        """Gallery.list_identities over all shards: each shard's first page, merged"""
+        pages = self._scatter("list_identities", prefix, after, limit)
+        merged = list(heapq.merge(*(names for names, _ in pages)))
+        more = len(merged) > limit or any(more for _, more in pages)
+        return merged[:limit], more
+
+    # Index
+
+    def search(self, embedding, k=1, nprobe=None):
+        return self.search_batch([embedding], k, nprobe=nprobe)[0]
+
+    def search_batch(self, embeddings, k=1, nprobe=None):
+        probes = np.asarray(embeddings, dtype=np.float32)
+        return merge_top_k(self._scatter("search_batch", probes, k, nprobe), k, len(probes))
+
+    def stats(self):
+        return self._scatter("stats")
+
+    def reload(self):
+        """Reload every shard from the store and the journal; returns their stats"""
+        return self._scatter("reload")
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+
+def start_local_shards(count, authkey=None, timeout=SHARD_START_TIMEOUT):
+    """
+    Spawn count shard processes on this machine, listening on free localhost
+    ports, and wait until each has loaded its part of the gallery.
+    """
+    authkey = authkey or os.urandom(16)
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    processes = []
+    for shard in range(count):
+        process = context.Process(
+            target=run_shard, args=(shard, count, ('127.0.0.1', 0), authkey, ready),
+            name=f"gallery-shard-{shard}", daemon=True
+        )
+        process.start()
+        processes.append(process)
+
+    addresses = [None] * count
+    try:
+        for _ in range(count):
+            shard, address = ready.get(timeout=timeout)
+            addresses[shard] = address
+    except queue.Empty:
+        for process in processes:
+            process.terminate()
+        raise RuntimeError(f"Gallery shards did not start within {timeout}s")
+
+    logger.info(f"✅ Started {count} local gallery shards")
+    return ShardedGallery(addresses, authkey, processes=processes)
+
+
+def connect_shards(spec, authkey=None):
+    """
+    ShardedGallery for FACE_SHARDS: a shard count spawns that many local
+    shards, a comma-separated list of host:port connects to running shard
+    servers (python shards.py serve), in shard order.
+    """
+    if authkey is None and os.environ.get("FACE_SHARD_AUTHKEY"):
+        authkey = os.environ["FACE_SHARD_AUTHKEY"].encode('utf-8')
+    if spec.isdigit():
+        return start_local_shards(int(spec), authkey)
+    if authkey is None:
+        raise ValueError("FACE_SHARD_AUTHKEY must be set to connect to remote shards")
+    return ShardedGallery([parse_address(address.strip()) for address in spec.split(',')], authkey)
+
+
+def main():
+    """Serve one gallery shard for coordinators started with FACE_SHARDS=host:port,..."""
+    parser = argparse.ArgumentParser(description="Serve one shard of the ID gallery")
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--shard', type=int, required=True, help='index of this shard, from 0')
+    parser.add_argument('--shards', type=int, required=True, help='number of shards')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=6000)
+    args = parser.parse_args()
+
+    authkey = os.environ.get("FACE_SHARD_AUTHKEY")
+    if not authkey:
+        sys.exit("FACE_SHARD_AUTHKEY must be set (the same on every shard and coordinator)")
+    if not 0 <= args.shard < args.shards:
+        sys.exit("--shard must be between 0 and --shards - 1")
+    run_shard(args.shard, args.shards, (args.host, args.port), authkey.encode('utf-8'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import io
+import os
+import sys
+import numpy as np
+import pytest
+
+# The backend modules import each other flat, as when run from backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def photo(seed, size=(160, 200), format='JPEG'):
+    """Bytes of a random photo; the stub models see a face in the middle of any image"""
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)).save(buffer, format)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def system(tmp_path, monkeypatch):
+    """A FaceRecognitionSystem with the benchmark stub models, in an empty working directory"""
+    from face_recognition import FaceRecognitionSystem
+    from benchmarks.stubs import StubDetector, StubEmbedder
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("database/ids")
+    return FaceRecognitionSystem(load_database=False, detector=StubDetector(), embedder=StubEmbedder())
+
+
+@pytest.fixture
+def client(system, monkeypatch):
+    """Flask test client of the API, served by the system fixture"""
+    import app
+    from tracking import TrackerSessions
+
+    monkeypatch.setattr(app, '_face_recognition_system', system)
+    monkeypatch.setattr(app, 'stream_sessions', TrackerSessions())
+    return app.app.test_client()
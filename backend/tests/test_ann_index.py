@@ -0,0 +1,47 @@
+import numpy as np
+from gallery import Gallery, VersionedGallery
+from ann_index import IVFIndex
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes
+
+
+def names_of(results):
+    return [[name for name, _ in result] for result in results]
+
+
+def ivf_versions(size=3000, max_templates=3):
+    names, matrix = synthetic_gallery(size, dimension=64, seed=3)
+    gallery = Gallery.from_matrix(names, matrix).configure_templates(max_templates)
+    index = IVFIndex(gallery, nlist=32, min_train_size=1000).build()
+    return VersionedGallery(gallery, index), matrix
+
+
+def test_ivf_full_nprobe_matches_exact_search():
+    versions, matrix = ivf_versions()
+    snapshot = versions.current
+    probes = synthetic_probes(matrix, 50)
+
+    exact = snapshot.gallery.search_batch(probes, k=5)
+    ivf = snapshot.index.search_batch(probes, k=5, nprobe=snapshot.index.nlist)
+    assert names_of(ivf) == names_of(exact)
+
+
+def test_ivf_indexes_every_row_of_a_batched_version():
+    versions, matrix = ivf_versions()
+    rng = np.random.default_rng(7)
+    new = rng.standard_normal((3, 64)).astype(np.float32)
+    # A repeated name in one batch: every template gets a row, not just the last
+    records = [("x", new[0]), ("y", new[1]), ("x", new[2]), ("id_0000005", matrix[6])]
+    snapshot = versions.current
+    gallery, index = versions._extend(snapshot, records)
+
+    positions = np.sort(np.concatenate(index._lists))
+    assert np.array_equal(positions, np.arange(gallery.rows.shape[0]))
+
+    probes = np.concatenate([new, synthetic_probes(matrix, 20)])
+    exact = gallery.search_batch(probes, k=3)
+    ivf = index.search_batch(probes, k=3, nprobe=index.nlist)
+    assert names_of(ivf) == names_of(exact)
+    assert [result[0][0] for result in ivf[:3]] == ["x", "y", "x"]
+
+    # The previous version's index is untouched
+    assert sum(len(cells) for cells in snapshot.index._lists) == snapshot.gallery.rows.shape[0]
@@ -0,0 +1,199 @@
+import io
+import os
+import json
+import runpy
+import pytest
+import numpy as np
+from conftest import photo
+from gallery import Gallery
+from ann_index import ExactIndex, IVFIndex
+import app
+from app import MAX_BATCH_ITEMS
+from benchmarks.synthetic import synthetic_gallery, synthetic_image
+
+
+def upload(seed, name='photo.jpg'):
+    return (io.BytesIO(photo(seed)), name)
+
+
+def test_recognize_when_the_probed_ivf_cells_hold_only_evicted_templates(system, client):
+    system.max_templates = 1
+    names, matrix = synthetic_gallery(5000, seed=4)
+    gallery = system.configure_gallery(Gallery.from_matrix(names, matrix))
+    system.versions.publish(gallery, IVFIndex(gallery, nlist=16, min_train_size=1000).build())
+
+    # Move every identity of the probe's nearest cell to a far away template
+    embedding, _, _ = system.embed_image(io.BytesIO(photo(1)))
+    for position in system.index.candidates(embedding, nprobe=1):
+        system.add_identity(names[position], -matrix[position])
+    assert system.index.search(embedding, k=3, nprobe=1) == []
+
+    response = client.post('/recognize', data={'image': upload(1), 'k': '3', 'nprobe': '1'})
+    assert response.status_code == 200
+    assert response.json['name'] == 'Unknown' and response.json['candidates'] == []
+
+    response = client.post('/recognize_batch', data={'images': [upload(1), upload(2)], 'nprobe': '1'})
+    assert response.status_code == 200
+    assert response.json['results'][0]['candidates'] == []
+
+
+def test_crowd_mode_rejects_a_malformed_min_confidence(client):
+    for value in ['high', '1.5', '-0.1']:
+        response = client.post('/recognize', data={'image': upload(1), 'mode': 'crowd', 'min_confidence': value})
+        assert response.status_code == 400
+        assert 'min_confidence' in response.json['error']
+
+
+def stream(client, frames, **fields):
+    data = {'frames': [(io.BytesIO(frame), f'{i}.jpg') for i, frame in enumerate(frames)], **fields}
+    response = client.post('/recognize_stream', data=data)
+    if response.status_code != 200:
+        return response, None
+    return response, [json.loads(line) for line in response.data.decode().splitlines()]
+
+
+def test_stream_keeps_tracks_across_requests_of_a_session(client):
+    frame = synthetic_image(320, 240)
+    _, first = stream(client, [frame, frame], session='s1', detect_every='5')
+    _, second = stream(client, [frame], session='s1', detect_every='5')
+
+    assert [line['detected'] for line in first[:-1]] == [True, False]
+    assert second[0]['frame'] == 2 and not second[0]['detected']
+    assert second[0]['tracks'][0]['track_id'] == first[0]['tracks'][0]['track_id']
+    assert second[-1]['summary']['frames'] == 3
+
+
+def test_stream_rejects_malformed_parameters(client):
+    frame = synthetic_image(320, 240)
+    for fields in [{'detect_every': '0'}, {'detect_every': 'often'}, {'min_confidence': '2'}]:
+        response, _ = stream(client, [frame], **fields)
+        assert response.status_code == 400
+
+    response, _ = stream(client, [frame] * (MAX_BATCH_ITEMS + 1))
+    assert response.status_code == 400
+    assert str(MAX_BATCH_ITEMS) in response.json['error']
+
+
+def register(client, name, seed):
+    response = client.post('/register', data={'name': name, 'image': upload(seed)})
+    assert response.status_code == 200, response.json
+
+
+def test_recognize_batch_matches_each_image_like_recognize(client):
+    register(client, 'alice', 1)
+    register(client, 'bob', 2)
+    images = [upload(2), (io.BytesIO(b'notes'), 'notes.txt'), upload(1), (io.BytesIO(b'not a jpeg'), 'broken.jpg')]
+    response = client.post('/recognize_batch', data={'images': images, 'k': '2'})
+    assert response.status_code == 200
+    results = response.json['results']
+
+    assert [result['index'] for result in results] == [0, 1, 2, 3]
+    for result, seed in [(results[0], 2), (results[2], 1)]:
+        single = client.post('/recognize', data={'image': upload(seed), 'k': '2'}).json
+        assert result['name'] == single['name']
+        assert [candidate['name'] for candidate in result['candidates']] == [c['name'] for c in single['candidates']]
+        assert result['distance'] == pytest.approx(single['distance'], abs=1e-5)
+    assert (results[0]['name'], results[2]['name']) == ('bob', 'alice')
+    assert results[1]['error'].startswith('Invalid file type')
+    assert results[3]['error'].startswith('Could not process image')
+
+
+def test_batch_endpoints_refuse_more_than_max_batch_items(client):
+    response = client.post('/recognize_batch', data={'images': [upload(1) for _ in range(MAX_BATCH_ITEMS + 1)]})
+    assert response.status_code == 400
+    assert str(MAX_BATCH_ITEMS) in response.json['error']
+
+    pairs = MAX_BATCH_ITEMS + 1
+    response = client.post('/verify_batch', data={'file1': [upload(1)], 'file2': [upload(2) for _ in range(pairs)]})
+    assert response.status_code == 400
+    assert str(MAX_BATCH_ITEMS) in response.json['error']
+
+    assert client.post('/recognize_batch', data={}).status_code == 400
+
+
+def test_verify_batch_pairs_files_in_order_or_one_against_many(client):
+    response = client.post('/verify_batch', data={
+        'file1': [upload(1), upload(1), upload(3)],
+        'file2': [upload(1), upload(2), (io.BytesIO(b'notes'), 'notes.txt')]
+    })
+    assert response.status_code == 200
+    same, different, invalid = response.json['results']
+    assert same['verified'] and same['distance'] == pytest.approx(0.0, abs=1e-5)
+    assert not different['verified']
+    single = client.post('/verify', data={'file1': upload(1), 'file2': upload(2)}).json
+    assert different['distance'] == pytest.approx(single['distance'], abs=1e-5)
+    assert invalid['error'].startswith('file2: Invalid file type') and 'verified' not in invalid
+
+    response = client.post('/verify_batch', data={'file1': [upload(1)], 'file2': [upload(2), upload(1)]})
+    assert [result['verified'] for result in response.json['results']] == [False, True]
+
+    response = client.post('/verify_batch', data={'file1': [upload(1), upload(2)], 'file2': [upload(1)] * 3})
+    assert response.status_code == 400
+
+
+def database_pages(client, **params):
+    """Every name of /database, following next_cursor; returns (names, page count)"""
+    names, pages, cursor = [], 0, None
+    while True:
+        query = dict(params, **({'cursor': cursor} if cursor else {}))
+        response = client.get('/database', query_string=query)
+        assert response.status_code == 200
+        names += response.json['id_names']
+        pages += 1
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            return names, pages
+
+
+def test_database_pages_through_ids_in_name_order(system, client):
+    rng = np.random.default_rng(14)
+    names = [f"{prefix}_{i:04d}" for prefix in ("carol", "ann", "bob") for i in range(700)]
+    matrix = rng.standard_normal((len(names), 32)).astype(np.float32)
+    gallery = system.configure_gallery(Gallery.from_matrix(names, matrix))
+    system.versions.publish(gallery, ExactIndex(gallery))
+    # Registered after the gallery was loaded, so not in its sorted names yet
+    for name in ["bob_x", "anna", "ann_0350a", "b"]:
+        system.add_identity(name, rng.standard_normal(32))
+    everyone = sorted(names + ["bob_x", "anna", "ann_0350a", "b"])
+
+    assert database_pages(client, limit=1000) == (everyone, 3)
+    assert client.get('/database').json['id_names'] == everyone[:100]
+    ann = [name for name in everyone if name.startswith("ann")]
+    assert database_pages(client, prefix="ann", limit=64) == (ann, -(-len(ann) // 64))
+    assert database_pages(client, prefix="bob_") == ([name for name in everyone if name.startswith("bob_")], 8)
+    assert database_pages(client, prefix="zed") == ([], 1)
+
+
+def test_database_refuses_a_limit_out_of_bounds(client):
+    for limit in ['0', '-5', '1001', 'lots']:
+        response = client.get('/database', query_string={'limit': limit})
+        assert response.status_code == 400
+        assert 'limit' in response.json['error']
+
+
+def test_database_answers_304_until_the_gallery_changes(system, client):
+    register(client, 'alice', 1)
+    response = client.get('/database')
+    etag = response.headers['ETag']
+    assert response.json['id_names'] == ['alice']
+
+    response = client.get('/database', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.headers['ETag'] == etag
+
+    register(client, 'bob', 2)
+    response = client.get('/database', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert response.json['id_names'] == ['alice', 'bob']
+
+
+def test_a_preloading_master_leaves_the_warm_up_to_each_worker(system, client, monkeypatch):
+    monkeypatch.setenv("PRELOAD_MODELS", "1")
+    monkeypatch.setenv("INFERENCE_WORKERS", "0")
+    monkeypatch.setenv("WARM_UP_AFTER_FORK", "0")
+    config = runpy.run_path(os.path.join(os.path.dirname(app.__file__), "gunicorn.conf.py"))
+    assert config['preload_app'] and os.environ["WARM_UP_AFTER_FORK"] == "1"
+
+    # Loaded in the master, not warm until the forked worker runs post_fork
+    assert client.get('/ready').status_code == 503
+    config['post_fork'](None, None)
+    assert system.warm and client.get('/ready').status_code == 200
@@ -0,0 +1,113 @@
+import time
+import threading
+import pytest
+from batching import MicroBatcher
+
+
+def submit_concurrently(batcher, items):
+    """submit() each item from its own thread; returns the results (or exceptions) in item order"""
+    results = [None] * len(items)
+
+    def run(i):
+        try:
+            results[i] = batcher.submit(items[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert not any(thread.is_alive() for thread in threads), "a caller never got its result"
+    return results
+
+
+def test_concurrent_items_share_batches_and_get_their_own_results():
+    sizes = []
+
+    def square(items):
+        sizes.append(len(items))
+        time.sleep(0.01)
+        return [item * item for item in items]
+
+    batcher = MicroBatcher(square, max_batch_size=8, max_wait_ms=20)
+    assert submit_concurrently(batcher, list(range(40))) == [i * i for i in range(40)]
+    batcher.close()
+
+    assert sum(sizes) == 40 and max(sizes) <= 8
+    assert len(sizes) < 40
+    assert (batcher.batches, batcher.items) == (len(sizes), 40)
+
+
+def test_a_failed_batch_fails_each_caller_and_the_next_batch_runs():
+    def process(items):
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=50)
+    results = submit_concurrently(batcher, ["a", "bad", "b"])
+    assert all(isinstance(result, ValueError) for result in results)
+    assert batcher.submit("c") == "C"
+    batcher.close()
+
+
+def test_missing_results_fail_the_callers_instead_of_hanging():
+    batcher = MicroBatcher(lambda items: items[:1], max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit_async(item) for item in range(3)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="1 results for a batch of 3"):
+            future.result(timeout=5)
+    batcher.close()
+
+
+def test_an_error_while_producing_results_fails_every_caller():
+    def process(items):
+        for item in items:
+            if item == 2:
+                raise ValueError("failed at 2")
+            yield item * 10
+
+    batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit_async(item) for item in range(4)]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+    # The scheduler thread survived and serves the next batch
+    assert batcher.submit(1) == 10
+    batcher.close()
+
+
+def test_cancelled_items_are_skipped():
+    processed = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def process(items):
+        processed.extend(items)
+        started.set()
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=0)
+    first = batcher.submit_async("first")
+    started.wait(5)
+    # Queued behind the running batch
+    cancelled, kept = batcher.submit_async("cancelled"), batcher.submit_async("kept")
+    assert cancelled.cancel()
+    release.set()
+
+    assert first.result(timeout=5) == "first" and kept.result(timeout=5) == "kept"
+    batcher.close()
+    assert processed == ["first", "kept"]
+
+
+def test_close_finishes_queued_work():
+    batcher = MicroBatcher(lambda items: [item + 1 for item in items], max_batch_size=2, max_wait_ms=0)
+    futures = [batcher.submit_async(item) for item in range(5)]
+    batcher.close()
+    assert [future.result(timeout=0) for future in futures] == [1, 2, 3, 4, 5]
+    with pytest.raises(RuntimeError):
+        batcher.submit(1)
@@ -0,0 +1,94 @@
+import os
+import json
+import numpy as np
+import pytest
+from conftest import photo
+from embedding_store import EmbeddingStore
+from create_embeddings import create_embeddings_from_ids, extract_face, file_sha256, save_manifest
+from benchmarks.stubs import StubDetector
+from benchmarks.synthetic import synthetic_gallery, synthetic_image
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    A store built from the photos of alice and bob, with templates registered
+    through the API since: two more for alice and one for carol, who has no
+    photo. The manifest matches the photos, so a rebuild needs no models.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("database/ids")
+    files = {}
+    for seed, name in enumerate(["alice", "bob"]):
+        path = f"database/ids/{name}.jpg"
+        with open(path, 'wb') as f:
+            f.write(photo(seed))
+        files[f"{name}.jpg"] = {"sha256": file_sha256(path), "name": name}
+    save_manifest("database/ids_manifest.json", files)
+
+    _, rows = synthetic_gallery(5, dimension=32, seed=3)
+    names = ["alice", "bob", "alice", "carol", "alice"]
+    sources = ["alice.jpg", "bob.jpg", "registered_live", "registered_live", "registered_live"]
+    store = EmbeddingStore("database")
+    store.save(names, rows, source_files=sources)
+    return store, rows
+
+
+def stored_templates(store):
+    names, matrix, index = store.load()
+    templates = {}
+    for name, row, source_file in zip(names, matrix, index["source_files"]):
+        templates.setdefault(name, []).append((source_file, np.array(row)))
+    return templates
+
+
+def test_rebuild_keeps_registered_templates_of_ids_with_a_photo(database):
+    store, rows = database
+    assert create_embeddings_from_ids(max_templates=5)
+
+    templates = stored_templates(store)
+    assert [source_file for source_file, _ in templates["alice"]] == ["alice.jpg", "registered_live", "registered_live"]
+    for (_, row), expected in zip(templates["alice"], rows[[0, 2, 4]]):
+        assert np.array_equal(row, expected)
+    assert [source_file for source_file, _ in templates["bob"]] == ["bob.jpg"]
+    assert [source_file for source_file, _ in templates["carol"]] == ["registered_live"]
+
+
+def test_rebuild_caps_templates_like_the_server(database, monkeypatch):
+    store, rows = database
+    monkeypatch.setenv("FACE_MAX_TEMPLATES", "2")
+    assert create_embeddings_from_ids()
+
+    # The photo is alice's oldest template, so it is the one evicted
+    templates = stored_templates(store)
+    assert [source_file for source_file, _ in templates["alice"]] == ["registered_live", "registered_live"]
+    for (_, row), expected in zip(templates["alice"], rows[[2, 4]]):
+        assert np.array_equal(row, expected)
+    assert len(templates["bob"]) == 1 and len(templates["carol"]) == 1
+
+    # Rebuilding again keeps the evicted photo out without embedding it again
+    assert json.load(open("database/ids_manifest.json"))["files"]["alice.jpg"]["evicted"]
+    assert create_embeddings_from_ids()
+    assert {name: len(rows) for name, rows in stored_templates(store).items()} == {"alice": 2, "bob": 1, "carol": 1}
+
+
+class SmallFaceDetector:
+    """One face of 2% of the photo's width: too small to crop from a draft decode"""
+
+    def detect_faces(self, pixels):
+        height, width = pixels.shape[:2]
+        side = max(1, width // 50)
+        return [{'box': [width // 3, height // 2, side, side], 'confidence': 0.99, 'keypoints': {}}]
+
+
+@pytest.mark.parametrize("orientation", [None, 6])
+@pytest.mark.parametrize("detector", [StubDetector(), SmallFaceDetector()], ids=["large_face", "small_face"])
+def test_gallery_crops_match_server_crops(system, orientation, detector):
+    # Large enough that the server detects on a draft decode
+    with open("photo.jpg", 'wb') as f:
+        f.write(synthetic_image(3000, 2000, orientation=orientation))
+    system.detector = detector
+    system.cascade.detector = detector
+
+    probe, _, _ = system.extract_face_and_box("photo.jpg")
+    assert np.array_equal(extract_face("photo.jpg", detector=detector), probe)
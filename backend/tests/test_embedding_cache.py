@@ -0,0 +1,158 @@
+import io
+import time
+import threading
+import embedding_cache
+from conftest import photo
+from embedding_cache import EmbeddingCache, SingleFlight
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = EmbeddingCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()['evictions'] == 1 and len(cache) == 2
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(embedding_cache.time, "monotonic", clock)
+    cache = EmbeddingCache(ttl_seconds=60)
+    cache.put("a", 1)
+
+    clock.now += 60
+    assert cache.get("a") == 1
+    clock.now += 1
+    assert cache.get("a") is None
+    assert cache.stats()['expirations'] == 1 and len(cache) == 0
+
+
+def test_hits_and_misses_are_counted():
+    cache = EmbeddingCache()
+    assert cache.get("a") is None
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("a")
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+    assert stats['hit_rate'] == 2 / 3
+
+
+def test_a_disabled_cache_stores_nothing():
+    cache = EmbeddingCache(max_entries=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None and len(cache) == 0
+
+
+def test_keys_follow_the_bytes_and_the_configuration():
+    data = photo(1)
+    assert EmbeddingCache.key(data, "mtcnn") == EmbeddingCache.key(bytes(data), "mtcnn")
+    assert EmbeddingCache.key(data, "mtcnn") != EmbeddingCache.key(data, "cascade")
+    assert EmbeddingCache.key(data, "mtcnn") != EmbeddingCache.key(photo(2), "mtcnn")
+
+
+class CountingDetector:
+    def __init__(self, detector):
+        self.detector = detector
+        self.calls = 0
+
+    def detect_faces(self, pixels):
+        self.calls += 1
+        return self.detector.detect_faces(pixels)
+
+
+def test_repeated_uploads_skip_detection(system):
+    system.cascade.detector = system.detector = CountingDetector(system.detector)
+    first = system.embed_image(io.BytesIO(photo(1)))
+    second = system.embed_image(io.BytesIO(photo(1)))
+
+    assert system.detector.calls == 1
+    assert second[0] is first[0]
+    assert system.embedding_cache.stats()['hits'] == 1
+
+
+def coalesce(flights, compute, followers=4):
+    """Run one leader and then followers on the same key while the leader is in flight"""
+    results = [None] * (followers + 1)
+
+    def run(i):
+        try:
+            results[i] = flights.do("key", compute)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(0,))]
+    threads[0].start()
+    deadline = time.monotonic() + 5
+    while not flights.stats()['in_flight'] and time.monotonic() < deadline:
+        time.sleep(0.001)
+    threads += [threading.Thread(target=run, args=(i,)) for i in range(1, followers + 1)]
+    for thread in threads[1:]:
+        thread.start()
+    while flights.stats()['coalesced'] < followers and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return threads, results
+
+
+def test_followers_share_the_leaders_result():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return object()
+
+    threads, results = coalesce(flights, compute)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flights.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 4, 'coalesced_rate': 0.8}
+
+    # Nothing is kept once the leader is done
+    flights.do("key", compute)
+    assert len(calls) == 2
+
+
+def test_followers_get_the_leaders_error():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def compute():
+        release.wait(5)
+        raise ValueError("no face")
+
+    threads, results = coalesce(flights, compute)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert isinstance(results[0], ValueError)
+    assert all(result is results[0] for result in results)
+    assert flights.stats()['in_flight'] == 0
+
+
+def test_identical_images_in_one_batch_are_detected_once(system):
+    system.cascade.detector = system.detector = CountingDetector(system.detector)
+    embeddings, errors, _ = system.embed_images([io.BytesIO(photo(1)), io.BytesIO(photo(2)), io.BytesIO(photo(1))])
+
+    assert system.detector.calls == 2 and errors == [None, None, None]
+    assert embeddings[2] is embeddings[0]
+    assert system.in_flight.stats()['coalesced'] == 1
@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pytest
+from gallery import Gallery, VersionedGallery
+from test_gallery import brute_force as gallery_brute_force, assert_same_results
+from embedding_store import EmbeddingStore, RegistrationJournal, JOURNAL_HEADER, compact_store
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes
+
+
+def journal_records(count, dimension=32, seed=4):
+    rng = np.random.default_rng(seed)
+    rows = rng.standard_normal((count, dimension)).astype(np.float32)
+    rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+    return [(f"new_{i}", row) for i, row in enumerate(rows)]
+
+
+def assert_same_records(records, expected):
+    assert [name for name, _ in records] == [name for name, _ in expected]
+    for (_, embedding), (_, row) in zip(records, expected):
+        assert np.array_equal(embedding, row)
+
+
+def test_replay_drops_a_torn_last_record(tmp_path):
+    journal = RegistrationJournal(str(tmp_path / "journal.bin"))
+    records = journal_records(4)
+    for name, row in records:
+        journal.append(name, row)
+
+    # A crash in the middle of the last append
+    size = os.path.getsize(journal.path)
+    with open(journal.path, 'r+b') as f:
+        f.truncate(size - 7)
+
+    assert_same_records(journal.replay(), records[:3])
+    assert journal.record_count == 3
+    # The torn tail is gone, so appending resumes cleanly after the valid records
+    journal.append(*records[3])
+    assert_same_records(journal.replay(), records)
+
+
+def test_replay_stops_at_a_record_that_fails_its_crc(tmp_path):
+    journal = RegistrationJournal(str(tmp_path / "journal.bin"))
+    records = journal_records(3)
+    for name, row in records:
+        journal.append(name, row)
+
+    # Flip one byte of the second record's embedding
+    record_size = JOURNAL_HEADER.size + len("new_0") + 32 * 4
+    with open(journal.path, 'r+b') as f:
+        f.seek(record_size + JOURNAL_HEADER.size + 10)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    assert_same_records(journal.replay(), records[:1])
+    assert os.path.getsize(journal.path) == record_size
+
+
+def test_interrupted_compaction_is_replayed_first(tmp_path):
+    journal = RegistrationJournal(str(tmp_path / "journal.bin"))
+    records = journal_records(5)
+    for name, row in records[:2]:
+        journal.append(name, row)
+    journal.rotate()
+    for name, row in records[2:4]:
+        journal.append(name, row)
+    # A second rotation before the first compaction finished keeps both, in order
+    journal.rotate()
+    journal.append(*records[4])
+
+    assert_same_records(journal.compacting_records(), records[:4])
+    assert_same_records(journal.replay(), records)
+    assert_same_records(journal.replay(include_compacting=False), records[4:])
+
+
+def test_compaction_after_a_torn_write_matches_brute_force(tmp_path):
+    names, matrix = synthetic_gallery(500, dimension=32, seed=8)
+    store = EmbeddingStore(str(tmp_path))
+    store.save(names, matrix)
+    journal = RegistrationJournal(str(tmp_path / "journal.bin"))
+    records = journal_records(6) + [(names[3], journal_records(1, seed=9)[0][1])]
+    for name, row in records:
+        journal.append(name, row)
+    with open(journal.path, 'ab') as f:
+        f.write(JOURNAL_HEADER.pack(b'FRJ1', 4, 32, 0) + b'torn')
+
+    assert compact_store(store, journal, json_file=str(tmp_path / "embeddings.json")) == len(records)
+    assert not os.path.exists(journal.compacting_path)
+
+    # One template per identity: the journaled one replaces names[3]'s row
+    expected = dict(zip(names, matrix))
+    expected.update(records)
+    loaded_names, loaded_matrix, _ = store.load()
+    gallery = Gallery.from_matrix(loaded_names, loaded_matrix)
+    assert sorted(gallery) == sorted(expected)
+
+    probes = np.concatenate([synthetic_probes(matrix, 20), [row for _, row in records]])
+    reference = np.stack(list(expected.values()))
+    reference_names = list(expected)
+    for probe, results in zip(probes, gallery.search_batch(probes, k=3)):
+        distances = np.linalg.norm(reference - probe / np.linalg.norm(probe), axis=1)
+        nearest = np.argsort(distances, kind='stable')[:3]
+        assert [name for name, _ in results] == [reference_names[i] for i in nearest]
+        assert np.allclose([distance for _, distance in results], distances[nearest], atol=1e-5)
+
+
+@pytest.mark.parametrize("quantization", [None, "int8"])
+def test_registrations_on_a_loaded_gallery_leave_the_memory_map_alone(tmp_path, quantization):
+    names, matrix = synthetic_gallery(300, dimension=32, seed=10)
+    store = EmbeddingStore(str(tmp_path))
+    store.save(names, matrix)
+    loaded_names, loaded_matrix, _ = store.load()
+    versions = VersionedGallery(Gallery.from_matrix(loaded_names, loaded_matrix).configure_templates(2), None)
+    versions.current.gallery.quantize(quantization)
+
+    # New identities, a second template of a stored one and a third that evicts its stored row
+    records = journal_records(40) + [(names[5], journal_records(1, seed=11)[0][1])]
+    records += [(names[7], row) for _, row in journal_records(2, seed=12)]
+    gallery = versions.current.gallery
+    for record in records:
+        gallery = gallery.extended([record])
+    assert gallery.rows.base is loaded_matrix
+
+    templates = {name: [row] for name, row in zip(names, matrix)}
+    for name, row in records:
+        templates[name] = templates.get(name, [])[-1:] + [row]
+    assert gallery.template_count == sum(len(rows) for rows in templates.values())
+    # In position order: the stored rows but the evicted one, then the registered ones
+    expected = np.concatenate([np.delete(matrix, 7, axis=0), [row for _, row in records]])
+    assert np.array_equal(gallery.matrix, expected)
+
+    probes = np.concatenate([synthetic_probes(matrix, 20), [row for _, row in records[-5:]]])
+    everything = np.arange(gallery.rows.shape[0])
+    for probe, results in zip(probes, gallery.search_batch(probes, k=3)):
+        expected = gallery_brute_force(templates, probe, 3)
+        assert_same_results(results, expected)
+        assert_same_results(gallery.search(probe, k=3), expected)
+        assert_same_results(gallery.search(probe, k=3, candidates=everything), expected)
+
+
+def test_a_registered_template_is_the_one_a_reload_replays(system):
+    system.load_database()
+    rng = np.random.default_rng(13)
+    embedding = 3.0 * rng.standard_normal(512)
+    system.register_identity("alice", embedding)
+    registered = system.gallery.templates("alice")
+
+    system.load_database()
+    replayed = system.gallery.templates("alice")
+    assert len(registered) == len(replayed) == 1
+    assert np.array_equal(registered[0], replayed[0])
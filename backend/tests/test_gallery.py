@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from gallery import Gallery
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes
+
+
+def brute_force(templates, probe, k):
+    """Top-k identities by their closest template, one distance at a time"""
+    probe = probe / np.linalg.norm(probe)
+    best = {
+        name: min(np.linalg.norm(probe - row / np.linalg.norm(row)) for row in rows)
+        for name, rows in templates.items()
+    }
+    return sorted(best.items(), key=lambda item: item[1])[:k]
+
+
+def assert_same_results(results, expected):
+    assert [name for name, _ in results] == [name for name, _ in expected]
+    assert np.allclose([distance for _, distance in results], [distance for _, distance in expected], atol=1e-5)
+
+
+@pytest.mark.parametrize("kind", ["float16", "int8"])
+def test_quantized_search_matches_exact_search(kind):
+    names, matrix = synthetic_gallery(2000, dimension=64, seed=5)
+    exact = Gallery.from_matrix(names, matrix)
+    quantized = Gallery.from_matrix(names, matrix).quantize(kind)
+    probes = synthetic_probes(matrix, 40)
+
+    for probe, expected in zip(probes, exact.search_batch(probes, k=5)):
+        assert_same_results(quantized.search(probe, k=5), expected)
+    for results, expected in zip(quantized.search_batch(probes, k=5), exact.search_batch(probes, k=5)):
+        assert_same_results(results, expected)
+
+
+def test_quantized_search_after_adds_matches_exact_search():
+    names, matrix = synthetic_gallery(500, dimension=64, seed=6)
+    exact = Gallery.from_matrix(names[:100], matrix[:100])
+    quantized = Gallery.from_matrix(names[:100], matrix[:100]).quantize("int8")
+    # Past twice the trained size, so the quantizer is re-fitted on the way
+    for name, row in zip(names[100:], matrix[100:]):
+        exact.add(name, row)
+        quantized.add(name, row)
+
+    probes = synthetic_probes(matrix, 40)
+    for results, expected in zip(quantized.search_batch(probes, k=3), exact.search_batch(probes, k=3)):
+        assert_same_results(results, expected)
+
+
+def keep_oldest(rows, max_templates):
+    return rows[-max_templates:]
+
+
+def keep_distinct(rows, max_templates):
+    """The 'redundant' policy: drop the older of the two most similar templates"""
+    rows = list(rows)
+    while len(rows) > max_templates:
+        normalized = [row / np.linalg.norm(row) for row in rows]
+        pairs = [(i, j) for i in range(len(rows)) for j in range(i + 1, len(rows))]
+        i, _ = max(pairs, key=lambda pair: np.dot(normalized[pair[0]], normalized[pair[1]]))
+        del rows[i]
+    return rows
+
+
+@pytest.mark.parametrize("eviction, keep", [("oldest", keep_oldest), ("redundant", keep_distinct)])
+def test_multi_template_search_matches_brute_force(eviction, keep):
+    rng = np.random.default_rng(11)
+    # Photos of one person are close together, so the nearest rows to a
+    # probe are often several templates of the same identity
+    centres = rng.standard_normal((120, 32))
+    gallery = Gallery().configure_templates(3, eviction=eviction)
+    templates = {}
+    for _ in range(600):
+        number = rng.integers(0, 120)
+        name = f"id_{number:03d}"
+        row = (centres[number] + 0.4 * rng.standard_normal(32)).astype(np.float32)
+        gallery.add(name, row)
+        templates[name] = keep(templates.get(name, []) + [row], 3)
+
+    assert gallery.template_count == sum(len(rows) for rows in templates.values())
+    probes = [rows[-1] + 0.1 * rng.standard_normal(32) for rows in list(templates.values())[:30]]
+    probes += list(rng.standard_normal((10, 32)))
+    batch = gallery.search_batch(probes, k=5)
+    for probe, results in zip(probes, batch):
+        expected = brute_force(templates, probe, 5)
+        assert_same_results(gallery.search(probe, k=5), expected)
+        assert_same_results(results, expected)
+
+
+def test_evicted_templates_are_not_matched():
+    rng = np.random.default_rng(12)
+    rows = rng.standard_normal((4, 16)).astype(np.float32)
+    gallery = Gallery().configure_templates(2)
+    gallery.add("other", rng.standard_normal(16))
+    for row in rows:
+        gallery.add("a", row)
+
+    # The first two templates of 'a' were evicted: a probe at one of them
+    # scores against the remaining ones
+    results = gallery.search(rows[0], k=2)
+    assert dict(results)["a"] == pytest.approx(brute_force({"a": rows[2:]}, rows[0], 1)[0][1], abs=1e-5)
+    assert gallery.search(rows[3], k=1)[0] == ("a", pytest.approx(0.0, abs=1e-5))
+
+
+def test_lowering_the_template_cap_trims_identities():
+    names, matrix = synthetic_gallery(30, dimension=16, seed=2)
+    # Three templates per identity, registered in order
+    gallery = Gallery.from_matrix([f"id_{i % 10}" for i in range(30)], matrix).configure_templates(1)
+    templates = {f"id_{i}": [matrix[i + 20]] for i in range(10)}
+
+    assert len(gallery) == 10 and gallery.template_count == 10
+    probes = synthetic_probes(matrix, 20)
+    for probe, results in zip(probes, gallery.search_batch(probes, k=4)):
+        assert_same_results(results, brute_force(templates, probe, 4))
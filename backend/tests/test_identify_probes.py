@@ -0,0 +1,65 @@
+import csv
+import json
+import pytest
+from identify_probes import ResultWriter, completed_probes, identify_probes, result_row
+
+
+def rows(probes):
+    # Candidates and boxes with commas and quotes, as real rows have
+    return [
+        result_row(probe, [(f'id "{i}", x', 0.5 + i / 100, True), ("other", 1.2, False)], box=[1, 2, 30, 40],
+                   detection="mtcnn")
+        for i, probe in enumerate(probes)
+    ]
+
+
+def write(output_file, output_format, probes):
+    writer = ResultWriter(str(output_file), output_format)
+    writer.write(rows(probes))
+    writer.close()
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+def test_completed_probes_truncates_an_interrupted_last_line(tmp_path, output_format):
+    output_file = tmp_path / f"results.{output_format}"
+    write(output_file, output_format, ["a.jpg", "dir/b.jpg", "c.jpg"])
+    complete = output_file.read_bytes()
+    # Interrupted in the middle of writing the next row
+    with open(output_file, 'ab') as f:
+        f.write(complete.splitlines(keepends=True)[-1][:25])
+
+    assert completed_probes(str(output_file), output_format) == {"a.jpg", "dir/b.jpg", "c.jpg"}
+    assert output_file.read_bytes() == complete
+
+    # Resuming appends after the last complete row, without a second CSV header
+    write(output_file, output_format, ["d.jpg"])
+    assert completed_probes(str(output_file), output_format) == {"a.jpg", "dir/b.jpg", "c.jpg", "d.jpg"}
+    if output_format == "csv":
+        with open(output_file, newline='') as f:
+            parsed = list(csv.DictReader(f))
+        assert len(parsed) == 4
+        assert json.loads(parsed[0]['candidates'])[0]['name'] == 'id "0", x'
+    else:
+        parsed = [json.loads(line) for line in output_file.read_text().splitlines()]
+        assert [row['file'] for row in parsed] == ["a.jpg", "dir/b.jpg", "c.jpg", "d.jpg"]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+def test_completed_probes_of_a_new_output(tmp_path, output_format):
+    output_file = tmp_path / f"results.{output_format}"
+    assert completed_probes(str(output_file), output_format) == set()
+    output_file.write_bytes(b"")
+    assert completed_probes(str(output_file), output_format) == set()
+
+
+def test_a_fully_identified_directory_is_skipped(tmp_path):
+    probe_dir = tmp_path / "probes"
+    (probe_dir / "dir").mkdir(parents=True)
+    for probe in ["a.jpg", "dir/b.png", "notes.txt"]:
+        (probe_dir / probe).write_bytes(b"")
+    output_file = tmp_path / "results.jsonl"
+    write(output_file, "jsonl", ["a.jpg", "dir/b.png"])
+
+    # No gallery or models are needed when there is nothing left to do
+    summary = identify_probes(str(probe_dir), str(output_file))
+    assert summary['probes'] == 2 and summary['skipped'] == 2 and summary['identified'] == 0
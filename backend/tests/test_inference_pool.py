@@ -0,0 +1,61 @@
+import io
+import threading
+import numpy as np
+import inference_pool
+from conftest import photo
+from inference_pool import InferencePool
+from face_recognition import FaceRecognitionSystem
+
+
+class InlinePool(InferencePool):
+    """InferencePool that runs each job in the calling thread, against the worker system of the test"""
+
+    def __init__(self):
+        self.jobs = []
+        self._lock = threading.Lock()
+
+    def run(self, function, *args):
+        with self._lock:
+            self.jobs.append(function.__name__)
+        return function(*args)
+
+
+def test_faces_of_concurrent_requests_share_facenet_jobs(system, monkeypatch):
+    monkeypatch.setattr(inference_pool, "_system", system)
+    pool = InlinePool()
+    server = FaceRecognitionSystem(inference_pool=pool, load_database=False)
+    server.embedding_batcher.max_wait = 0.05
+
+    images = [photo(seed) for seed in range(16)]
+    results = [None] * len(images)
+
+    def run(i):
+        results[i] = server.embed_image(io.BytesIO(images[i]))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(images))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # One extraction job per image, but the crops are embedded in batches
+    assert pool.jobs.count("_extract_face") == 16
+    assert pool.jobs.count("_embeddings") == server.embedding_batcher.batches < 16
+    for image, (embedding, box, path) in zip(images, results):
+        expected, expected_box, expected_path = system.embed_image(io.BytesIO(image))
+        assert np.allclose(embedding, expected, atol=1e-6)
+        assert (box, path) == (expected_box, expected_path)
+
+
+def test_batch_and_crowd_requests_embed_their_faces_in_one_job(system, monkeypatch):
+    monkeypatch.setattr(inference_pool, "_system", system)
+    pool = InlinePool()
+    server = FaceRecognitionSystem(inference_pool=pool, load_database=False)
+
+    embeddings, errors, _ = server.embed_images([io.BytesIO(photo(seed)) for seed in range(4)] + [io.BytesIO(b'xx')])
+    assert pool.jobs == ["_extract_images", "_embeddings"]
+    assert all(embedding is not None for embedding in embeddings[:4]) and errors[4].startswith("Could not process")
+
+    pool.jobs.clear()
+    faces = server.embed_faces(io.BytesIO(photo(5)))
+    assert pool.jobs == ["_extract_faces", "_embeddings"] and len(faces) == 1
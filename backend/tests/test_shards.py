@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from gallery import Gallery
+from shards import shard_of, merge_top_k
+from embedding_store import EmbeddingStore
+from face_recognition import FaceRecognitionSystem
+from benchmarks.synthetic import synthetic_gallery, synthetic_probes
+
+
+def shard_galleries(names, matrix, shards, max_templates=1):
+    """Split a gallery by identity as the shard servers load it"""
+    owners = np.array([shard_of(name, shards) for name in names])
+    return [
+        Gallery.from_matrix([names[i] for i in np.flatnonzero(owners == shard)], matrix[owners == shard])
+        .configure_templates(max_templates)
+        for shard in range(shards)
+    ]
+
+
+def assert_same_results(merged, expected):
+    for results, reference in zip(merged, expected):
+        assert [name for name, _ in results] == [name for name, _ in reference]
+        assert np.allclose([distance for _, distance in results], [distance for _, distance in reference])
+
+
+@pytest.mark.parametrize("shards", [1, 3, 8])
+def test_merged_shard_results_match_one_gallery(shards):
+    names, matrix = synthetic_gallery(3000, dimension=64, seed=9)
+    probes = synthetic_probes(matrix, 30)
+    answers = [gallery.search_batch(probes, k=10) for gallery in shard_galleries(names, matrix, shards)]
+
+    merged = merge_top_k(answers, 10, len(probes))
+    assert_same_results(merged, Gallery.from_matrix(names, matrix).search_batch(probes, k=10))
+
+
+def test_merged_multi_template_results_match_one_gallery():
+    # Three templates per identity, all on the identity's shard
+    _, matrix = synthetic_gallery(1500, dimension=64, seed=10)
+    names = [f"id_{i % 500:04d}" for i in range(1500)]
+    probes = synthetic_probes(matrix, 30)
+    answers = [gallery.search_batch(probes, k=5) for gallery in shard_galleries(names, matrix, 4, max_templates=3)]
+
+    merged = merge_top_k(answers, 5, len(probes))
+    expected = Gallery.from_matrix(names, matrix).configure_templates(3).search_batch(probes, k=5)
+    assert_same_results(merged, expected)
+    assert all(len({name for name, _ in results}) == 5 for results in merged)
+
+
+def test_merge_with_fewer_identities_than_k():
+    answers = [[[("a", 0.5)], []], [[("b", 0.2), ("c", 0.9)], [("d", 0.1)]]]
+    assert merge_top_k(answers, 3, 2) == [[("b", 0.2), ("a", 0.5), ("c", 0.9)], [("d", 0.1)]]
+
+
+def test_registrations_on_two_shards_survive_a_compaction_and_restart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    names, matrix = synthetic_gallery(40, dimension=32, seed=11)
+    EmbeddingStore("database").save(names, matrix)
+
+    def start_shards():
+        return [FaceRecognitionSystem(shard=(shard, 2)) for shard in range(2)]
+
+    shards = start_shards()
+    rng = np.random.default_rng(12)
+    templates = {name: [row] for name, row in zip(names, matrix)}
+
+    def register(name):
+        row = rng.standard_normal(32).astype(np.float32)
+        row /= np.linalg.norm(row)
+        shards[shard_of(name, 2)].register_identity(name, row)
+        templates.setdefault(name, []).append(row)
+
+    # New IDs and extra templates of stored ones, on both shards
+    for name in ["new_a", "new_b", "new_c", "new_d", names[0], names[1], names[2]]:
+        register(name)
+    assert {shard_of(name, 2) for name in templates if name.startswith("new_")} == {0, 1}
+    shards[0].compact_database()
+    for name in ["new_e", "new_f", names[3]]:
+        register(name)
+
+    shards = start_shards()
+    for name, rows in templates.items():
+        stored = shards[shard_of(name, 2)].gallery.templates(name)
+        assert len(stored) == len(rows), name
+        for template, row in zip(stored, rows):
+            assert np.allclose(template, row)
@@ -0,0 +1,96 @@
+import io
+import time
+from tracking import FaceTracker, TrackerSessions
+from benchmarks.synthetic import synthetic_image
+
+
+class CountingDetector:
+    """One centred face; its side grows by grow after every call"""
+
+    def __init__(self, confidence=0.99, grow=0):
+        self.confidence = confidence
+        self.grow = grow
+        self.calls = 0
+
+    def detect_faces(self, pixels):
+        height, width = pixels.shape[:2]
+        side = min(height, width) // 3 + self.grow * self.calls
+        self.calls += 1
+        return [{
+            'box': [(width - side) // 2, (height - side) // 2, side, side],
+            'confidence': self.confidence,
+            'keypoints': {}
+        }]
+
+
+def frame(seed=0):
+    return io.BytesIO(synthetic_image(320, 240, seed=seed))
+
+
+def test_detection_runs_every_detect_every_frames_and_tracks_in_between(system):
+    system.detector = CountingDetector()
+    tracker = FaceTracker(system, detect_every=3)
+    results = [tracker.process(frame()) for _ in range(7)]
+
+    assert [result['detected'] for result in results] == [True, False, False, True, False, False, True]
+    assert system.detector.calls == 3
+    # One track all along, embedded once: later detections are not better
+    assert len({track['track_id'] for result in results for track in result['tracks']}) == 1
+    assert [track['updated'] for result in results for track in result['tracks']] == [True] + [False] * 6
+    assert tracker.stats() == {'frames': 7, 'detections': 3, 'embeddings': 1, 'active_tracks': 1}
+
+
+def test_a_track_seen_at_better_quality_is_embedded_again(system):
+    system.detector = CountingDetector(grow=20)
+    tracker = FaceTracker(system, detect_every=1)
+    results = [tracker.process(frame()) for _ in range(3)]
+
+    assert [result['tracks'][0]['updated'] for result in results] == [True, True, True]
+    assert tracker.embeddings == 3
+
+
+def test_a_lost_track_is_detected_again_in_the_same_frame(system):
+    system.detector = CountingDetector()
+    tracker = FaceTracker(system, detect_every=10)
+    first = tracker.process(frame(seed=0))
+    # A different scene: template matching loses the face
+    second = tracker.process(frame(seed=1))
+
+    assert second['detected'] and system.detector.calls == 2
+    assert [track['track_id'] for track in second['tracks']] == [first['tracks'][0]['track_id']]
+
+
+def test_faces_below_min_confidence_are_not_tracked(system):
+    system.detector = CountingDetector(confidence=0.8)
+    tracker = FaceTracker(system, min_confidence=0.9)
+    assert tracker.process(frame())['tracks'] == []
+    assert tracker.embeddings == 0
+
+
+class Tracker:
+    def __init__(self):
+        self.last_used = time.monotonic()
+
+
+def test_sessions_return_the_same_tracker_for_the_same_id():
+    sessions = TrackerSessions()
+    first = sessions.get("a", Tracker)
+    assert sessions.get("a", Tracker) is first
+    assert sessions.get("b", Tracker) is not first
+
+
+def test_sessions_expire_after_the_ttl():
+    sessions = TrackerSessions(ttl_seconds=60)
+    idle = sessions.get("a", Tracker)
+    idle.last_used -= 61
+    assert sessions.get("a", Tracker) is not idle
+
+
+def test_sessions_evict_the_least_recently_used_beyond_max_sessions():
+    sessions = TrackerSessions(max_sessions=2)
+    a, b = sessions.get("a", Tracker), sessions.get("b", Tracker)
+    assert sessions.get("a", Tracker) is a
+    sessions.get("c", Tracker)
+
+    assert sessions.get("a", Tracker) is a
+    assert sessions.get("b", Tracker) is not b
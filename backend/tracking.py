@@ -0,0 +1,281 @@
+import time
+import logging
+import threading
+import itertools
+from collections import OrderedDict
+import numpy as np
+import cv2
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def box_iou(a, b):
+    """Intersection over union of two [x, y, width, height] boxes"""
+    ax2, ay2 = a[0] + a[2], a[1] + a[3]
+    bx2, by2 = b[0] + b[2], b[1] + b[3]
+    inter_w = max(0, min(ax2, bx2) - max(a[0], b[0]))
+    inter_h = max(0, min(ay2, by2) - max(a[1], b[1]))
+    intersection = inter_w * inter_h
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class Track:
+    """One face followed across frames"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, box, confidence):
+        self.track_id = next(self._ids)
+        self.box = box
+        self.confidence = confidence
+        self.template = None
+        self.missed_detections = 0
+        self.lost = False
+
+        # Identity, refreshed only when the face is seen at better quality
+        self.embedding = None
+        self.embedded_quality = 0.0
+        self.name = "Unknown"
+        self.distance = None
+
+    @property
+    def quality(self):
+        return self.confidence * self.box[2] * self.box[3]
+
+
+class FaceTracker:
+    """
+    Follows faces between video frames so that MTCNN and FaceNet do not run
+    on every frame.
+
+    MTCNN runs every detect_every frames, or as soon as a track is lost.
+    In between, each track is followed by normalized template matching of
+    its last detected patch in a window around its previous box. A track is
+    embedded once when it appears and again only when it is detected with a
+    quality (confidence x box area) at least quality_gain times better than
+    the one it was embedded at; all crops that need embedding in a frame go
+    through one FaceNet call and one gallery matrix search.
+    """
+
+    def __init__(self, system, detect_every=10, min_confidence=0.9, iou_threshold=0.3,
+                 match_threshold=0.5, quality_gain=1.25, max_missed=2, max_side=None):
+        self.system = system
+        self.detect_every = max(1, detect_every)
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.match_threshold = match_threshold
+        self.quality_gain = quality_gain
+        self.max_missed = max_missed
+        self.max_side = max_side or system.detection_max_side
+        # Frames of one stream must be processed in order
+        self.lock = threading.Lock()
+
+        self.tracks = []
+        self.frame_index = 0
+        self.frames = 0
+        self.detections = 0
+        self.embeddings = 0
+        self.last_used = time.monotonic()
+
+    def decode(self, file):
+        """Decode a frame to RGB at no more than max_side pixels"""
+        from PIL import Image, ImageOps
+
+        with metrics.stage("decode"):
+            image = Image.open(file)
+            scale = self.max_side / max(image.size)
+            if scale < 1:
+                target = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+                if image.format == 'JPEG':
+                    image.draft('RGB', target)
+                image = image.convert('RGB')
+                if image.size != target:
+                    image = image.resize(target)
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            return np.asarray(image)
+
+    def _detect(self, pixels, gray):
+        results = self.system.detect_faces(pixels)
+        self.detections += 1
+        height, width = gray.shape
+        detections = []
+        for result in results:
+            confidence = float(result.get('confidence', 1.0))
+            if confidence < self.min_confidence:
+                continue
+            x, y, w, h = result['box']
+            x, y = max(0, x), max(0, y)
+            w, h = min(w, width - x), min(h, height - y)
+            if w > 0 and h > 0:
+                detections.append(([int(x), int(y), int(w), int(h)], confidence))
+
+        # Greedy IoU association of detections with existing tracks
+        pairs = sorted(
+            ((box_iou(track.box, box), t, d) for t, track in enumerate(self.tracks)
+             for d, (box, _) in enumerate(detections)),
+            reverse=True
+        )
+        matched_tracks, matched_detections = set(), set()
+        for iou, t, d in pairs:
+            if iou < self.iou_threshold:
+                break
+            if t in matched_tracks or d in matched_detections:
+                continue
+            matched_tracks.add(t)
+            matched_detections.add(d)
+            track = self.tracks[t]
+            track.box, track.confidence = detections[d]
+            track.missed_detections = 0
+            track.lost = False
+
+        survivors = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.missed_detections += 1
+                track.lost = True
+                if track.missed_detections > self.max_missed:
+                    continue
+            survivors.append(track)
+        for d, (box, confidence) in enumerate(detections):
+            if d not in matched_detections:
+                survivors.append(Track(box, confidence))
+        self.tracks = survivors
+
+        for track in self.tracks:
+            if not track.lost:
+                x, y, w, h = track.box
+                track.template = gray[y:y + h, x:x + w].copy()
+
+    def _follow(self, gray):
+        """Move each track by template matching around its previous box"""
+        height, width = gray.shape
+        for track in self.tracks:
+            if track.lost or track.template is None or track.template.size == 0:
+                track.lost = True
+                continue
+
+            x, y, w, h = track.box
+            margin_x, margin_y = w // 2, h // 2
+            x0, y0 = max(0, x - margin_x), max(0, y - margin_y)
+            x1, y1 = min(width, x + w + margin_x), min(height, y + h + margin_y)
+            window = gray[y0:y1, x0:x1]
+            th, tw = track.template.shape
+            if window.shape[0] < th or window.shape[1] < tw:
+                track.lost = True
+                continue
+
+            scores = cv2.matchTemplate(window, track.template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, location = cv2.minMaxLoc(scores)
+            if score < self.match_threshold:
+                track.lost = True
+                continue
+            track.box = [int(x0 + location[0]), int(y0 + location[1]), w, h]
+
+    def _embed(self, pixels, detected):
+        """Embed new tracks and tracks seen at a clearly better quality"""
+        pending = []
+        for track in self.tracks:
+            if not detected or track.lost:
+                continue
+            if track.embedding is None or track.quality >= track.embedded_quality * self.quality_gain:
+                x, y, w, h = track.box
+                face = cv2.resize(pixels[y:y + h, x:x + w], self.system.required_size)
+                pending.append((track, face))
+
+        if not pending:
+            return set()
+
+        embeddings = self.system.get_embeddings([face for _, face in pending])
+        self.embeddings += len(pending)
+        updated = set()
+        if len(self.system.id_embeddings):
+            matches = self.system.search_gallery_batch(list(embeddings), k=1)
+        else:
+            matches = [[] for _ in pending]
+        for (track, _), embedding, candidates in zip(pending, embeddings, matches):
+            track.embedding = embedding
+            track.embedded_quality = track.quality
+            name, distance = "Unknown", None
+            if candidates and candidates[0][2]:
+                name, distance = candidates[0][0], float(candidates[0][1])
+            track.name, track.distance = name, distance
+            updated.add(track.track_id)
+        return updated
+
+    def process(self, file):
+        """Advance the tracker by one frame and return the per-track state"""
+        self.last_used = time.monotonic()
+        pixels = self.decode(file)
+        gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+
+        detect = (
+            not self.tracks
+            or self.frame_index % self.detect_every == 0
+            or any(track.lost for track in self.tracks)
+        )
+        if not detect:
+            self._follow(gray)
+            # Re-detect right away instead of reporting stale boxes
+            if any(track.lost for track in self.tracks):
+                detect = True
+        if detect:
+            self._detect(pixels, gray)
+
+        updated = self._embed(pixels, detect)
+        frame = {
+            'frame': self.frame_index,
+            'detected': detect,
+            'tracks': [
+                {
+                    'track_id': track.track_id,
+                    'box': track.box,
+                    'name': track.name,
+                    'distance': track.distance,
+                    'updated': track.track_id in updated
+                }
+                for track in self.tracks if not track.lost
+            ]
+        }
+        self.frame_index += 1
+        self.frames += 1
+        return frame
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'detections': self.detections,
+            'embeddings': self.embeddings,
+            'active_tracks': sum(1 for track in self.tracks if not track.lost)
+        }
+
+
+class TrackerSessions:
+    """Trackers kept between requests of the same stream, expired after ttl_seconds idle"""
+
+    def __init__(self, max_sessions=256, ttl_seconds=300):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id, factory):
+        with self._lock:
+            now = time.monotonic()
+            for key in [key for key, tracker in self._sessions.items()
+                        if now - tracker.last_used > self.ttl_seconds]:
+                del self._sessions[key]
+
+            tracker = self._sessions.get(session_id)
+            if tracker is None:
+                tracker = factory()
+                self._sessions[session_id] = tracker
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            return tracker
+
+    def discard(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)